@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Approximate nearest-neighbour index over activity embeddings.
+
+Scoring a user against a whole catalog with an exact cosine scan touches
+every embedding row. RandomProjectionIndex is a random-hyperplane LSH index:
+each of `n_tables` tables hashes a row to the signs of its projections on
+`n_bits` random hyperplanes, so rows at a small angle to each other tend to
+share buckets. A query reads the rows in its own bucket of every table and,
+with multi-probe, in the buckets reached by flipping its `probes` least
+certain bits. Candidates are then scored exactly.
+
+Recall is traded against speed with n_tables and n_bits (fixed when the
+index is built) and probes (chosen per query). More tables or probes raise
+recall; more bits make buckets smaller and queries faster.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Dict, TYPE_CHECKING
+
+# numpy is imported where it is used so that importing this module stays cheap
+if TYPE_CHECKING:
+    import numpy as np
+
+DEFAULT_TABLES = 16
+DEFAULT_BITS = 8
+DEFAULT_PROBES = 2
+
+
+class RandomProjectionIndex:
+    """Random-hyperplane LSH tables over the rows of an embedding matrix."""
+
+    def __init__(self, planes: Any, n_bits: int, sorted_codes: Any = None, order: Any = None):
+        # planes: (n_features, n_tables * n_bits); per table, row ids sorted by
+        # bucket code and those codes
+        self.planes = planes
+        self.n_bits = n_bits
+        self.n_tables = planes.shape[1] // n_bits
+        self.sorted_codes = sorted_codes
+        self.order = order
+
+    @property
+    def n_rows(self) -> int:
+        return self.order.shape[1]
+
+    @classmethod
+    def build(cls, embeddings: Any, n_tables: int = DEFAULT_TABLES, n_bits: int = DEFAULT_BITS,
+              seed: int = 0) -> RandomProjectionIndex:
+        """Hash every row of a dense or sparse embedding matrix."""
+        import numpy as np
+
+        if not 1 <= n_bits <= 62:
+            raise ValueError("n_bits must be between 1 and 62")
+        if n_tables < 1:
+            raise ValueError("n_tables must be at least 1")
+
+        rng = np.random.default_rng(seed)
+        planes = rng.standard_normal((embeddings.shape[1], n_tables * n_bits))
+        return cls(planes, n_bits).reindex(embeddings)
+
+    def reindex(self, embeddings: Any) -> RandomProjectionIndex:
+        """A new index hashing the rows of `embeddings` with this index's hyperplanes."""
+        import numpy as np
+
+        index = type(self)(self.planes, self.n_bits)
+        codes = index._codes(np.asarray(embeddings @ self.planes))
+        index.order = np.argsort(codes, axis=0, kind='stable').T.copy()
+        index.sorted_codes = np.take_along_axis(codes.T, index.order, axis=1)
+        return index
+
+    def _codes(self, projections: np.ndarray) -> np.ndarray:
+        """Bucket code per row and table from the rows' hyperplane projections."""
+        import numpy as np
+
+        bits = (projections >= 0).reshape(len(projections), self.n_tables, self.n_bits)
+        # Accumulated bit by bit: widening all bits to int64 at once costs
+        # n_bits times the memory of the codes
+        codes = np.zeros(bits.shape[:2], dtype=np.int64)
+        shifted = np.empty_like(codes)
+        for bit in range(self.n_bits):
+            np.copyto(shifted, bits[:, :, bit])
+            shifted <<= bit
+            codes |= shifted
+        return codes
+
+    def candidates(self, vector: Any, probes: int = DEFAULT_PROBES) -> np.ndarray:
+        """Sorted ids of the rows sharing a probed bucket with `vector`."""
+        import numpy as np
+
+        projections = np.asarray(vector, dtype=np.float64) @ self.planes
+        codes = self._codes(projections[None, :])[0]
+
+        # Multi-probe: also visit the buckets across the `probes` hyperplanes
+        # the query is closest to, in every table
+        margins = np.abs(projections).reshape(self.n_tables, self.n_bits)
+        flips = np.argsort(margins, axis=1, kind='stable')[:, :min(probes, self.n_bits)]
+        probe_codes = np.concatenate([codes[:, None], codes[:, None] ^ np.left_shift(1, flips)], axis=1)
+
+        found = np.zeros(self.n_rows, dtype=bool)
+        for table, table_codes in enumerate(probe_codes):
+            starts = np.searchsorted(self.sorted_codes[table], table_codes, side='left')
+            ends = np.searchsorted(self.sorted_codes[table], table_codes, side='right')
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                found[self.order[table, start:end]] = True
+        return np.flatnonzero(found)
+
+    def params(self) -> Dict[str, Any]:
+        return {'type': 'random_projection', 'n_tables': self.n_tables, 'n_bits': self.n_bits, 'rows': self.n_rows}
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Content-addressed LRU cache of activity embedding rows.
+
+Recommend calls for a destination keep sending the same popular places.
+An activity's embedding depends only on the model and on the fields
+feature extraction reads, so rows are cached under the place id plus those
+field values and reused until the model version changes. Only cache misses
+go through the feature transform.
+
+Rows are dense numpy rows, or (indices, data) pairs for models that keep
+their embeddings sparse (see sparse_rows / stack_sparse_rows).
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+DEFAULT_CACHE_SIZE = 10000
+
+
+def embedding_keys(place_ids: Sequence[Any], raw_columns: Dict[str, Sequence[Any]]) -> List[Tuple]:
+    """
+    Cache keys for activities, from their ids and raw feature columns.
+
+    Keys hold the field values themselves rather than a digest, so two
+    different activities can never share a cached row.
+    """
+    return list(zip(
+        place_ids,
+        map(tuple, raw_columns['types']),
+        raw_columns['rating'],
+        raw_columns['price_level'],
+        raw_columns['user_ratings_total'],
+        raw_columns['has_photos']
+    ))
+
+
+def sparse_rows(matrix: Any) -> List[Tuple[Any, Any]]:
+    """Split a CSR matrix into per-row (column indices, values) pairs."""
+    indptr = matrix.indptr
+    return [
+        (matrix.indices[start:end], matrix.data[start:end])
+        for start, end in zip(indptr[:-1].tolist(), indptr[1:].tolist())
+    ]
+
+
+def stack_sparse_rows(rows: Sequence[Tuple[Any, Any]], n_features: int) -> Any:
+    """Assemble (column indices, values) pairs back into a CSR matrix."""
+    import numpy as np
+    from scipy import sparse
+
+    if not rows:
+        return sparse.csr_matrix((0, n_features))
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(indices) for indices, _ in rows], out=indptr[1:])
+    indices = np.concatenate([indices for indices, _ in rows])
+    data = np.concatenate([data for _, data in rows])
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(rows), n_features))
+
+
+def _frozen(row: Any) -> Any:
+    """Read-only copy of a cached row (or of both arrays of a sparse row)."""
+    if isinstance(row, tuple):
+        return tuple(_frozen(part) for part in row)
+    row = row.copy()
+    row.flags.writeable = False
+    return row
+
+
+class EmbeddingCache:
+    """LRU map from embedding keys to embedding rows for one model version."""
+
+    def __init__(self, max_entries: int = DEFAULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.version: Optional[str] = None
+        self.hits = 0
+        self.misses = 0
+        self._rows: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def lookup(self, version: str, keys: Sequence[Hashable]) -> Tuple[Dict[int, Any], List[int]]:
+        """
+        Find cached rows for `keys`.
+
+        Returns ({position: row} for hits, [positions of misses]). Rows cached
+        for another model version are discarded first.
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            if version != self.version:
+                self._reset(version)
+
+            for position, key in enumerate(keys):
+                row = self._rows.get(key)
+                if row is None:
+                    missing.append(position)
+                else:
+                    self._rows.move_to_end(key)
+                    found[position] = row
+
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def store(self, version: str, keys: Sequence[Hashable], rows: Any) -> None:
+        """Cache one embedding row per key, evicting the least recently used rows."""
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            if version != self.version:
+                return
+            for key, row in zip(keys, rows):
+                self._rows[key] = _frozen(row)
+                self._rows.move_to_end(key)
+            while len(self._rows) > self.max_entries:
+                self._rows.popitem(last=False)
+
+    def _reset(self, version: Optional[str]) -> None:
+        self._rows.clear()
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self) -> None:
+        """Drop all rows and statistics (e.g. when the model changes)."""
+        with self._lock:
+            self._reset(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'entries': len(self._rows),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses
+        }
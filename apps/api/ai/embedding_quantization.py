@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Reduced-precision storage for activity embeddings.
+
+Models keep their embedding matrix in one of EMBEDDING_PRECISIONS:
+
+    float64    the transform's own output (the default)
+    float32    half the memory and bandwidth; ranking is unaffected in practice
+    int8       scalar quantization: one int8 code per value and a float32
+               scale per dimension (QuantizedEmbeddings), an eighth of float64
+
+Scoring runs in float32 for both reduced precisions. Int8 rows are only
+widened a block at a time, so scoring a quantized catalog never holds a
+full float copy of it.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Optional, TYPE_CHECKING
+
+# numpy is imported where it is used so that importing this module stays cheap
+if TYPE_CHECKING:
+    import numpy as np
+
+EMBEDDING_PRECISIONS = ('float64', 'float32', 'int8')
+
+# Rows widened to float32 at a time when scoring int8 codes
+BLOCK_ROWS = 16384
+
+
+def check_precision(precision: str, sparse_embeddings: bool = False) -> str:
+    """Validate an embedding precision option."""
+    if precision not in EMBEDDING_PRECISIONS:
+        raise ValueError(f"Embedding precision must be one of {', '.join(EMBEDDING_PRECISIONS)}")
+    if precision == 'int8' and sparse_embeddings:
+        raise ValueError("int8 embedding precision needs dense embeddings")
+    return precision
+
+
+def to_precision(embeddings: Any, precision: str) -> Any:
+    """Embeddings (dense or CSR) stored at `precision`."""
+    import numpy as np
+
+    if precision == 'int8':
+        return QuantizedEmbeddings.quantize(embeddings)
+    dtype = np.dtype(precision)
+    if embeddings.dtype == dtype:
+        return embeddings
+    return embeddings.astype(dtype)
+
+
+def scoring_dtype(embeddings: Any) -> np.dtype:
+    """Dtype query vectors are cast to before scoring against `embeddings`."""
+    import numpy as np
+
+    if isinstance(embeddings, QuantizedEmbeddings) or embeddings.dtype == np.float32:
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+def row_norms(embeddings: Any) -> np.ndarray:
+    """L2 norm of every row of a dense, CSR or quantized embedding matrix."""
+    import numpy as np
+
+    if isinstance(embeddings, QuantizedEmbeddings):
+        return embeddings.norms
+    if hasattr(embeddings, 'multiply'):
+        return np.sqrt(np.asarray(embeddings.multiply(embeddings).sum(axis=1)).ravel())
+    return np.sqrt(np.einsum('ij,ij->i', embeddings, embeddings))
+
+
+def gather_rows(embeddings: Any, new_rows: Any, source: np.ndarray) -> Any:
+    """
+    Matrix whose row i is row source[i] of `embeddings` stacked over
+    `new_rows` (same format and precision).
+
+    Dense rows are copied run by run straight into the result, without
+    building the stacked matrix first, since updates keep most rows in order.
+    """
+    import numpy as np
+
+    if isinstance(embeddings, QuantizedEmbeddings):
+        return QuantizedEmbeddings(gather_rows(embeddings.codes, new_rows.codes, source), embeddings.scales,
+                                   gather_rows(embeddings.norms, new_rows.norms, source))
+    if hasattr(embeddings, 'indptr'):
+        from scipy import sparse
+
+        return sparse.vstack([embeddings, new_rows], format='csr')[source]
+
+    existing = len(embeddings)
+    result = np.empty((len(source),) + embeddings.shape[1:], dtype=embeddings.dtype)
+    # Runs of consecutive source rows within either matrix
+    breaks = np.flatnonzero((np.diff(source) != 1) | (source[1:] == existing)) + 1
+    starts = [0] + breaks.tolist()
+    ends = breaks.tolist() + [len(source)]
+    for start, end in zip(starts, ends):
+        first = int(source[start]) if len(source) else 0
+        part, first = (embeddings, first) if first < existing else (new_rows, first - existing)
+        result[start:end] = part[first:first + end - start]
+    return result
+
+
+class QuantizedEmbeddings:
+    """
+    Int8 embedding matrix: row i stands for codes[i] * scales.
+
+    Supports what catalog scoring needs from a dense matrix: shape, row
+    selection and a product with a query vector (or matrix of column
+    vectors). norms are the L2 norms of the dequantized rows.
+    """
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray, norms: np.ndarray):
+        self.codes = codes
+        self.scales = scales
+        self.norms = norms
+
+    @classmethod
+    def quantize(cls, embeddings: Any, scales: Optional[np.ndarray] = None) -> QuantizedEmbeddings:
+        """
+        Symmetric per-dimension quantization: each column's largest magnitude
+        maps to 127. With `scales` (e.g. to add rows to a quantized model)
+        those are used instead and values beyond their range are clipped.
+        """
+        import numpy as np
+
+        if hasattr(embeddings, 'toarray'):
+            embeddings = embeddings.toarray()
+        embeddings = np.asarray(embeddings)
+
+        if scales is None:
+            scales = (np.abs(embeddings).max(axis=0) / 127.0).astype(np.float32) if len(embeddings) else \
+                np.ones(embeddings.shape[1], dtype=np.float32)
+            scales[scales == 0.0] = 1.0
+
+        codes = np.empty(embeddings.shape, dtype=np.int8)
+        norms = np.empty(len(embeddings), dtype=np.float32)
+        for start in range(0, len(embeddings), BLOCK_ROWS):
+            block = slice(start, start + BLOCK_ROWS)
+            codes[block] = np.clip(np.rint(embeddings[block] / scales), -127, 127)
+            values = codes[block] * scales
+            norms[block] = np.sqrt(np.einsum('ij,ij->i', values, values))
+        return cls(codes, scales, norms)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scales.nbytes + self.norms.nbytes
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, rows: Any) -> QuantizedEmbeddings:
+        return QuantizedEmbeddings(self.codes[rows], self.scales, self.norms[rows])
+
+    def __matmul__(self, vectors: Any) -> np.ndarray:
+        import numpy as np
+
+        # Fold the scales into the query so the codes are only widened, never rescaled
+        scaled = np.asarray(vectors, dtype=np.float32) * (self.scales if np.ndim(vectors) == 1 else self.scales[:, None])
+        result = np.empty((len(self.codes),) + scaled.shape[1:], dtype=np.float32)
+        for start in range(0, len(self.codes), BLOCK_ROWS):
+            block = slice(start, start + BLOCK_ROWS)
+            result[block] = self.codes[block].astype(np.float32) @ scaled
+        return result
+
+    def toarray(self) -> np.ndarray:
+        """The dequantized float32 matrix."""
+        return self.codes * self.scales
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Shared-memory publication of activity embedding matrices.
+
+A process that loads the recommendation model can publish its embedding
+matrix into a named `multiprocessing.shared_memory` segment. Other processes
+on the host (sidecar workers, tips/health workers) attach to the segment and
+read the matrix zero-copy instead of each unpickling their own copy.
+
+Segments are tagged with the model version they were built from and listed
+in a small manifest next to the model file. A retrain publishes a new
+segment alongside the old one; the old segment stays valid until its
+publisher releases it (or exits), so attached readers are never left
+pointing at freed memory mid-request.
+"""
+
+import json
+import logging
+import os
+from datetime import datetime
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = "twemb_"
+MANIFEST_NAME = "shared_embeddings.json"
+
+
+def segment_name(version: str) -> str:
+    """Shared memory segment name for a model version (kept short for macOS)."""
+    return f"{SEGMENT_PREFIX}{version}"
+
+
+def _open_segment(name: str) -> shared_memory.SharedMemory:
+    """Attach to an existing segment without taking ownership of its lifetime."""
+    try:
+        return shared_memory.SharedMemory(name=name, create=False, track=False)
+    except TypeError:
+        # Python < 3.13 always registers the segment with the resource
+        # tracker, which would unlink it when this (non-owning) process exits
+        from multiprocessing import resource_tracker
+
+        segment = shared_memory.SharedMemory(name=name, create=False)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+class SharedEmbeddings:
+    """A dense embedding matrix backed by a named shared memory segment."""
+
+    def __init__(self, segment: shared_memory.SharedMemory, shape: Tuple[int, ...],
+                 dtype: str, version: str, owner: bool):
+        self.segment = segment
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.version = version
+        self.owner = owner
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=segment.buf)
+        if not owner:
+            self.array.flags.writeable = False
+
+    @property
+    def name(self) -> str:
+        return self.segment.name
+
+    @classmethod
+    def publish(cls, embeddings: Any, version: str) -> 'SharedEmbeddings':
+        """Copy a matrix into a new segment owned by the calling process."""
+        if hasattr(embeddings, 'toarray'):
+            embeddings = embeddings.toarray()
+        embeddings = np.ascontiguousarray(embeddings)
+
+        name = segment_name(version)
+        # Zero-size segments are not allowed
+        size = max(embeddings.nbytes, 1)
+        try:
+            segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a publisher that crashed or was restarted. Its
+            # contents are not trusted; processes still mapping it keep
+            # their mapping when the name is unlinked.
+            logger.warning(f"Replacing leftover shared embeddings segment {name}")
+            stale = shared_memory.SharedMemory(name=name, create=False)
+            stale.close()
+            stale.unlink()
+            segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        shared = cls(segment, embeddings.shape, embeddings.dtype.str, version, owner=True)
+        shared.array[...] = embeddings
+
+        logger.info(f"Published embeddings {embeddings.shape} to shared memory segment {segment.name}")
+        return shared
+
+    @classmethod
+    def attach(cls, entry: Dict[str, Any]) -> 'SharedEmbeddings':
+        """Attach read-only to a segment described by a manifest entry."""
+        segment = _open_segment(entry['name'])
+        logger.info(f"Attached to shared embeddings segment {entry['name']}")
+        return cls(segment, entry['shape'], entry['dtype'], entry['version'], owner=False)
+
+    def manifest_entry(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'version': self.version,
+            'shape': list(self.shape),
+            'dtype': self.dtype.str,
+            'publisher_pid': os.getpid(),
+            'published_at': datetime.now().isoformat()
+        }
+
+    def release(self) -> None:
+        """Detach; the owning publisher also removes the segment from the system."""
+        # Drop our view first, the buffer cannot be closed while exported
+        self.array = None
+        try:
+            self.segment.close()
+        except BufferError:
+            # A reader still holds a view; the mapping goes away with it
+            logger.warning(f"Shared embeddings segment {self.name} still in use, deferring close")
+        if self.owner:
+            try:
+                self.segment.unlink()
+                logger.info(f"Unlinked shared embeddings segment {self.name}")
+            except FileNotFoundError:
+                pass
+
+
+def read_manifest(model_dir: Path) -> Dict[str, Any]:
+    """Read the shared embeddings manifest for a model directory."""
+    path = Path(model_dir) / MANIFEST_NAME
+    if not path.exists():
+        return {'current': None, 'segments': {}}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _write_manifest(model_dir: Path, manifest: Dict[str, Any]) -> None:
+    path = Path(model_dir) / MANIFEST_NAME
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def register_segment(model_dir: Path, shared: SharedEmbeddings) -> None:
+    """Record a published segment and make it the current version."""
+    manifest = read_manifest(model_dir)
+    manifest['segments'][shared.version] = shared.manifest_entry()
+    manifest['current'] = shared.version
+    _write_manifest(model_dir, manifest)
+
+
+def unregister_segment(model_dir: Path, version: str) -> None:
+    """Remove a released segment from the manifest."""
+    manifest = read_manifest(model_dir)
+    manifest['segments'].pop(version, None)
+    if manifest.get('current') == version:
+        manifest['current'] = None
+    _write_manifest(model_dir, manifest)
+
+
+def find_segment(model_dir: Path, version: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """Manifest entry for a model version (the current one by default)."""
+    manifest = read_manifest(model_dir)
+    version = version or manifest.get('current')
+    if version is None:
+        return None
+    return manifest['segments'].get(version)
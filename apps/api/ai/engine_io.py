@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+Wire formats for the TripWeaver recommendation engine.
+
+Requests and responses are JSON by default. MessagePack framing is an
+optional, more compact alternative, and activity lists can be shipped as
+Arrow IPC streams so large candidate sets cross the process boundary as
+columns instead of thousands of per-field JSON objects.
+
+Responses are encoded compactly by encode_json, which understands numpy
+scalars and arrays, datetimes and dataclasses, and uses orjson when it is
+installed.
+
+msgpack and pyarrow are optional dependencies, imported only when a request
+actually uses them. orjson is optional as well; without it the standard
+library encoder is used.
+"""
+
+import base64
+import codecs
+import dataclasses
+import json
+import queue
+import struct
+import threading
+from collections.abc import Sequence
+from datetime import date, datetime
+from typing import Any, BinaryIO, Dict, Iterator, List
+
+# Request fields that may carry an Arrow IPC activity table
+ACTIVITY_FIELDS = ('activities', 'available_activities')
+
+# msgpack frames on streams are prefixed with a 4-byte big-endian length
+FRAME_HEADER = struct.Struct('>I')
+
+
+def _require_msgpack():
+    try:
+        import msgpack
+    except ImportError as e:
+        raise ImportError("MessagePack support requires the msgpack package (pip install msgpack)") from e
+    return msgpack
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError as e:
+        raise ImportError("Arrow IPC support requires the pyarrow package (pip install pyarrow)") from e
+    return pyarrow
+
+
+def _drop_nulls(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in row.items() if value is not None}
+
+
+class ColumnarActivities(Sequence):
+    """
+    Activity list backed by an Arrow table.
+
+    Behaves like a list of activity dicts, but feature extraction reads the
+    columns directly. Rows are only materialized as dicts when indexed or
+    iterated (e.g. to return the top recommendations). Null cells are left
+    out of row dicts, matching a missing key in JSON input.
+    """
+
+    def __init__(self, table: Any):
+        self.table = table
+        self._rows = None
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def __getitem__(self, index):
+        if self._rows is not None:
+            return self._rows[index]
+        if isinstance(index, slice):
+            return self.to_pylist()[index]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("activity index out of range")
+        return _drop_nulls(self.table.slice(index, 1).to_pylist()[0])
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self.to_pylist())
+
+    def to_pylist(self) -> List[Dict[str, Any]]:
+        """Materialize all rows as activity dicts (cached)."""
+        if self._rows is None:
+            self._rows = [_drop_nulls(row) for row in self.table.to_pylist()]
+        return self._rows
+
+    def column(self, name: str, default: Any) -> List[Any]:
+        """
+        Values of a column, with nulls and a missing column mapped to default.
+
+        Numeric columns are returned as numpy arrays without going through
+        Python objects.
+        """
+        if name not in self.table.column_names:
+            return [default] * len(self)
+        values = self.table.column(name)
+
+        pa = _require_pyarrow()
+        if default is not None and (pa.types.is_integer(values.type) or pa.types.is_floating(values.type)):
+            import pyarrow.compute as pc
+
+            return pc.fill_null(values, pa.scalar(default, type=values.type)).to_numpy()
+
+        return [default if value is None else value for value in values.to_pylist()]
+
+    def feature_columns(self) -> Dict[str, List[Any]]:
+        """The raw columns ActivityRecommendationEngine features are derived from."""
+        return {
+            'types': self.column('types', []),
+            'rating': self.column('rating', 0.0),
+            'price_level': self.column('price_level', 0),
+            'user_ratings_total': self.column('user_ratings_total', 0),
+            'has_photos': [1 if ref else 0 for ref in self.column('photo_reference', None)]
+        }
+
+
+def activities_from_arrow(payload: bytes) -> ColumnarActivities:
+    """Decode an Arrow IPC stream of activities."""
+    pa = _require_pyarrow()
+    reader = pa.ipc.open_stream(pa.py_buffer(payload))
+    return ColumnarActivities(reader.read_all())
+
+
+def activities_to_arrow(activities: List[Dict[str, Any]]) -> bytes:
+    """Encode activity dicts as an Arrow IPC stream (for clients and tests)."""
+    pa = _require_pyarrow()
+    table = pa.Table.from_pylist(activities)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def resolve_activity_payloads(request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Replace Arrow IPC activity payloads with ColumnarActivities.
+
+    A payload is raw bytes (MessagePack bin) or, for JSON clients,
+    {"arrow_ipc": "<base64>"}.
+    """
+    for field in ACTIVITY_FIELDS:
+        value = request.get(field)
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            request[field] = activities_from_arrow(bytes(value))
+        elif isinstance(value, dict) and 'arrow_ipc' in value:
+            request[field] = activities_from_arrow(base64.b64decode(value['arrow_ipc']))
+    return request
+
+
+class _PrefetchReader:
+    """Reads raw chunks on a background thread so input transfer overlaps processing."""
+
+    def __init__(self, stream: BinaryIO, chunk_size: int, max_chunks: int):
+        self._chunks = queue.Queue(maxsize=max_chunks)
+        self._thread = threading.Thread(
+            target=self._run, args=(stream, chunk_size), name='engine-stdin-prefetch', daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, stream: BinaryIO, chunk_size: int) -> None:
+        try:
+            while True:
+                chunk = stream.read(chunk_size)
+                self._chunks.put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            self._chunks.put(e)
+
+    def read(self) -> bytes:
+        chunk = self._chunks.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+
+class StreamingJsonRequest:
+    """
+    Incremental reader for one large JSON request object.
+
+    Items of the array under `array_key` are parsed and yielded one at a
+    time, so neither the raw payload nor the full object graph is held in
+    memory. Every other field is parsed whole into `fields`; fields that
+    appear after the array are only available once iteration finishes.
+    At most `prefetch_chunks` raw chunks are buffered ahead of the parser.
+    """
+
+    def __init__(self, stream: BinaryIO, array_key: str = 'activities',
+                 chunk_size: int = 1 << 16, prefetch_chunks: int = 8):
+        self.array_key = array_key
+        self.fields: Dict[str, Any] = {}
+        self.items_read = 0
+        # Whether the request has the array at all (it may be empty)
+        self.array_found = False
+
+        self._reader = _PrefetchReader(stream, chunk_size, prefetch_chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._state = 'start'
+
+    def _fill(self) -> bool:
+        """Append the next chunk to the buffer; False once the input is exhausted."""
+        if self._eof:
+            return False
+
+        chunk = self._reader.read()
+        if not chunk:
+            self._eof = True
+            self._buffer += self._utf8.decode(b'', final=True)
+            return False
+
+        # Drop the consumed prefix so the buffer only holds unparsed input
+        self._buffer = self._buffer[self._pos:] + self._utf8.decode(chunk)
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        """Skip whitespace and return the next significant character ('' at EOF)."""
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, allowed: str) -> str:
+        char = self._peek()
+        if not char or char not in allowed:
+            raise ValueError(f"Malformed streaming request: expected one of {allowed!r}, got {char!r}")
+        self._pos += 1
+        return char
+
+    def _value(self) -> Any:
+        """Parse the next complete JSON value, reading more input as needed."""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # A value ending exactly at the buffer end may be a truncated number
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def _read_fields(self) -> None:
+        """Parse object members until the streamed array starts or the object ends."""
+        if self._state == 'start':
+            self._expect('{')
+            if self._peek() == '}':
+                self._pos += 1
+                self._state = 'done'
+                return
+            self._state = 'members'
+
+        while self._state == 'members':
+            key = self._value()
+            if not isinstance(key, str):
+                raise ValueError("Malformed streaming request: object keys must be strings")
+            self._expect(':')
+
+            if key == self.array_key and self._peek() == '[':
+                self._pos += 1
+                self._state = 'array_first'
+                self.array_found = True
+                return
+
+            self.fields[key] = self._value()
+            if self._expect(',}') == '}':
+                self._state = 'done'
+
+    def _after_array(self) -> None:
+        if self._expect(',}') == '}':
+            self._state = 'done'
+        else:
+            self._state = 'members'
+            self._read_fields()
+
+    def read_header(self) -> Dict[str, Any]:
+        """Parse the fields that precede the streamed array."""
+        if self._state == 'start':
+            self._read_fields()
+        return self.fields
+
+    def items(self) -> Iterator[Any]:
+        """Yield the streamed array's items, then parse the remaining fields."""
+        self.read_header()
+
+        while self._state in ('array_first', 'array'):
+            if self._peek() == ']':
+                self._pos += 1
+                self._after_array()
+                break
+            if self._state == 'array':
+                self._expect(',')
+            self._state = 'array'
+
+            item = self._value()
+            self.items_read += 1
+            yield item
+
+            if self._peek() == ']':
+                self._pos += 1
+                self._after_array()
+
+        if self._state == 'members':
+            self._read_fields()
+
+
+def json_default(value: Any) -> Any:
+    """Convert values the json/msgpack encoders do not handle natively."""
+    if isinstance(value, ColumnarActivities):
+        return value.to_pylist()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    # numpy scalars and arrays (checked by duck typing to avoid importing numpy)
+    if hasattr(value, 'tolist') and hasattr(value, 'dtype'):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_COMPACT_ENCODER = json.JSONEncoder(
+    default=json_default, separators=(',', ':'), ensure_ascii=False, check_circular=False
+)
+_PRETTY_ENCODER = json.JSONEncoder(default=json_default, indent=2, ensure_ascii=False)
+
+
+def encode_json(payload: Any, pretty: bool = False) -> bytes:
+    """Encode a response as UTF-8 JSON, compact unless pretty is requested."""
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(payload, default=json_default, option=option)
+        except TypeError:
+            # e.g. integers beyond 64 bits; the stdlib encoder handles them
+            pass
+
+    encoder = _PRETTY_ENCODER if pretty else _COMPACT_ENCODER
+    return encoder.encode(payload).encode('utf-8')
+
+
+class JsonCodec:
+    """Newline-delimited JSON framing."""
+
+    name = 'json'
+
+    def frames(self, stream: BinaryIO) -> Iterator[bytes]:
+        for line in stream:
+            if line.strip():
+                yield line
+
+    def decode(self, frame: bytes) -> Any:
+        return json.loads(frame)
+
+    def encode(self, payload: Any) -> bytes:
+        return encode_json(payload) + b'\n'
+
+
+class MsgpackCodec:
+    """Length-prefixed MessagePack framing."""
+
+    name = 'msgpack'
+
+    def __init__(self):
+        self.msgpack = _require_msgpack()
+
+    def frames(self, stream: BinaryIO) -> Iterator[bytes]:
+        while True:
+            header = stream.read(FRAME_HEADER.size)
+            if not header:
+                return
+            if len(header) < FRAME_HEADER.size:
+                raise ValueError("Truncated MessagePack frame header")
+            (size,) = FRAME_HEADER.unpack(header)
+            frame = stream.read(size)
+            if len(frame) < size:
+                raise ValueError("Truncated MessagePack frame")
+            yield frame
+
+    def decode(self, frame: bytes) -> Any:
+        try:
+            return self.msgpack.unpackb(frame, raw=False)
+        except Exception as e:
+            raise ValueError(str(e)) from e
+
+    def encode(self, payload: Any) -> bytes:
+        body = self.msgpack.packb(payload, default=json_default, use_bin_type=True)
+        return FRAME_HEADER.pack(len(body)) + body
+
+
+CODECS = {
+    'json': JsonCodec,
+    'msgpack': MsgpackCodec
+}
+
+
+def get_codec(name: str):
+    """Instantiate the codec for a wire format name."""
+    if name not in CODECS:
+        raise ValueError(f"Unknown wire format: {name}")
+    return CODECS[name]()
+
+
+def decode_msgpack_requests(raw: bytes) -> List[Any]:
+    """Decode one or more concatenated (unframed) MessagePack documents."""
+    msgpack = _require_msgpack()
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(raw)
+    return list(unpacker)
+
+
+def encode_msgpack(payload: Any) -> bytes:
+    """Encode a single (unframed) MessagePack document."""
+    msgpack = _require_msgpack()
+    return msgpack.packb(payload, default=json_default, use_bin_type=True)
@@ -0,0 +1,707 @@
+#!/usr/bin/env python3
+"""
+Resident server mode for the TripWeaver recommendation engine.
+
+Spawning `recommendation_engine.py` per request pays for the interpreter,
+the ML library imports and the model load on every call. The server keeps a
+single ActivityRecommendationEngine loaded and answers newline-delimited JSON
+requests on stdin/stdout or on a Unix socket, one response line per request.
+With wire_format="msgpack" requests and responses are length-prefixed
+MessagePack frames instead.
+
+With workers > 0 the parent loads the model once and forks a pool of worker
+processes (through a fork server forked before any thread starts). Workers
+inherit the model (including the embedding matrix) copy-on-write and are
+handed one request at a time, so throughput scales across cores without
+one model copy per worker. A worker that dies is replaced and its request
+answered with an error.
+
+Requests wait in a bounded admission queue with two priority lanes: cheap
+interactive modes (explain, summary, ...) are started ahead of expensive
+bulk modes (recommend, auto_optimize, ...). A request arriving at a full
+lane is rejected straight away, and a request whose "deadline_ms" has
+passed by the time a worker is free is dropped without being run.
+
+Without workers, up to `threads` requests are scored at once in-process:
+they read an immutable model snapshot, so only train and update requests
+need the engine to themselves. The CLI then serves through a HotSwapEngine
+(model_swap): train and update requests are answered at once and built in
+a background process, and the new model is swapped in when it is ready.
+"""
+
+import gc
+import logging
+import multiprocessing
+import os
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Optional
+
+from engine_io import get_codec
+from engine_timing import encode_with_timings
+
+logger = logging.getLogger(__name__)
+
+RequestHandler = Callable[[Dict[str, Any], Any], Dict[str, Any]]
+
+# Modes that change the model: a forked worker would only update its own
+# copy, and in-process they run alone
+MODEL_CHANGING_MODES = ('train', 'update')
+
+# Modes that can take long (large activity lists, model fitting) queue in the
+# bulk lane; everything else is cheap and served from the interactive lane
+BULK_MODES = ('recommend', 'multi_recommend', 'auto_optimize', 'train', 'update', 'batch')
+LANES = ('interactive', 'bulk')
+
+DEFAULT_MAX_QUEUE = 64
+
+
+def request_lane(request: Dict[str, Any]) -> str:
+    """Priority lane a request is queued in."""
+    return 'bulk' if any(mode in request for mode in BULK_MODES) else 'interactive'
+
+
+def changes_model(request: Dict[str, Any]) -> bool:
+    """Whether a request (or an item of its batch) trains or updates the model."""
+    items = request.get('batch')
+    requests = [request] + (items if isinstance(items, list) else [])
+    return any(isinstance(item, dict) and any(mode in item for mode in MODEL_CHANGING_MODES) for item in requests)
+
+
+def _run_handler(handler: RequestHandler, request: Dict[str, Any], engine: Any) -> Dict[str, Any]:
+    """Run the request handler, turning failures into error responses."""
+    try:
+        return handler(request, engine)
+    except Exception as e:
+        logger.error(f"Error handling request: {e}")
+        return {
+            'status': 'error',
+            'message': str(e)
+        }
+
+
+def _pool_worker(engine: Any, handler: RequestHandler, connection: Any) -> None:
+    """Worker process loop: serve requests from the parent until a None sentinel arrives."""
+    logger.info(f"Engine worker {os.getpid()} started")
+    while True:
+        item = connection.recv()
+        if item is None:
+            break
+
+        seq, request = item
+        connection.send((seq, _run_handler(handler, request, engine)))
+
+    logger.info(f"Engine worker {os.getpid()} stopping")
+
+
+# Response to requests a pool whose workers all died cannot run
+_NO_WORKERS = {
+    'status': 'error',
+    'code': 'worker_died',
+    'message': 'No engine worker is left to handle the request'
+}
+
+
+def _fork_server(engine: Any, handler: RequestHandler, connection: Any, pool_connection: Any) -> None:
+    """
+    Fork server process loop: fork a worker for every request from the pool
+    and send back the pool's end of the worker's pipe, until a None sentinel
+    arrives.
+
+    The pool forks this process before it starts any thread, and the process
+    never starts one, so workers forked from it (replacements included) never
+    inherit a lock another thread was holding.
+    """
+    from multiprocessing.reduction import send_handle
+
+    # The pool's end stays open in the pool only, so this process sees it close
+    pool_connection.close()
+    while True:
+        # Reap workers that exited
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except ChildProcessError:
+            pass
+
+        if not connection.poll(1.0):
+            continue
+        try:
+            item = connection.recv()
+        except EOFError:
+            break
+        if item is None:
+            break
+
+        parent_end, child_end = multiprocessing.Pipe()
+        # Keep the children's garbage collection from dirtying shared pages
+        gc.collect()
+        gc.freeze()
+        pid = os.fork()
+        if pid == 0:
+            connection.close()
+            parent_end.close()
+            exit_code = 0
+            try:
+                _pool_worker(engine, handler, child_end)
+            except BaseException as e:
+                logger.error(f"Engine worker {os.getpid()} failed: {e}")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        child_end.close()
+        send_handle(connection, parent_end.fileno(), os.getppid())
+        connection.send(pid)
+        parent_end.close()
+
+
+class _PoolWorker:
+    """A worker process, the parent's end of its pipe and the request it is running."""
+
+    __slots__ = ('pid', 'connection', 'seq')
+
+    def __init__(self, pid: int, connection: Any):
+        self.pid = pid
+        self.connection = connection
+        # Sequence number of the request in flight (None: idle)
+        self.seq: Optional[int] = None
+
+
+class WorkerPool:
+    """
+    Pre-forked pool of engine worker processes.
+
+    The engine must be fully loaded before the pool starts: workers are
+    forked from a copy of the parent and share its memory pages until they
+    write to them. Results are delivered through futures resolved by a
+    collector thread in the parent.
+
+    Workers are forked by a fork server process that the pool forks before
+    starting any thread, because forking a process with running threads can
+    leave a child holding a lock nobody will release. The parent only asks
+    it for new workers, including replacements forked while the server's
+    threads are running.
+
+    Every worker has a pipe of its own and runs one request at a time, so
+    the parent knows which request each worker holds. (A queue shared by
+    all workers would not survive a worker killed while holding its lock.)
+    A worker that dies (OOM kill, crash) closes its pipe; its request is
+    answered with an error and a new worker replaces it.
+    """
+
+    def __init__(self, engine: Any, handler: RequestHandler, workers: int):
+        if workers < 1:
+            raise ValueError("Worker pool needs at least one worker")
+
+        self.engine = engine
+        self.handler = handler
+        self.workers = workers
+        self.restarts = 0
+
+        self._context = multiprocessing.get_context('fork')
+        self._workers: List[Optional[_PoolWorker]] = [None] * workers
+        # Requests waiting for an idle worker, in submission order
+        self._backlog = deque()
+        self._pending: Dict[int, Future] = {}
+        self._pending_lock = threading.Condition()
+        self._next_seq = 0
+        self._fork_server = None
+        self._fork_server_process = None
+        self._collector = None
+        self._closed = False
+        self._stopped = False
+        # Set once workers died and none could be forked to replace them
+        self._exhausted = False
+
+    def start(self) -> None:
+        """Fork the fork server and the workers, then start collecting responses."""
+        # Move everything allocated so far out of the collector's reach so
+        # the children's garbage collection does not dirty shared pages
+        gc.collect()
+        gc.freeze()
+        try:
+            self._fork_server, server_connection = self._context.Pipe()
+            self._fork_server_process = self._context.Process(
+                target=_fork_server, args=(self.engine, self.handler, server_connection, self._fork_server),
+                name='engine-fork-server', daemon=True
+            )
+            self._fork_server_process.start()
+            server_connection.close()
+        finally:
+            # The fork server keeps its frozen generation; the parent collects normally again
+            gc.unfreeze()
+
+        if not self._fork_workers(range(self.workers)):
+            raise RuntimeError("Could not start the engine workers")
+
+        # The collector is the only thread that asks for workers from here on
+        self._collector = threading.Thread(target=self._collect, name='engine-pool-collector', daemon=True)
+        self._collector.start()
+
+        logger.info(f"Started engine worker pool with {self.workers} workers")
+
+    def _fork_workers(self, indices: Iterable[int]) -> bool:
+        """Have the fork server fork workers into the given slots; False if it is gone."""
+        from multiprocessing.connection import Connection
+        from multiprocessing.reduction import recv_handle
+
+        for index in indices:
+            try:
+                self._fork_server.send(True)
+                connection = Connection(recv_handle(self._fork_server))
+                pid = self._fork_server.recv()
+            except (EOFError, OSError) as e:
+                logger.error(f"Engine fork server is gone ({e}); cannot start more workers")
+                return False
+            with self._pending_lock:
+                self._workers[index] = worker = _PoolWorker(pid, connection)
+                self._take_backlog(worker)
+        return True
+
+    def submit(self, request: Dict[str, Any]) -> Future:
+        """Queue a request for the next free worker."""
+        future = Future()
+        with self._pending_lock:
+            if self._closed:
+                raise RuntimeError("Worker pool is closed")
+            if self._exhausted:
+                future.set_result(dict(_NO_WORKERS))
+                return future
+            seq = self._next_seq
+            self._next_seq += 1
+            self._pending[seq] = future
+
+            self._backlog.append((seq, request))
+            idle = next((w for w in self._workers if w is not None and w.seq is None), None)
+            if idle is not None:
+                self._take_backlog(idle)
+        return future
+
+    def _take_backlog(self, worker: _PoolWorker) -> None:
+        """Hand the oldest waiting request to an idle worker (lock held)."""
+        if self._backlog:
+            worker.seq, request = self._backlog.popleft()
+            try:
+                worker.connection.send((worker.seq, request))
+            except OSError:
+                # The worker is gone; the collector answers the request and replaces it
+                pass
+
+    def _collect(self) -> None:
+        from multiprocessing.connection import wait as wait_ready
+
+        while not self._stopped:
+            with self._pending_lock:
+                workers = [worker for worker in self._workers if worker is not None]
+            ready = set(wait_ready([worker.connection for worker in workers], timeout=0.5))
+
+            # A worker's pipe reaches end of file once it has exited and its responses are read
+            dead = [worker for worker in workers if worker.connection in ready and not self._receive(worker)]
+            if dead and not self._stopped:
+                self._replace(dead)
+
+    def _receive(self, worker: _PoolWorker) -> bool:
+        """Deliver a response the worker sent; False when its pipe is closed."""
+        try:
+            seq, response = worker.connection.recv()
+        except (EOFError, OSError):
+            return False
+
+        with self._pending_lock:
+            future = self._pending.pop(seq, None)
+            if worker.seq == seq:
+                worker.seq = None
+                self._take_backlog(worker)
+            self._pending_lock.notify_all()
+        if future is not None:
+            future.set_result(response)
+        return True
+
+    def _replace(self, dead: List[_PoolWorker]) -> None:
+        """Answer the requests of workers that exited with an error and fork replacements."""
+        failed = []
+        indices = []
+        with self._pending_lock:
+            for worker in dead:
+                index = self._workers.index(worker)
+                self._workers[index] = None
+                indices.append(index)
+                worker.connection.close()
+                logger.error(f"Engine worker {worker.pid} exited unexpectedly; starting a replacement")
+                if worker.seq is not None:
+                    failed.append((self._pending.pop(worker.seq, None), worker.pid))
+            self.restarts += len(dead)
+            self._pending_lock.notify_all()
+
+        for future, pid in failed:
+            if future is not None:
+                future.set_result({
+                    'status': 'error',
+                    'code': 'worker_died',
+                    'message': f'Engine worker {pid} exited while handling the request'
+                })
+
+        if not self._fork_workers(indices):
+            self._fail_backlog_without_workers()
+
+    def _fail_backlog_without_workers(self) -> None:
+        """Answer waiting requests with an error once no worker is left to run them."""
+        with self._pending_lock:
+            if any(worker is not None for worker in self._workers):
+                return
+            self._exhausted = True
+            waiting = [self._pending.pop(seq, None) for seq, _ in self._backlog]
+            self._backlog.clear()
+            self._pending_lock.notify_all()
+        for future in waiting:
+            if future is not None:
+                future.set_result(dict(_NO_WORKERS))
+
+    def shutdown(self) -> None:
+        """Stop the workers after they finish the requests already queued."""
+        with self._pending_lock:
+            if self._closed:
+                return
+            self._closed = True
+            while self._backlog or any(w is not None and w.seq is not None for w in self._workers):
+                self._pending_lock.wait(1.0)
+            self._stopped = True
+            workers = [worker for worker in self._workers if worker is not None]
+
+        if self._collector is not None:
+            self._collector.join()
+        for worker in workers:
+            try:
+                worker.connection.send(None)
+            except OSError:
+                pass
+        for worker in workers:
+            # Workers are the fork server's children; end of file means one has exited
+            try:
+                worker.connection.recv()
+            except (EOFError, OSError):
+                pass
+            worker.connection.close()
+
+        if self._fork_server is not None:
+            try:
+                self._fork_server.send(None)
+            except OSError:
+                pass
+            self._fork_server_process.join()
+            self._fork_server.close()
+
+        logger.info("Engine worker pool stopped")
+
+
+class _Ticket:
+    """A request waiting in the admission queue."""
+
+    __slots__ = ('request', 'future', 'enqueued_at', 'deadline_ms', 'response')
+
+    def __init__(self, request: Dict[str, Any], deadline_ms: Optional[float] = None,
+                 response: Optional[Dict[str, Any]] = None):
+        self.request = request
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.deadline_ms = deadline_ms
+        # Set for frames that failed to decode; answered in turn without running
+        self.response = response
+
+    def waited_ms(self) -> float:
+        return (time.monotonic() - self.enqueued_at) * 1000
+
+
+class AdmissionQueue:
+    """
+    Bounded request queue with an interactive and a bulk lane.
+
+    Interactive requests are taken first, but once `burst` interactive
+    requests in a row have been taken while bulk work is waiting, the next
+    bulk request goes ahead so the bulk lane cannot starve.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_QUEUE, burst: int = 4):
+        if max_size < 1:
+            raise ValueError("Admission queue needs room for at least one request per lane")
+
+        self.max_size = max_size
+        self.burst = burst
+        self._lanes = {lane: deque() for lane in LANES}
+        self._ready = threading.Condition()
+        self._streak = 0
+        self._closed = False
+
+    def put(self, lane: str, item: Any) -> bool:
+        """Queue an item; False when its lane is full."""
+        with self._ready:
+            if self._closed:
+                raise RuntimeError("Admission queue is closed")
+            pending = self._lanes[lane]
+            if len(pending) >= self.max_size:
+                return False
+            pending.append(item)
+            self._ready.notify()
+            return True
+
+    def get(self) -> Any:
+        """Block for the next item; None once the queue is closed and drained."""
+        with self._ready:
+            while True:
+                interactive, bulk = self._lanes['interactive'], self._lanes['bulk']
+                if interactive and (not bulk or self._streak < self.burst):
+                    self._streak += 1
+                    return interactive.popleft()
+                if bulk:
+                    self._streak = 0
+                    return bulk.popleft()
+                if self._closed:
+                    return None
+                self._ready.wait()
+
+    def depth(self) -> Dict[str, int]:
+        with self._ready:
+            return {lane: len(pending) for lane, pending in self._lanes.items()}
+
+    def close(self) -> None:
+        """Stop accepting items; get() returns None after the backlog drains."""
+        with self._ready:
+            self._closed = True
+            self._ready.notify_all()
+
+
+class EngineServer:
+    """
+    Serves engine requests against a resident engine instance.
+
+    Every request line is a JSON object using the same modes as the one-shot
+    CLI. An optional "id" field is echoed back so clients can correlate
+    responses, and an optional "deadline_ms" bounds how long the request may
+    wait in the queue. Responses are written as they complete and may arrive
+    out of order when requests from both lanes are in flight.
+    """
+
+    def __init__(self, engine: Any, handler: RequestHandler, workers: int = 0, wire_format: str = 'json',
+                 max_queue: int = DEFAULT_MAX_QUEUE, threads: int = 1):
+        if threads < 1:
+            raise ValueError("threads must be at least 1")
+        if workers and threads > 1:
+            raise ValueError("threads apply to in-process serving; a worker pool runs one request per worker")
+        self.engine = engine
+        self.handler = handler
+        self.codec = get_codec(wire_format)
+        self.queue = AdmissionQueue(max_queue)
+        self._write_lock = threading.Lock()
+
+        self.pool = None
+        if workers:
+            self.pool = WorkerPool(engine, handler, workers)
+            self.pool.start()
+
+        # Scoring reads an immutable model snapshot (model_snapshot), so up to
+        # `threads` requests run in-process at once, while train and update
+        # requests take every slot and run alone. With a pool, one request runs
+        # per worker. Requests stay in the admission queue until a slot frees
+        # up so priorities still apply.
+        self._capacity = workers or threads
+        self._slots = threading.BoundedSemaphore(self._capacity)
+        self._executor = None
+        if not workers and threads > 1:
+            self._executor = ThreadPoolExecutor(threads, thread_name_prefix='engine-request')
+        self._dispatcher = threading.Thread(target=self._dispatch, name='engine-dispatcher', daemon=True)
+        self._dispatcher.start()
+
+        logger.info("Initialized resident engine server")
+
+    def submit(self, request: Dict[str, Any]) -> Future:
+        """Queue a decoded request; the future resolves to its response payload."""
+        if self.pool is not None and changes_model(request):
+            # Batch items count too: one worker would change only its own copy
+            return _resolved({
+                'status': 'error',
+                'message': 'train and update requests are not supported with a worker pool; retrain offline and restart the server'
+            })
+
+        deadline_ms = request.get('deadline_ms')
+        if deadline_ms is not None and (isinstance(deadline_ms, bool) or not isinstance(deadline_ms, (int, float))):
+            return _resolved({
+                'status': 'error',
+                'message': '"deadline_ms" must be a number of milliseconds'
+            })
+
+        lane = request_lane(request)
+        ticket = _Ticket(request, deadline_ms)
+        if not self.queue.put(lane, ticket):
+            logger.warning(f"Rejected {lane} request: queue full ({self.queue.max_size} waiting)")
+            return _resolved({
+                'status': 'error',
+                'code': 'overloaded',
+                'message': f'Server is overloaded: the {lane} queue is full, retry later'
+            })
+
+        return ticket.future
+
+    def _dispatch(self) -> None:
+        """Start queued requests, highest priority first, as execution slots free up."""
+        while True:
+            self._slots.acquire()
+            ticket = self.queue.get()
+            if ticket is None:
+                self._slots.release()
+                return
+
+            if ticket.response is not None:
+                self._slots.release()
+                ticket.future.set_result(ticket.response)
+                continue
+
+            waited_ms = ticket.waited_ms()
+            if ticket.deadline_ms is not None and waited_ms > ticket.deadline_ms:
+                self._slots.release()
+                ticket.future.set_result({
+                    'status': 'error',
+                    'code': 'deadline_exceeded',
+                    'message': f'Request deadline of {ticket.deadline_ms} ms passed after {waited_ms:.0f} ms in queue'
+                })
+                continue
+
+            if self.pool is not None:
+                self.pool.submit(ticket.request).add_done_callback(
+                    lambda done, ticket=ticket, waited_ms=waited_ms: self._complete(ticket, waited_ms, done.result())
+                )
+            elif self._executor is None:
+                self._complete(ticket, waited_ms, _run_handler(self.handler, ticket.request, self.engine))
+            else:
+                slots = 1
+                if changes_model(ticket.request):
+                    # Wait for the requests in flight; nothing else starts meanwhile
+                    for _ in range(self._capacity - 1):
+                        self._slots.acquire()
+                    slots = self._capacity
+                self._executor.submit(self._run, ticket, waited_ms, slots)
+
+    def _run(self, ticket: _Ticket, waited_ms: float, slots: int) -> None:
+        self._complete(ticket, waited_ms, _run_handler(self.handler, ticket.request, self.engine), slots)
+
+    def _complete(self, ticket: _Ticket, waited_ms: float, response: Dict[str, Any], slots: int = 1) -> None:
+        self._slots.release(slots)
+        timings = response.get('timings')
+        if isinstance(timings, dict):
+            # Time spent waiting for a slot counts towards the request's latency
+            timings = dict(timings, queue=round(waited_ms, 3))
+            timings['total'] = round(timings.pop('total', 0.0) + waited_ms, 3)
+            response = dict(response, timings=timings)
+        ticket.future.set_result(response)
+
+    def handle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Run one decoded request and return its response payload."""
+        return self._finish(request, self.submit(request).result())
+
+    def _finish(self, request: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Any]:
+        if 'id' in request:
+            response = dict(response, id=request['id'])
+        return response
+
+    def _decode(self, frame: bytes):
+        """Decode a request frame into (request, None) or (None, error response)."""
+        try:
+            request = self.codec.decode(frame)
+        except ValueError as e:
+            return None, {
+                'status': 'error',
+                'message': f"Invalid {self.codec.name} request: {e}"
+            }
+
+        if not isinstance(request, dict):
+            return None, {
+                'status': 'error',
+                'message': 'Request must be an object'
+            }
+
+        return request, None
+
+    def handle_frame(self, frame: bytes) -> Dict[str, Any]:
+        """Decode one request frame and return its response payload."""
+        request, error = self._decode(frame)
+        if error is not None:
+            return error
+        return self.handle(request)
+
+    def encode(self, response: Dict[str, Any]) -> bytes:
+        """Encode a response frame, timing the encoding when the response reports timings."""
+        return encode_with_timings(response, self.codec.encode, self.codec.name == 'json')
+
+    def _write(self, stdout: BinaryIO, response: Dict[str, Any]) -> None:
+        with self._write_lock:
+            stdout.write(self.encode(response))
+            stdout.flush()
+
+    def serve_stdio(self, stdin: Optional[BinaryIO] = None, stdout: Optional[BinaryIO] = None) -> None:
+        """Serve requests from stdin until it is closed, writing responses to stdout."""
+        stdin = stdin or sys.stdin.buffer
+        stdout = stdout or sys.stdout.buffer
+
+        logger.info(f"Serving engine requests on stdin/stdout ({self.codec.name})")
+        in_flight = []
+        for frame in self.codec.frames(stdin):
+            request, error = self._decode(frame)
+            if error is not None:
+                # Queued so the error is answered in turn with earlier requests
+                request = {}
+                ticket = _Ticket(request, response=error)
+                future = ticket.future if self.queue.put('interactive', ticket) else _resolved(error)
+            else:
+                future = self.submit(request)
+            future.add_done_callback(
+                lambda done, request=request: self._write(stdout, self._finish(request, done.result()))
+            )
+            if not future.done():
+                in_flight.append(future)
+
+        wait(in_flight)
+        logger.info("stdin closed, engine server stopping")
+
+    def serve_unix_socket(self, path: str) -> None:
+        """Serve requests on a Unix socket until interrupted."""
+        if os.path.exists(path):
+            os.unlink(path)
+
+        server = self
+
+        class _ConnectionHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for frame in server.codec.frames(self.rfile):
+                    response = server.handle_frame(frame)
+                    self.wfile.write(server.encode(response))
+                    self.wfile.flush()
+
+        with socketserver.ThreadingUnixStreamServer(path, _ConnectionHandler) as unix_server:
+            unix_server.daemon_threads = True
+            logger.info(f"Serving engine requests on unix socket {path} ({self.codec.name})")
+            try:
+                unix_server.serve_forever()
+            except KeyboardInterrupt:
+                logger.info("Interrupted, engine server stopping")
+            finally:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def close(self) -> None:
+        """Finish the queued requests, then release the worker pool, if any."""
+        self.queue.close()
+        self._dispatcher.join()
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def _resolved(response: Dict[str, Any]) -> Future:
+    future = Future()
+    future.set_result(response)
+    return future
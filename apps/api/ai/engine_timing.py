@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Per-stage latency accounting for engine requests.
+
+Requests (or the CLI with --timings) can ask for a "timings" block in the
+response that breaks the request's wall time down into stages such as
+import, model_load, feature_extraction, transform, similarity, boosting,
+sort and serialize, in milliseconds.
+
+The timer for the request being handled is kept in a context variable so
+engine code records stages with `with stage('transform'):` without the
+timer being threaded through every call. Outside a timed request `stage`
+is a no-op. Nested stages are exclusive: time spent in an inner stage is
+not counted again in the outer one, so the stages add up to at most the
+total.
+"""
+
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Any, Callable, Dict, Optional
+
+_current_timer: ContextVar[Optional['StageTimer']] = ContextVar('engine_stage_timer', default=None)
+
+_NO_STAGE = nullcontext()
+
+
+class StageTimer:
+    """Accumulates wall time per named stage for one request."""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.stages: Dict[str, float] = {}
+        # [name, started, seconds spent in nested stages]
+        self._stack = []
+
+    @contextmanager
+    def stage(self, name: str):
+        entry = [name, perf_counter(), 0.0]
+        self._stack.append(entry)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = perf_counter() - entry[1]
+            self.add(name, elapsed - entry[2])
+            if self._stack:
+                self._stack[-1][2] += elapsed
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def as_dict(self) -> Dict[str, float]:
+        """Stage durations plus the elapsed total, in milliseconds."""
+        timings = {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()}
+        timings['total'] = round((perf_counter() - self.started) * 1000, 3)
+        return timings
+
+
+def current_timer() -> Optional[StageTimer]:
+    return _current_timer.get()
+
+
+@contextmanager
+def activate(timer: StageTimer):
+    """Make `timer` the one `stage` records into for the enclosed code."""
+    token = _current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _current_timer.reset(token)
+
+
+def stage(name: str):
+    """Time the enclosed block as `name` on the active timer, if any."""
+    timer = _current_timer.get()
+    if timer is None:
+        return _NO_STAGE
+    return timer.stage(name)
+
+
+def encode_with_timings(payload: Any, encode: Callable[[Any], bytes], json_output: bool) -> bytes:
+    """
+    Encode a response, adding the time spent encoding to its timings block.
+
+    The response body is encoded once without the block. For JSON the
+    completed block is spliced in as the last key; other formats encode the
+    response again with the block attached.
+    """
+    timings = payload.get('timings') if isinstance(payload, dict) else None
+    if not isinstance(timings, dict):
+        return encode(payload)
+
+    body_payload = {key: value for key, value in payload.items() if key != 'timings'}
+    start = perf_counter()
+    body = encode(body_payload)
+    serialize_ms = (perf_counter() - start) * 1000
+
+    timings = dict(timings)
+    total = timings.pop('total', 0.0)
+    timings['serialize'] = round(timings.get('serialize', 0.0) + serialize_ms, 3)
+    timings['total'] = round(total + serialize_ms, 3)
+
+    if json_output and body_payload:
+        from engine_io import encode_json
+
+        document = body.rstrip()
+        return document[:-1] + b',"timings":' + encode_json(timings) + b'}' + body[len(document):]
+    return encode(dict(body_payload, timings=timings))
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Activity feature columns and a compiled form of the fitted feature pipeline.
+
+Activities are featurized column-wise: Google Places `types` are interned
+into integer ids once and the derived category flags are computed with
+bitmask operations over those ids.
+
+The model is trained with an sklearn ColumnTransformer (one-hot primary
+type, standard-scaled numeric features, TF-IDF over the type list). Its
+per-call overhead dominates request latency when the candidate list is
+small, so after training the fitted parameters are exported into a
+CompiledFeatureTransform. It produces the same embeddings with a few numpy
+and scipy.sparse operations, straight from the interned columns, without
+building a DataFrame.
+
+HashedFeatureTransform is the same transform with the fitted category and
+term vocabularies replaced by fixed-width hashing, for models trained out
+of core (see hashed_training), where no vocabulary is fitted.
+"""
+
+from __future__ import annotations
+
+import re
+import zlib
+from itertools import chain
+from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+# numpy, pandas and scipy are imported where they are used so that importing
+# this module stays cheap for the pure-Python engine modes
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+# Google Places types behind each derived category flag
+TYPE_CATEGORIES = {
+    'is_food': ('restaurant', 'cafe', 'bar', 'food'),
+    'is_cultural': ('museum', 'art_gallery', 'library', 'church'),
+    'is_outdoor': ('park', 'natural_feature', 'recreation_area'),
+    'is_entertainment': ('amusement_park', 'movie_theater', 'stadium'),
+    'is_shopping': ('shopping_mall', 'store', 'department_store'),
+}
+
+CATEGORICAL_FEATURES = ['primary_type']
+NUMERICAL_FEATURES = [
+    'rating', 'price_level', 'user_ratings_total', 'has_photos',
+    *TYPE_CATEGORIES,
+    'is_highly_rated', 'is_popular', 'is_expensive'
+]
+TEXT_FEATURE = 'types_text'
+
+# Columns of the feature table, in order
+FEATURE_COLUMNS = ['primary_type', 'types_text', *NUMERICAL_FEATURES]
+
+# TfidfVectorizer's default tokenization
+DEFAULT_TOKEN_PATTERN = r"(?u)\b\w\w+\b"
+
+
+def intern_types(types_column: List[List[str]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Intern per-activity type lists into integer ids.
+
+    Returns (vocabulary, type_ids, offsets): activity i has the types
+    vocabulary[type_ids[offsets[i]:offsets[i + 1]]].
+    """
+    import numpy as np
+    import pandas as pd
+
+    lengths = np.fromiter(map(len, types_column), dtype=np.int64, count=len(types_column))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    flat_types = list(chain.from_iterable(types_column))
+    if not flat_types:
+        return np.empty(0, dtype=object), np.empty(0, dtype=np.int64), offsets
+
+    type_ids, vocabulary = pd.factorize(np.array(flat_types, dtype=object))
+    return np.asarray(vocabulary, dtype=object), type_ids, offsets
+
+
+def select_interned(interned: Tuple[np.ndarray, np.ndarray, np.ndarray],
+                    rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """intern_types output restricted to the activities at `rows` (same vocabulary)."""
+    import numpy as np
+
+    vocabulary, type_ids, offsets = interned
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    selected_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=selected_offsets[1:])
+    positions = np.arange(selected_offsets[-1]) + np.repeat(starts - selected_offsets[:-1], lengths)
+    return vocabulary, type_ids[positions], selected_offsets
+
+
+def category_flags(vocabulary: np.ndarray, type_ids: np.ndarray, offsets: np.ndarray) -> Dict[str, np.ndarray]:
+    """0/1 TYPE_CATEGORIES flags per activity, from interned types."""
+    import numpy as np
+
+    # One bit per category for every distinct type, OR-ed over each activity's types
+    vocabulary_bits = np.zeros(len(vocabulary), dtype=np.uint8)
+    for bit, category_types in enumerate(TYPE_CATEGORIES.values()):
+        members = set(category_types)
+        in_category = np.fromiter((t in members for t in vocabulary), dtype=bool, count=len(vocabulary))
+        vocabulary_bits |= in_category.astype(np.uint8) << bit
+
+    activity_bits = np.zeros(len(offsets) - 1, dtype=np.uint8)
+    has_types = offsets[1:] > offsets[:-1]
+    if has_types.any():
+        activity_bits[has_types] = np.bitwise_or.reduceat(vocabulary_bits[type_ids], offsets[:-1][has_types])
+
+    return {
+        name: ((activity_bits >> bit) & 1).astype(np.int64)
+        for bit, name in enumerate(TYPE_CATEGORIES)
+    }
+
+
+class FeatureColumns:
+    """
+    Features of a list of activities, held as columns.
+
+    Built from the raw per-activity values (types, rating, price_level,
+    user_ratings_total, has_photos). `frame()` gives the DataFrame the sklearn
+    pipeline is fitted on; CompiledFeatureTransform reads the interned types
+    and numeric arrays directly.
+    """
+
+    def __init__(self, raw: Dict[str, Any]):
+        import numpy as np
+
+        self.types = raw['types']
+        self.vocabulary, self.type_ids, self.offsets = intern_types(self.types)
+        self.has_types = self.offsets[1:] > self.offsets[:-1]
+
+        rating = np.asarray(raw['rating'])
+        price_level = np.asarray(raw['price_level'])
+        user_ratings_total = np.asarray(raw['user_ratings_total'])
+
+        # In NUMERICAL_FEATURES order
+        self.numeric = {
+            'rating': rating,
+            'price_level': price_level,
+            'user_ratings_total': user_ratings_total,
+            'has_photos': np.asarray(raw['has_photos'], dtype=np.int64),
+
+            # Derived binary features
+            **category_flags(self.vocabulary, self.type_ids, self.offsets),
+
+            # Quality indicators
+            'is_highly_rated': (rating >= 4.0).astype(np.int64),
+            'is_popular': (user_ratings_total >= 100).astype(np.int64),
+            'is_expensive': (price_level >= 3).astype(np.int64)
+        }
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def primary_type_ids(self) -> np.ndarray:
+        """Vocabulary id of each activity's first type (-1 for activities without types)."""
+        import numpy as np
+
+        ids = np.full(len(self), -1, dtype=np.int64)
+        ids[self.has_types] = self.type_ids[self.offsets[:-1][self.has_types]]
+        return ids
+
+    def primary_type(self) -> np.ndarray:
+        import numpy as np
+
+        primary_type = np.full(len(self), 'unknown', dtype=object)
+        primary_type[self.has_types] = self.vocabulary[self.primary_type_ids()[self.has_types]]
+        return primary_type
+
+    def type_incidence(self):
+        """Sparse activities x vocabulary matrix counting each activity's types."""
+        import numpy as np
+        from scipy import sparse
+
+        return sparse.csr_matrix(
+            (np.ones(len(self.type_ids)), self.type_ids, self.offsets),
+            shape=(len(self), len(self.vocabulary))
+        )
+
+    def frame(self) -> pd.DataFrame:
+        """The feature table, with FEATURE_COLUMNS in order."""
+        import pandas as pd
+
+        features = {
+            'primary_type': self.primary_type(),
+            'types_text': [' '.join(activity_types) for activity_types in self.types],
+            **self.numeric
+        }
+        return pd.DataFrame(features, columns=FEATURE_COLUMNS)
+
+
+class CompiledFeatureTransform:
+    """
+    The fitted feature pipeline reduced to its parameters.
+
+    Output columns follow the ColumnTransformer: one-hot primary type (the
+    dropped first category and unknown types are all zeros), standardized
+    numeric features, then l2-normalized TF-IDF weights over the fitted
+    vocabulary.
+    """
+
+    def __init__(self, categories: List[str], mean: Any, scale: Any, vocabulary: Dict[str, int],
+                 idf: Any, token_pattern: str, lowercase: bool = True, dropped_category: Optional[str] = None):
+        import numpy as np
+
+        self.categories = list(categories)
+        # The fitted category the encoder dropped (encoded as all zeros, like an unknown one)
+        self.dropped_category = dropped_category
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.vocabulary = dict(vocabulary)
+        self.idf = np.asarray(idf, dtype=np.float64)
+        self.token_pattern = token_pattern
+        self.lowercase = lowercase
+
+        self._category_index = {category: i for i, category in enumerate(self.categories)}
+        self._token_re = re.compile(token_pattern)
+        self._numeric_start = len(self.categories)
+        self._text_start = self._numeric_start + len(self.mean)
+        self.n_features = self._text_start + len(self.idf)
+
+    @classmethod
+    def from_pipeline(cls, pipeline: Any) -> Optional[CompiledFeatureTransform]:
+        """
+        Export the parameters of a fitted training pipeline.
+
+        Returns None when the pipeline uses options this transform does not
+        implement; callers then keep using the pipeline itself.
+        """
+        try:
+            preprocessor = pipeline.named_steps['preprocessor']
+            encoder = preprocessor.named_transformers_['cat']
+            scaler = preprocessor.named_transformers_['num']
+            vectorizer = preprocessor.named_transformers_['text']
+        except (AttributeError, KeyError):
+            return None
+
+        layout = [(name, columns) for name, _, columns in preprocessor.transformers_ if name != 'remainder']
+        if layout != [('cat', CATEGORICAL_FEATURES), ('num', NUMERICAL_FEATURES), ('text', TEXT_FEATURE)]:
+            return None
+        if getattr(encoder, '_infrequent_enabled', False) or scaler.scale_ is None or scaler.mean_ is None:
+            return None
+        if (vectorizer.analyzer != 'word' or vectorizer.ngram_range != (1, 1) or vectorizer.binary
+                or vectorizer.norm != 'l2' or not vectorizer.use_idf or vectorizer.sublinear_tf
+                or vectorizer.tokenizer is not None or vectorizer.preprocessor is not None
+                or vectorizer.strip_accents is not None):
+            return None
+
+        drop_idx = encoder.drop_idx_[0] if encoder.drop_idx_ is not None else None
+        categories = [category for i, category in enumerate(encoder.categories_[0]) if i != drop_idx]
+
+        return cls(
+            categories=categories,
+            mean=scaler.mean_,
+            scale=scaler.scale_,
+            vocabulary={term: int(index) for term, index in vectorizer.vocabulary_.items()},
+            idf=vectorizer.idf_,
+            token_pattern=vectorizer.token_pattern,
+            lowercase=vectorizer.lowercase,
+            dropped_category=str(encoder.categories_[0][drop_idx]) if drop_idx is not None else None
+        )
+
+    def _type_terms(self, vocabulary: np.ndarray):
+        """Sparse distinct-types x terms matrix of TF-IDF term counts per type."""
+        import numpy as np
+        from scipy import sparse
+
+        rows, cols = [], []
+        for row, activity_type in enumerate(vocabulary):
+            text = activity_type.lower() if self.lowercase else activity_type
+            for token in self._token_re.findall(text):
+                column = self.vocabulary.get(token)
+                if column is not None:
+                    rows.append(row)
+                    cols.append(column)
+
+        return sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, cols)), shape=(len(vocabulary), len(self.idf))
+        )
+
+    def _one_hot_columns(self, columns: FeatureColumns) -> np.ndarray:
+        """One-hot output column of each activity's primary type (-1 when all zeros)."""
+        import numpy as np
+
+        # Looked up once per distinct type
+        type_columns = np.fromiter(
+            (self._category_index.get(t, -1) for t in columns.vocabulary), dtype=np.int64, count=len(columns.vocabulary)
+        )
+        primary_ids = columns.primary_type_ids()
+        one_hot = np.full(len(columns), self._category_index.get('unknown', -1), dtype=np.int64)
+        one_hot[columns.has_types] = type_columns[primary_ids[columns.has_types]]
+        return one_hot
+
+    def _scaled_numeric(self, columns: FeatureColumns, out: np.ndarray) -> np.ndarray:
+        """Standardized numeric features, written into `out` (activities x NUMERICAL_FEATURES)."""
+        for j, name in enumerate(NUMERICAL_FEATURES):
+            out[:, j] = columns.numeric[name]
+        out -= self.mean
+        out /= self.scale
+        return out
+
+    def _tfidf(self, columns: FeatureColumns):
+        """Sparse l2-normalized TF-IDF rows, or None when no activity has types."""
+        import numpy as np
+        from scipy import sparse
+
+        if not len(columns.vocabulary):
+            return None
+
+        # Tokens never span two types, so term counts are sums of per-type counts
+        counts = sparse.csr_matrix(columns.type_incidence() @ self._type_terms(columns.vocabulary))
+        counts.data *= self.idf[counts.indices]
+        squares = counts.multiply(counts).sum(axis=1).A1
+        norms = np.sqrt(squares, out=np.ones_like(squares), where=squares > 0)
+        counts.data /= np.repeat(norms, np.diff(counts.indptr))
+        return counts
+
+    def transform(self, columns: FeatureColumns, sparse_output: bool = False) -> Any:
+        """
+        Embedding matrix for the activities in `columns`: a dense array, or
+        a CSR matrix with `sparse_output`.
+        """
+        import numpy as np
+
+        one_hot = self._one_hot_columns(columns)
+        rows = np.flatnonzero(one_hot >= 0)
+        tfidf = self._tfidf(columns)
+
+        if sparse_output:
+            from scipy import sparse
+
+            numeric = self._scaled_numeric(columns, np.empty((len(columns), len(self.mean))))
+            blocks = [
+                sparse.csr_matrix((np.ones(len(rows)), (rows, one_hot[rows])), shape=(len(columns), self._numeric_start)),
+                sparse.csr_matrix(numeric),
+                tfidf if tfidf is not None else sparse.csr_matrix((len(columns), len(self.idf)))
+            ]
+            return sparse.hstack(blocks, format='csr')
+
+        embeddings = np.zeros((len(columns), self.n_features))
+        embeddings[rows, one_hot[rows]] = 1.0
+        self._scaled_numeric(columns, embeddings[:, self._numeric_start:self._text_start])
+        if tfidf is not None:
+            embeddings[:, self._text_start:] = tfidf.toarray()
+        return embeddings
+
+
+def hash_bucket(token: str, n_buckets: int) -> int:
+    """Bucket of a category or term (stable across processes, unlike hash())."""
+    return zlib.crc32(token.encode('utf-8')) % n_buckets
+
+
+class HashedFeatureTransform(CompiledFeatureTransform):
+    """
+    CompiledFeatureTransform over hashed columns: the primary type is
+    one-hot encoded into n_type_buckets columns and type-list terms are
+    counted in len(idf) buckets, so any type or term has a column without
+    a fitted vocabulary. Colliding types or terms share a column.
+
+    Unlike the fitted encoder no category is dropped, and unknown types
+    (activities without types are "unknown") get a column like any other.
+    """
+
+    def __init__(self, mean: Any, scale: Any, idf: Any, n_type_buckets: int,
+                 token_pattern: str = DEFAULT_TOKEN_PATTERN, lowercase: bool = True):
+        super().__init__(categories=[], mean=mean, scale=scale, vocabulary={}, idf=idf,
+                         token_pattern=token_pattern, lowercase=lowercase)
+        self.n_type_buckets = n_type_buckets
+        self._numeric_start = n_type_buckets
+        self._text_start = self._numeric_start + len(self.mean)
+        self.n_features = self._text_start + len(self.idf)
+
+    @property
+    def n_text_buckets(self) -> int:
+        return len(self.idf)
+
+    def _type_terms(self, vocabulary: np.ndarray):
+        """Sparse distinct-types x term-buckets matrix of term counts per type."""
+        import numpy as np
+        from scipy import sparse
+
+        rows, cols = [], []
+        for row, activity_type in enumerate(vocabulary):
+            text = activity_type.lower() if self.lowercase else activity_type
+            for token in self._token_re.findall(text):
+                rows.append(row)
+                cols.append(hash_bucket(token, self.n_text_buckets))
+
+        # Colliding terms of a type add up
+        return sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, cols)), shape=(len(vocabulary), self.n_text_buckets)
+        )
+
+    def _one_hot_columns(self, columns: FeatureColumns) -> np.ndarray:
+        """Bucket of each activity's primary type."""
+        import numpy as np
+
+        type_columns = np.fromiter(
+            (hash_bucket(t, self.n_type_buckets) for t in columns.vocabulary), dtype=np.int64, count=len(columns.vocabulary)
+        )
+        one_hot = np.full(len(columns), hash_bucket('unknown', self.n_type_buckets), dtype=np.int64)
+        one_hot[columns.has_types] = type_columns[columns.primary_type_ids()[columns.has_types]]
+        return one_hot
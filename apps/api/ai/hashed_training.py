@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Out-of-core training with hashed features.
+
+The regular trainer fits the sklearn pipeline on a DataFrame of every
+activity, and TF-IDF fits its vocabulary over all of them. For catalogs of
+millions of activities, HashedStreamingTrainer trains from a stream instead.
+It makes one pass over the activities and one over its own output:
+
+1. Each chunk of activities is embedded with a not yet fitted
+   HashedFeatureTransform: raw numeric values and l2-normalized term
+   counts. The rows are appended to a scratch file. Meanwhile the scaler's
+   mean and variance and the document frequency of every term bucket are
+   accumulated.
+2. The fitted transform is built from those statistics. The scratch rows
+   are then standardized, IDF-weighted and renormalized block by block into
+   embeddings.npy, through a memory map of just that block.
+
+Memory use depends on the chunk and block sizes, not on the catalog size.
+Place ids are streamed to ids.json the same way. Both files are handed to
+the model directory writer, which moves them into the new model version;
+no training feature table is kept.
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from embedding_quantization import BLOCK_ROWS
+from engine_timing import stage
+from feature_transform import NUMERICAL_FEATURES, FeatureColumns, HashedFeatureTransform
+
+DEFAULT_TYPE_BUCKETS = 64
+DEFAULT_TEXT_BUCKETS = 64
+
+# Hashed models are written as a dense float matrix
+HASHED_PRECISIONS = ('float64', 'float32')
+
+
+class HashedStreamingTrainer:
+    """
+    Fits a HashedFeatureTransform and writes the embeddings of a stream of
+    activities into `staging_dir`, chunk by chunk (see the module docstring).
+    """
+
+    def __init__(self, staging_dir: Path, n_type_buckets: int = DEFAULT_TYPE_BUCKETS,
+                 n_text_buckets: int = DEFAULT_TEXT_BUCKETS, dtype: str = 'float64'):
+        import numpy as np
+
+        if dtype not in HASHED_PRECISIONS:
+            raise ValueError(f"Hashed features are stored as {' or '.join(HASHED_PRECISIONS)}")
+        if n_type_buckets < 1 or n_text_buckets < 1:
+            raise ValueError("Hashed features need at least one type and one text bucket")
+
+        self.staging_dir = Path(staging_dir)
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        n_numeric = len(NUMERICAL_FEATURES)
+        # Unfitted: numeric values pass through and term counts are only l2-normalized
+        self._raw_transform = HashedFeatureTransform(np.zeros(n_numeric), np.ones(n_numeric),
+                                                     np.ones(n_text_buckets), n_type_buckets)
+        self._mean = np.zeros(n_numeric)
+        # Sum of squared deviations from the mean
+        self._m2 = np.zeros(n_numeric)
+        self._document_frequency = np.zeros(n_text_buckets, dtype=np.int64)
+
+        self._raw_path = self.staging_dir / "embeddings.raw"
+        self._ids_path = self.staging_dir / "ids.json"
+        self._raw_file = open(self._raw_path, 'wb')
+        self._ids_file = open(self._ids_path, 'w')
+        self._ids_file.write('[')
+
+    def add(self, columns: FeatureColumns, activity_ids: List[Any]) -> None:
+        """Embed a chunk of activities and fold it into the statistics."""
+        import numpy as np
+
+        transform = self._raw_transform
+        with stage('transform'):
+            block = transform.transform(columns)
+            numeric = block[:, transform._numeric_start:transform._text_start]
+
+            # Chan et al.'s pairwise update of the running mean and squared deviations
+            count = len(block)
+            total = self.rows + count
+            chunk_mean = numeric.mean(axis=0)
+            delta = chunk_mean - self._mean
+            self._m2 += ((numeric - chunk_mean) ** 2).sum(axis=0) + delta ** 2 * self.rows * count / total
+            self._mean += delta * count / total
+            self._document_frequency += np.count_nonzero(block[:, transform._text_start:], axis=0)
+
+        with stage('save'):
+            # Scratch rows at the output precision: float32 models write half as much
+            self._raw_file.write(block.astype(self.dtype, copy=False).tobytes())
+            separator = ',' if self.rows else ''
+            self._ids_file.write(separator + ','.join(json.dumps(row_id) for row_id in activity_ids))
+        self.rows = total
+
+    def finish(self) -> Tuple[HashedFeatureTransform, Dict[str, Path]]:
+        """
+        The fitted transform and the staged model files (embeddings.npy,
+        ids.json) for write_model_directory.
+        """
+        import numpy as np
+
+        self.close()
+        if not self.rows:
+            raise ValueError("No activities provided for training")
+
+        # As StandardScaler (population variance, constant features unscaled)
+        # and TfidfVectorizer (smoothed IDF)
+        scale = np.sqrt(self._m2 / self.rows)
+        scale[scale == 0.0] = 1.0
+        idf = np.log((1 + self.rows) / (1 + self._document_frequency)) + 1.0
+        transform = HashedFeatureTransform(self._mean, scale, idf, self._raw_transform.n_type_buckets)
+
+        width = transform.n_features
+        numeric = slice(transform._numeric_start, transform._text_start)
+        text = slice(transform._text_start, width)
+        embeddings_path = self.staging_dir / "embeddings.npy"
+        output = np.lib.format.open_memmap(embeddings_path, mode='w+', dtype=self.dtype, shape=(self.rows, width))
+        data_offset = output.offset
+        del output
+
+        with stage('fit'):
+            for start in range(0, self.rows, BLOCK_ROWS):
+                rows = min(BLOCK_ROWS, self.rows - start)
+                # Only this block of either file is mapped, so resident memory stays at one block
+                block = np.array(np.memmap(self._raw_path, dtype=self.dtype, mode='r',
+                                           offset=start * width * self.dtype.itemsize, shape=(rows, width)),
+                                 dtype=np.float64)
+                block[:, numeric] -= transform.mean
+                block[:, numeric] /= transform.scale
+                terms = block[:, text]
+                terms *= idf
+                norms = np.sqrt(np.einsum('ij,ij->i', terms, terms))
+                norms[norms == 0.0] = 1.0
+                terms /= norms[:, None]
+
+                output = np.memmap(embeddings_path, dtype=self.dtype, mode='r+',
+                                   offset=data_offset + start * width * self.dtype.itemsize, shape=(rows, width))
+                output[:] = block
+                del output
+
+        os.remove(self._raw_path)
+        return transform, {'embeddings.npy': embeddings_path, 'ids.json': self._ids_path}
+
+    def close(self) -> None:
+        """Close the scratch files (finish does this; call it when training is abandoned)."""
+        if not self._ids_file.closed:
+            self._ids_file.write(']')
+            self._ids_file.close()
+        self._raw_file.close()
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Per-destination model shards.
+
+A single model for every place ever seen makes each worker load and hold
+every destination. With shards, each destination has its own model under
+<model_dir>/destinations/<key>/ (an ordinary engine model directory with
+its own embeddings, catalog and metadata), and requests pick one with
+"destination". A shard is loaded on the first request that names it.
+Loaded shards are kept in least-recently-used order, and the oldest are
+dropped once the loaded shards together exceed the memory budget. A
+worker serving Tokyo never loads Orlando; one serving both keeps whichever
+fits.
+
+Requests without "destination" use the model at the top of model_dir, as
+an unsharded engine does. A destination nobody trained is an error rather
+than a new shard: only train requests create shard directories.
+
+train_destination_shards retrains many shards at once, one destination
+per task in a process pool. Each shard is written by the model directory's
+atomic version swap, so a worker serving a shard keeps answering from the
+previous version until the new one is complete. A resident server does the
+same for single train and update requests (background_rebuilds): each is
+built in its own process while the shard keeps serving, and the shard is
+loaded again once the new version is saved.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+SHARDS_DIR = "destinations"
+DEFAULT_MEMORY_BUDGET_MB = 1024
+
+
+def shard_key(destination: Any) -> str:
+    """Directory name of a destination's shard ("Tokyo, Japan" -> "tokyo-japan")."""
+    key = re.sub(r'[^a-z0-9]+', '-', str(destination).lower()).strip('-')
+    if not key:
+        raise ValueError(f"Invalid destination: {destination!r}")
+    return key
+
+
+def shard_path(model_dir: str, destination: Optional[Any]) -> Path:
+    """Model directory of a destination (model_dir itself for no destination)."""
+    if destination is None:
+        return Path(model_dir)
+    return Path(model_dir) / SHARDS_DIR / shard_key(destination)
+
+
+def _saved_stamp(path: Path) -> Optional[Tuple[int, int]]:
+    """Identity of the model saved in `path` (None when nothing was saved there)."""
+    try:
+        # Every save replaces the metadata file, so it gets a new inode and mtime
+        stat = os.stat(path / "model_metadata.json")
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+class DestinationShards:
+    """
+    Engines for the destinations requested so far, loaded lazily and kept
+    in LRU order within a memory budget.
+
+    engine_options are passed to load_engine for every shard (embedding
+    cache size and training options). Thread-safe: a shard being loaded
+    only makes requests for that same shard wait.
+
+    With background_rebuilds (resident servers), train and update requests
+    are built in a separate process per shard (see start_rebuild) instead
+    of blocking the server for the length of the fit.
+    """
+
+    def __init__(self, model_dir: str = "models", memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB,
+                 background_rebuilds: bool = False, **engine_options):
+        self.model_dir = Path(model_dir)
+        self.memory_budget = int(memory_budget_mb * 2 ** 20)
+        self.background_rebuilds = background_rebuilds
+        self.engine_options = engine_options
+        self.loads = 0
+        self.evictions = 0
+        # shard key (None for the top-level model) -> engine, least recently used first
+        self._engines: 'OrderedDict[Optional[str], Any]' = OrderedDict()
+        # Saved model each loaded engine was opened from, and its size when last used
+        self._stamps: Dict[Optional[str], Optional[Tuple[int, int]]] = {}
+        self._sizes: Dict[Optional[str], int] = {}
+        self._total_bytes = 0
+        # Shards being loaded, set once the load finishes
+        self._loading: Dict[Optional[str], threading.Event] = {}
+        self._lock = threading.Lock()
+        # Background rebuilds running and finished, per shard key
+        self._rebuilds: Dict[Optional[str], Dict[str, Any]] = {}
+        self._last_rebuilds: Dict[Optional[str], Dict[str, Any]] = {}
+        self._rebuilds_done = threading.Condition(self._lock)
+
+    def engine_for(self, destination: Optional[Any] = None, create: bool = False) -> Any:
+        """
+        The engine of a destination's shard, loading it if needed.
+
+        Only destinations with a saved model have a shard; any other one
+        raises ValueError, except with `create` (train requests), which
+        returns an untrained engine that trains into the shard's directory.
+        A shard saved again since it was loaded (e.g. by
+        train_destination_shards) is loaded again.
+        """
+        key = shard_key(destination) if destination is not None else None
+        path = shard_path(self.model_dir, destination)
+        stamp = _saved_stamp(path)
+        if key is not None and stamp is None:
+            if not create:
+                raise ValueError(f"No model has been trained for destination {destination!r}")
+            from recommendation_engine import load_engine
+
+            path.mkdir(parents=True, exist_ok=True)
+            # Not kept: the next request loads the shard once it is saved
+            return load_engine(str(path), **self.engine_options)
+
+        while True:
+            with self._lock:
+                engine = self._engines.get(key)
+                if engine is not None and self._stamps[key] == stamp:
+                    self._engines.move_to_end(key)
+                    break
+                loading = self._loading.get(key)
+                if loading is None:
+                    self._loading[key] = loading = threading.Event()
+                    engine = None
+                    break
+            # Another request is loading this shard
+            loading.wait()
+
+        if engine is None:
+            engine = self._load(key, path, stamp, loading)
+        self._measure(key, engine)
+        return engine
+
+    def reload(self, destination: Optional[Any] = None) -> bool:
+        """
+        Drop a loaded shard so the next request loads its saved model again
+        (engine_for also does so by itself once the shard is saved again).
+        Returns whether the shard was loaded.
+        """
+        key = shard_key(destination) if destination is not None else None
+        with self._lock:
+            return self._drop(key) is not None
+
+    def _load(self, key: Optional[str], path: Path, stamp: Optional[Tuple[int, int]],
+              loading: threading.Event) -> Any:
+        """Load a shard outside the lock; other shards keep being served meanwhile."""
+        from recommendation_engine import load_engine
+
+        try:
+            engine = load_engine(str(path), **self.engine_options)
+            with self._lock:
+                # A replaced engine finishes its requests; it was not sharing embeddings
+                reloaded = self._drop(key) is not None
+                self._engines[key] = engine
+                self._stamps[key] = stamp
+                self.loads += 1
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+        logger.info(f"{'Reloaded' if reloaded else 'Loaded'} model shard {key or '(default)'}")
+        return engine
+
+    def _drop(self, key: Optional[str]) -> Any:
+        """Forget a loaded shard (lock held); returns its engine, if it was loaded."""
+        engine = self._engines.pop(key, None)
+        self._stamps.pop(key, None)
+        self._total_bytes -= self._sizes.pop(key, 0)
+        return engine
+
+    def _measure(self, key: Optional[str], engine: Any) -> None:
+        """
+        Update a shard's size in the running total and evict others if it no
+        longer fits. Shards load model parts lazily, so a shard is measured
+        again whenever it is used (only that shard).
+        """
+        size = engine.memory_bytes()
+        with self._lock:
+            if self._engines.get(key) is not engine:
+                return
+            self._total_bytes += size - self._sizes.get(key, 0)
+            self._sizes[key] = size
+            self._evict(keep=key)
+
+    def _evict(self, keep: Optional[str]) -> None:
+        """Drop least recently used shards until the loaded ones fit the budget (lock held)."""
+        for key in list(self._engines):
+            if self._total_bytes <= self.memory_budget:
+                break
+            if key == keep:
+                continue
+            size = self._sizes.get(key, 0)
+            self._drop(key).release_shared_embeddings()
+            self.evictions += 1
+            logger.info(f"Evicted model shard {key or '(default)'} ({size / 2 ** 20:.1f} MiB)")
+
+    def start_rebuild(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Start the train or update request of one shard in a background
+        process and return the response to it straight away.
+
+        The shard's loaded engine keeps serving; once the new version is
+        saved, engine_for loads it on the shard's next request. One rebuild
+        runs per shard at a time.
+        """
+        from model_swap import REBUILD_MODES, start_background_rebuild
+
+        mode = next(mode for mode in REBUILD_MODES if mode in request)
+        destination = request.get('destination')
+        key = shard_key(destination) if destination is not None else None
+        path = shard_path(self.model_dir, destination)
+        if key is not None and mode != 'train' and _saved_stamp(path) is None:
+            raise ValueError(f"No model has been trained for destination {destination!r}")
+
+        with self._lock:
+            if key in self._rebuilds:
+                return {
+                    'status': 'error',
+                    'code': 'rebuild_in_progress',
+                    'message': f'A model {self._rebuilds[key]["mode"]} of this shard is already running '
+                               f'in the background; retry when it finishes'
+                }
+            self._rebuilds[key] = {'shard': key or '', 'mode': mode, 'started_at': datetime.now().isoformat()}
+            status = dict(self._rebuilds[key])
+
+        path.mkdir(parents=True, exist_ok=True)
+        started = perf_counter()
+        # The rebuild process opens the shard's directory as an ordinary model
+        shard_request = {name: value for name, value in request.items() if name != 'destination'}
+        start_background_rebuild(str(path), self.engine_options, shard_request,
+                                 lambda result: self._finish_rebuild(key, result, started))
+        logger.info(f"Started background model {mode} of shard {key or '(default)'}")
+
+        return {
+            'status': 'accepted',
+            'message': f'Model {mode} started in the background; the current model serves until it finishes',
+            'rebuild': status
+        }
+
+    def _finish_rebuild(self, key: Optional[str], result: Dict[str, Any], started: float) -> None:
+        with self._lock:
+            self._last_rebuilds[key] = dict(
+                self._rebuilds.pop(key), finished_at=datetime.now().isoformat(),
+                seconds=round(perf_counter() - started, 3), result=result
+            )
+            self._rebuilds_done.notify_all()
+        logger.info(f"Background rebuild of shard {key or '(default)'} finished: {result.get('status')}")
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the running rebuilds to finish; False on timeout."""
+        with self._lock:
+            return self._rebuilds_done.wait_for(lambda: not self._rebuilds, timeout)
+
+    def destinations(self) -> List[str]:
+        """Keys of the destinations with a saved shard."""
+        shards_dir = self.model_dir / SHARDS_DIR
+        if not shards_dir.is_dir():
+            return []
+        # Every saved model writes its metadata file next to the model
+        return sorted(path.name for path in shards_dir.iterdir() if (path / "model_metadata.json").exists())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            loaded = [key or '' for key in self._engines]
+            memory_bytes = self._total_bytes
+            rebuilds = {
+                'running': [dict(status) for status in self._rebuilds.values()],
+                'last': {key or '': status for key, status in self._last_rebuilds.items()}
+            }
+        return {
+            'loaded': loaded,
+            'memory_bytes': memory_bytes,
+            'memory_budget_bytes': self.memory_budget,
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'rebuilds': rebuilds
+        }
+
+    def warm_up(self) -> None:
+        """Import the request-time libraries (through the default engine) ahead of the first request."""
+        self.engine_for(None).warm_up()
+
+    def release_shared_embeddings(self) -> None:
+        with self._lock:
+            for engine in self._engines.values():
+                engine.release_shared_embeddings()
+
+
+ACTIVITY_FILE_SUFFIXES = ('.json', '.ndjson')
+
+
+def _read_activities(path: Path) -> List[Dict[str, Any]]:
+    """Activities of a JSON array or NDJSON file."""
+    with open(path, 'r') as f:
+        if path.suffix == '.json':
+            return json.load(f)
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def destination_sources(source: Union[str, Path]) -> Dict[str, Union[Path, List[Dict[str, Any]]]]:
+    """
+    Activities to train, by destination.
+
+    `source` is either a directory with one JSON array or NDJSON file of
+    activities per destination (named after it, e.g. tokyo-japan.ndjson),
+    or an NDJSON file of activities that each carry a "destination". Files
+    of a directory are returned as paths for the training workers to read
+    themselves.
+    """
+    source = Path(source)
+    if source.is_dir():
+        return {path.stem: path for path in sorted(source.iterdir()) if path.suffix in ACTIVITY_FILE_SUFFIXES}
+
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    with open(source, 'r') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            activity = json.loads(line)
+            if activity.get('destination') is None:
+                raise ValueError(f"{source}:{number}: activity has no \"destination\"")
+            groups.setdefault(str(activity['destination']), []).append(activity)
+    return groups
+
+
+def _train_shard(model_dir: str, destination: str, activities: Union[Path, List[Dict[str, Any]]],
+                 training_options: Dict[str, Any]) -> Dict[str, Any]:
+    """Train and save one destination's shard (runs in a pool worker)."""
+    from engine_timing import StageTimer, activate, stage
+    from recommendation_engine import ActivityRecommendationEngine
+
+    started = perf_counter()
+    timer = StageTimer()
+    try:
+        with activate(timer):
+            if isinstance(activities, Path):
+                with stage('parse'):
+                    activities = _read_activities(activities)
+            path = shard_path(model_dir, destination)
+            path.mkdir(parents=True, exist_ok=True)
+            engine = ActivityRecommendationEngine(str(path), **training_options)
+            engine.train_content_based_model(activities, force_retrain=True)
+    except Exception as e:
+        logger.error(f"Training shard {destination} failed: {e}")
+        return {'destination': destination, 'status': 'error', 'error': str(e),
+                'seconds': round(perf_counter() - started, 3)}
+
+    return {
+        'destination': destination,
+        'key': shard_key(destination),
+        'status': 'success',
+        'activities': len(activities),
+        'seconds': round(perf_counter() - started, 3),
+        'timings': timer.as_dict()
+    }
+
+
+def train_destination_shards(model_dir: str, source: Union[str, Path], workers: Optional[int] = None,
+                             **training_options) -> Dict[str, Any]:
+    """
+    Train the shard of every destination in `source` (see
+    destination_sources) across `workers` processes (default: one per
+    CPU; 1 trains in this process).
+
+    Returns per-shard results with wall time and stage timings. A shard
+    that fails to train is reported and leaves its previous version in
+    place; the others are still trained.
+    """
+    started = perf_counter()
+    sources = destination_sources(source)
+    workers = min(workers or os.cpu_count() or 1, max(len(sources), 1))
+
+    # Largest destinations first, so the slowest shards do not start last
+    def size(item):
+        activities = item[1]
+        return activities.stat().st_size if isinstance(activities, Path) else len(activities)
+
+    tasks = sorted(sources.items(), key=size, reverse=True)
+    logger.info(f"Training {len(tasks)} destination shards with {workers} workers")
+
+    if workers == 1:
+        results = [_train_shard(model_dir, destination, activities, training_options)
+                   for destination, activities in tasks]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_train_shard, model_dir, destination, activities, training_options)
+                       for destination, activities in tasks]
+            results = [future.result() for future in futures]
+
+    results.sort(key=lambda result: result['destination'])
+    failed = [result['destination'] for result in results if result['status'] != 'success']
+    return {
+        'status': 'error' if failed else 'success',
+        'message': f"Failed to train {len(failed)} of {len(results)} shards" if failed else
+                   f"Trained {len(results)} shards",
+        'workers': workers,
+        'seconds': round(perf_counter() - started, 3),
+        'shards': results
+    }
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Immutable views of a trained model for concurrent scoring.
+
+A resident server handles many requests at once on one engine. Training,
+update_model and loading a model replace the engine's embeddings,
+transform, index and catalog one attribute at a time, so a request that
+read them one after the other could mix parts of two model versions.
+Scoring therefore reads a ModelSnapshot. The engine builds it once the
+new model is complete and publishes it with a single reference
+assignment; a request takes the current snapshot when it starts and uses
+only that snapshot.
+
+Parts a model directory provides only when first used are LazyPart
+holders, which load their value once however many threads ask for it
+at the same time.
+"""
+
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+from engine_timing import stage
+
+
+class LazyPart:
+    """A model part computed or read from disk on first use, exactly once."""
+
+    __slots__ = ('_loader', '_value', '_lock')
+
+    def __init__(self, loader: Optional[Callable[[], Any]] = None, value: Any = None):
+        self._loader = loader
+        self._value = value
+        self._lock = threading.Lock()
+
+    def get(self) -> Any:
+        if self._loader is not None:
+            with self._lock:
+                # Another thread may have loaded it while this one waited
+                if self._loader is not None:
+                    with stage('model_load'):
+                        self._value = self._loader()
+                    self._loader = None
+        return self._value
+
+    def peek(self, default: Any = None) -> Any:
+        """The value if it is already loaded, `default` otherwise (never loads)."""
+        return default if self._loader is not None else self._value
+
+
+@dataclass(frozen=True)
+class ModelSnapshot:
+    """
+    Everything scoring reads from one trained model version.
+
+    catalog_columns holds the catalog's interned types, prices and
+    embedding norms (see ActivityRecommendationEngine._catalog_scoring_columns),
+    computed the first time a catalog query needs them.
+    """
+
+    version: str
+    embeddings: Any
+    sparse: bool
+    precision: str
+    transform: Any
+    pipeline: LazyPart
+    ann_index: Any
+    catalog: LazyPart
+    catalog_columns: LazyPart
+
+    @property
+    def n_features(self) -> int:
+        return self.embeddings.shape[1]
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped model directory format.
+
+A trained model is saved as a directory of plain files instead of one
+joblib pickle:
+
+    manifest.json              metadata, shapes and which parts are present
+    transform.json / .npz      fitted parameters of the compiled transform
+    embeddings.npy             dense embeddings (or embeddings.{data,indices,indptr}.npy for CSR,
+                               embeddings.{codes,scales,norms}.npy for int8)
+    features.*.npy             the training feature table, column by column (when one was kept)
+    ids.json                   place id of each embedding row
+    ann.*.npy                  ANN index tables, when one was built
+    pipeline.joblib            the fitted sklearn pipeline
+    catalog.pickle             the activity catalog, when one was kept
+
+Arrays are opened with mmap, so loading reads only the manifest and the
+small transform parameters; embedding and feature pages come in on demand
+and are shared between processes through the page cache. The pipeline,
+feature table and catalog are only read when something uses them.
+
+Each save writes a new version directory next to the model path, which
+is a symlink atomically switched to the new version. Readers keep the
+version they opened: a ModelDirectory holds a shared lock on the
+version's .readers file while it exists (an engine keeps it until it
+has read every deferred part), and saves only remove older versions no
+reader holds. The version before the current one is always kept, so a
+reader that resolved the link just before a swap can still open it.
+"""
+
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+from pathlib import Path
+from typing import IO, Any, Dict, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks: only the current and previous versions are protected
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+READERS_NAME = ".readers"
+
+
+def _save_array(directory: Path, name: str, array: Any) -> None:
+    np.save(directory / f"{name}.npy", np.ascontiguousarray(array), allow_pickle=False)
+
+
+def _load_array(directory: Path, name: str) -> np.ndarray:
+    return np.load(directory / f"{name}.npy", mmap_mode='r', allow_pickle=False)
+
+
+def _hold_version(version_dir: Path) -> Optional[IO]:
+    """Mark a version as in use until the returned handle is closed."""
+    if fcntl is None:
+        return None
+    try:
+        handle = open(version_dir / READERS_NAME, 'r')
+    except OSError:
+        # Versions written before reader locks existed
+        return None
+    fcntl.flock(handle, fcntl.LOCK_SH)
+    return handle
+
+
+def _version_in_use(version_dir: Path) -> bool:
+    """Whether any process (this one included) has the version open."""
+    if fcntl is None:
+        return False
+    try:
+        handle = open(version_dir / READERS_NAME, 'r')
+    except OSError:
+        return False
+    with handle:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        return False
+
+
+def write_model_directory(model_path: Path, metadata: Dict[str, Any], embeddings: Any,
+                          activity_features: Any, compiled_transform: Any = None, pipeline: Any = None,
+                          ann_index: Any = None, catalog: Any = None, activity_ids: Any = None,
+                          staged_files: Optional[Dict[str, Path]] = None) -> Path:
+    """
+    Write a model version and point `model_path` at it.
+
+    staged_files maps file names of the version (embeddings.npy, ids.json)
+    to files already written elsewhere on the same filesystem, e.g. by the
+    out-of-core trainer; they are moved into the version instead of being
+    written from the corresponding argument, which then only describes them.
+
+    Returns the version directory. Older versions other than the one being
+    replaced are removed once no reader holds them.
+    """
+    staged_files = staged_files or {}
+    model_path = Path(model_path)
+    version_dir = Path(tempfile.mkdtemp(prefix=f"{model_path.name}.", dir=model_path.parent))
+    from embedding_quantization import QuantizedEmbeddings
+
+    quantized = isinstance(embeddings, QuantizedEmbeddings)
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'metadata': metadata,
+        'embeddings': {
+            'shape': list(embeddings.shape),
+            'sparse': hasattr(embeddings, 'indptr'),
+            'precision': 'int8' if quantized else np.dtype(embeddings.dtype).name
+        },
+        'feature_columns': list(activity_features.columns) if activity_features is not None else None,
+        'transform': compiled_transform is not None,
+        'ann_index': ann_index.n_bits if ann_index is not None else None,
+        'catalog': catalog is not None,
+        'activity_ids': activity_ids is not None or 'ids.json' in staged_files
+    }
+
+    try:
+        for name, staged in staged_files.items():
+            os.replace(staged, version_dir / name)
+
+        if manifest['embeddings']['sparse']:
+            for part in ('data', 'indices', 'indptr'):
+                _save_array(version_dir, f"embeddings.{part}", getattr(embeddings, part))
+        elif quantized:
+            for part in ('codes', 'scales', 'norms'):
+                _save_array(version_dir, f"embeddings.{part}", getattr(embeddings, part))
+        elif 'embeddings.npy' not in staged_files:
+            _save_array(version_dir, 'embeddings', embeddings)
+
+        # Numeric feature columns as-is, text columns as fixed-width unicode
+        for column in (activity_features.columns if activity_features is not None else ()):
+            values = activity_features[column].to_numpy()
+            if values.dtype == object or not np.issubdtype(values.dtype, np.number):
+                values = values.astype(str)
+            _save_array(version_dir, f"features.{column}", values)
+
+        if compiled_transform is not None:
+            from feature_transform import HashedFeatureTransform
+
+            if isinstance(compiled_transform, HashedFeatureTransform):
+                params = {'hashed': True, 'n_type_buckets': compiled_transform.n_type_buckets}
+            else:
+                params = {
+                    'categories': [str(category) for category in compiled_transform.categories],
+                    'vocabulary': compiled_transform.vocabulary,
+                    'dropped_category': compiled_transform.dropped_category
+                }
+            with open(version_dir / "transform.json", 'w') as f:
+                json.dump(dict(params, token_pattern=compiled_transform.token_pattern,
+                               lowercase=compiled_transform.lowercase), f)
+            np.savez(version_dir / "transform.npz", mean=compiled_transform.mean,
+                     scale=compiled_transform.scale, idf=compiled_transform.idf)
+
+        if activity_ids is not None and 'ids.json' not in staged_files:
+            with open(version_dir / "ids.json", 'w') as f:
+                json.dump(list(activity_ids), f)
+
+        if ann_index is not None:
+            for part in ('planes', 'sorted_codes', 'order'):
+                _save_array(version_dir, f"ann.{part}", getattr(ann_index, part))
+
+        if pipeline is not None:
+            import joblib
+
+            joblib.dump(pipeline, version_dir / "pipeline.joblib")
+        if catalog is not None:
+            # Plain activity dicts: the C pickler is many times faster than
+            # joblib's pure-Python one
+            with open(version_dir / "catalog.pickle", 'wb') as f:
+                pickle.dump(catalog, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        (version_dir / READERS_NAME).touch()
+        # The manifest goes last: a version without one is incomplete
+        with open(version_dir / MANIFEST_NAME, 'w') as f:
+            json.dump(manifest, f, indent=2)
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+
+    os.chmod(version_dir, 0o755)
+    previous = model_path.resolve() if model_path.is_symlink() else None
+    link_tmp = model_path.with_name(f".{model_path.name}.{os.getpid()}.link")
+    if link_tmp.is_symlink():
+        link_tmp.unlink()
+    os.symlink(version_dir.name, link_tmp)
+    os.replace(link_tmp, model_path)
+
+    # Keep the current and the previous version, and older ones still open
+    keep = {version_dir.name, previous.name if previous is not None else None}
+    for stale in model_path.parent.glob(f"{model_path.name}.*"):
+        if (stale.is_dir() and stale.name not in keep and (stale / MANIFEST_NAME).exists()
+                and not _version_in_use(stale)):
+            shutil.rmtree(stale, ignore_errors=True)
+
+    logger.info(f"Wrote model version {version_dir.name}")
+    return version_dir
+
+
+class ModelDirectory:
+    """
+    A saved model version opened for reading. Arrays are memory-mapped.
+
+    The version is not removed by later saves while this object exists.
+    """
+
+    def __init__(self, model_path: Path):
+        # Resolve once so a concurrent save cannot switch versions under us
+        self.path = Path(model_path).resolve()
+        self._reader_lock = _hold_version(self.path)
+        with open(self.path / MANIFEST_NAME, 'r') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported model format version: {self.manifest.get('format_version')}")
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        return self.manifest['metadata']
+
+    def embeddings(self) -> Any:
+        """
+        The embedding matrix, memory-mapped (a CSR matrix over mapped arrays
+        when sparse, QuantizedEmbeddings over mapped arrays for int8).
+        """
+        shape = tuple(self.manifest['embeddings']['shape'])
+        if self.manifest['embeddings'].get('precision') == 'int8':
+            from embedding_quantization import QuantizedEmbeddings
+
+            return QuantizedEmbeddings(*(_load_array(self.path, f"embeddings.{part}")
+                                         for part in ('codes', 'scales', 'norms')))
+        if not self.manifest['embeddings']['sparse']:
+            return _load_array(self.path, 'embeddings')
+
+        from scipy import sparse
+
+        return sparse.csr_matrix(
+            tuple(_load_array(self.path, f"embeddings.{part}") for part in ('data', 'indices', 'indptr')),
+            shape=shape, copy=False
+        )
+
+    def compiled_transform(self) -> Optional[Any]:
+        if not self.manifest['transform']:
+            return None
+
+        from feature_transform import CompiledFeatureTransform, HashedFeatureTransform
+
+        with open(self.path / "transform.json", 'r') as f:
+            params = json.load(f)
+        transform_class = HashedFeatureTransform if params.pop('hashed', False) else CompiledFeatureTransform
+        with np.load(self.path / "transform.npz", allow_pickle=False) as arrays:
+            return transform_class(mean=arrays['mean'], scale=arrays['scale'], idf=arrays['idf'], **params)
+
+    def activity_features(self) -> Optional[Any]:
+        """The training feature table (built from the mapped columns on first use)."""
+        if self.manifest['feature_columns'] is None:
+            return None
+
+        import pandas as pd
+
+        return pd.DataFrame({
+            column: _load_array(self.path, f"features.{column}")
+            for column in self.manifest['feature_columns']
+        }, columns=self.manifest['feature_columns'])
+
+    def activity_ids(self) -> Optional[Any]:
+        if not self.manifest.get('activity_ids'):
+            return None
+
+        with open(self.path / "ids.json", 'r') as f:
+            return json.load(f)
+
+    def ann_index(self) -> Optional[Any]:
+        if self.manifest['ann_index'] is None:
+            return None
+
+        from ann_index import RandomProjectionIndex
+
+        return RandomProjectionIndex(
+            _load_array(self.path, 'ann.planes'), self.manifest['ann_index'],
+            sorted_codes=_load_array(self.path, 'ann.sorted_codes'), order=_load_array(self.path, 'ann.order')
+        )
+
+    def pipeline(self) -> Optional[Any]:
+        path = self.path / "pipeline.joblib"
+        if not path.exists():
+            return None
+
+        import joblib
+
+        return joblib.load(path)
+
+    def catalog(self) -> Optional[Any]:
+        if not self.manifest['catalog']:
+            return None
+
+        with open(self.path / "catalog.pickle", 'rb') as f:
+            return pickle.load(f)
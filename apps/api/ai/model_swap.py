@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Zero-downtime model replacement for the resident engine.
+
+Training the engine a server answers from blocks the server for the length
+of the fit and changes the model under the requests being scored. A
+HotSwapEngine instead serves every request from the current engine and
+builds model changes ("train" and "update" requests) in a separate
+process. That process loads the saved model, applies the request and saves
+the result as a new model version (model_store's atomic version swap).
+The server then opens that version as a new engine and makes it current
+with a single reference assignment.
+
+Requests that started on the previous engine finish on it. It is retired,
+and its shared embedding segment released, once the last of them is done.
+The model directory keeps the previous version, so the lazily loaded parts
+of a retired engine stay readable.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Requests that change the model and are therefore built in the background
+REBUILD_MODES = ('train', 'update')
+
+
+def _rebuild(model_dir: str, training_options: Dict[str, Any], request: Dict[str, Any]) -> Dict[str, Any]:
+    """Apply a train or update request to the saved model (runs in the rebuild process)."""
+    from recommendation_engine import _configure_logging, handle_request, load_engine
+
+    _configure_logging()
+    return handle_request(request, load_engine(model_dir, **training_options))
+
+
+def start_background_rebuild(model_dir: str, training_options: Dict[str, Any], request: Dict[str, Any],
+                             on_done: Callable[[Dict[str, Any]], None]) -> None:
+    """
+    Apply a train or update request to the model saved in model_dir in a
+    separate process. on_done receives the request's response (an error
+    response if the process failed) once the new version is saved.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # A fresh interpreter: forking would copy the server's threads' locks
+    executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    future = executor.submit(_rebuild, model_dir, training_options, request)
+
+    def finish(done: Any) -> None:
+        executor.shutdown(wait=False)
+        try:
+            result = done.result()
+        except Exception as e:
+            logger.error(f"Background model rebuild failed: {e}")
+            result = {'status': 'error', 'message': str(e)}
+        on_done(result)
+
+    future.add_done_callback(finish)
+
+
+class HotSwapEngine:
+    """
+    The current engine of a resident server, replaced atomically when a
+    background rebuild finishes.
+
+    engine_factory opens the saved model as a new engine (it is also used
+    for the first one); training_options are passed to load_engine in the
+    rebuild process. One rebuild runs at a time.
+    """
+
+    def __init__(self, engine_factory: Callable[[], Any], model_dir: str,
+                 training_options: Optional[Dict[str, Any]] = None):
+        self._engine_factory = engine_factory
+        self.model_dir = model_dir
+        self.training_options = training_options or {}
+        self._engine = engine_factory()
+        self.swaps = 0
+
+        # Requests in flight per engine (by id), and replaced engines some still use
+        self._in_flight: Dict[int, int] = {}
+        self._retired: List[Any] = []
+        self._lock = threading.Lock()
+
+        self._rebuild: Optional[Dict[str, Any]] = None
+        self._last_rebuild: Optional[Dict[str, Any]] = None
+        self._idle = threading.Event()
+        self._idle.set()
+
+    @property
+    def engine(self) -> Any:
+        """The engine new requests are served from."""
+        return self._engine
+
+    @contextmanager
+    def acquire(self) -> Iterator[Any]:
+        """The current engine, kept from retirement until the block exits."""
+        with self._lock:
+            engine = self._engine
+            self._in_flight[id(engine)] = self._in_flight.get(id(engine), 0) + 1
+        try:
+            yield engine
+        finally:
+            with self._lock:
+                self._in_flight[id(engine)] -= 1
+                if not self._in_flight[id(engine)]:
+                    del self._in_flight[id(engine)]
+                drained = self._drained()
+            for retired in drained:
+                retired.release_shared_embeddings()
+
+    def _drained(self) -> List[Any]:
+        """Remove and return the retired engines no request uses any more (lock held)."""
+        drained = [engine for engine in self._retired if id(engine) not in self._in_flight]
+        self._retired = [engine for engine in self._retired if id(engine) in self._in_flight]
+        return drained
+
+    def swap(self, engine: Any) -> None:
+        """Make `engine` current; the previous one is retired once its requests finish."""
+        with self._lock:
+            previous, self._engine = self._engine, engine
+            self.swaps += 1
+            self._retired.append(previous)
+            drained = self._drained()
+        for retired in drained:
+            retired.release_shared_embeddings()
+        logger.info(f"Swapped in model version {engine.model_version_tag()}")
+
+    def start_rebuild(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Start building the model change a train or update request asks for
+        and return the response to it straight away.
+        """
+        mode = next(mode for mode in REBUILD_MODES if mode in request)
+        with self._lock:
+            if self._rebuild is not None:
+                return {
+                    'status': 'error',
+                    'code': 'rebuild_in_progress',
+                    'message': f'A model {self._rebuild["mode"]} is already running in the background; retry when it finishes'
+                }
+            self._rebuild = {'mode': mode, 'started_at': datetime.now().isoformat()}
+            self._idle.clear()
+            status = dict(self._rebuild)
+
+        started = perf_counter()
+        start_background_rebuild(self.model_dir, self.training_options, request,
+                                 lambda result: self._finish_rebuild(result, started))
+        logger.info(f"Started background model {mode}")
+
+        return {
+            'status': 'accepted',
+            'message': f'Model {mode} started in the background; the current model serves until it finishes',
+            'rebuild': status
+        }
+
+    def _finish_rebuild(self, result: Dict[str, Any], started: float) -> None:
+        try:
+            if result.get('status') == 'success':
+                engine = self._engine_factory()
+                # load_engine logs a model it cannot read and returns an untrained engine
+                if engine.is_trained and engine._snapshot is not None:
+                    self.swap(engine)
+                else:
+                    logger.error("The rebuilt model could not be loaded; keeping the current model")
+                    result = {
+                        'status': 'error',
+                        'code': 'swap_failed',
+                        'message': 'The rebuilt model was saved but could not be loaded; the current model keeps serving'
+                    }
+        except Exception as e:
+            logger.error(f"Background model rebuild failed: {e}")
+            result = {'status': 'error', 'message': str(e)}
+
+        with self._lock:
+            self._last_rebuild = dict(
+                self._rebuild, finished_at=datetime.now().isoformat(),
+                seconds=round(perf_counter() - started, 3), result=result
+            )
+            self._rebuild = None
+        self._idle.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for a running rebuild to finish and be swapped in; False on timeout."""
+        return self._idle.wait(timeout)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'running': dict(self._rebuild) if self._rebuild is not None else None,
+                'last': self._last_rebuild,
+                'swaps': self.swaps,
+                'retired_in_use': len(self._retired)
+            }
+
+    def warm_up(self) -> None:
+        self._engine.warm_up()
+
+    def release_shared_embeddings(self) -> None:
+        with self._lock:
+            engines = [self._engine] + self._retired
+        for engine in engines:
+            engine.release_shared_embeddings()
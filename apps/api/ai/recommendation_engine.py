@@ -6,35 +6,116 @@ This module implements a machine learning-based personalization system that rank
 activities based on user preferences using TF-IDF, one-hot encoding, and cosine similarity.
 """
 
+from __future__ import annotations
+
 import json
-import numpy as np
-import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.preprocessing import StandardScaler, OneHotEncoder
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.compose import ColumnTransformer
-from sklearn.pipeline import Pipeline
-import joblib
 import os
 import sys
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Tuple, Optional
+from typing import Dict, List, Any, Iterable, Tuple, Optional, TYPE_CHECKING
 from pathlib import Path
+from itertools import islice
 import hashlib
-from prisma import PrismaClient
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('logs/ml_engine.log') if os.path.exists('logs') else logging.NullHandler()
-    ]
+
+from ann_index import DEFAULT_BITS, DEFAULT_PROBES, DEFAULT_TABLES, RandomProjectionIndex
+from engine_io import ColumnarActivities, encode_json, resolve_activity_payloads
+from engine_timing import StageTimer, activate, current_timer, encode_with_timings, stage
+from embedding_cache import DEFAULT_CACHE_SIZE, EmbeddingCache, embedding_keys, sparse_rows, stack_sparse_rows
+from embedding_quantization import (
+    EMBEDDING_PRECISIONS, QuantizedEmbeddings, check_precision, gather_rows, row_norms, scoring_dtype, to_precision
 )
+from feature_transform import (
+    FEATURE_COLUMNS, CompiledFeatureTransform, FeatureColumns, HashedFeatureTransform, intern_types, select_interned
+)
+from hashed_training import DEFAULT_TEXT_BUCKETS, DEFAULT_TYPE_BUCKETS
+from model_snapshot import LazyPart, ModelSnapshot
+from model_swap import REBUILD_MODES, HotSwapEngine
+from model_shards import DEFAULT_MEMORY_BUDGET_MB, DestinationShards, shard_path, train_destination_shards
+
+# numpy, pandas, scikit-learn, joblib and prisma are imported inside the code
+# paths that use them. Importing them up front costs seconds per CLI spawn,
+# while explain/summary/health_score/proactive_tips modes are pure Python.
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
 logger = logging.getLogger(__name__)
 
+# CLI modes that need a (possibly trained) ActivityRecommendationEngine
+MODEL_MODES = ('train', 'update', 'recommend', 'multi_recommend', 'info')
+
+# update_model refits the pipeline once more than this share of the model's
+# activities has a primary type the fitted encoder has never seen
+DEFAULT_DRIFT_THRESHOLD = 0.05
+
+def _configure_logging() -> None:
+    """Configure engine logging for CLI runs (kept out of import time)."""
+    handlers = [logging.StreamHandler()]
+    if os.path.exists('logs'):
+        handlers.append(logging.FileHandler('logs/ml_engine.log'))
+    
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=handlers
+    )
+
+def top_n_indices(scores: np.ndarray, top_n: int) -> np.ndarray:
+    """
+    Indices of the top_n highest scores, best first.
+    
+    Matches a stable descending sort truncated to top_n (ties keep input
+    order) while only partially ordering the candidates.
+    """
+    import numpy as np
+    
+    count = len(range(len(scores))[:top_n])
+    if count == 0:
+        return np.empty(0, dtype=np.int64)
+    if count < len(scores):
+        kth = np.partition(scores, len(scores) - count)[len(scores) - count]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[:count - len(above)]
+        candidates = np.concatenate([above, ties])
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+def _l2_normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Rows scaled to unit length; all-zero rows stay zero (as in sklearn's normalize)."""
+    import numpy as np
+    
+    norms = np.sqrt(np.einsum('ij,ij->i', matrix, matrix))
+    norms[norms == 0.0] = 1.0
+    return matrix / norms[:, None]
+
+def cosine_similarity(X: Any, Y: Any) -> np.ndarray:
+    """
+    Cosine similarity between the rows of X (dense) and of Y (dense or CSR).
+    
+    Computed as sklearn.metrics.pairwise.cosine_similarity does (both sides
+    l2-normalized, zero rows left at zero, one matrix product) without
+    importing scikit-learn on the request path. A float32 Y is scored in
+    float32.
+    """
+    import numpy as np
+    
+    dtype = scoring_dtype(Y)
+    
+    def normalized(matrix):
+        if hasattr(matrix, 'indptr'):
+            matrix = matrix.tocsr(copy=True).astype(dtype)
+            lengths = np.diff(matrix.indptr)
+            rows = np.repeat(np.arange(matrix.shape[0]), lengths)
+            norms = np.sqrt(np.bincount(rows, weights=matrix.data ** 2, minlength=matrix.shape[0]))
+            norms[norms == 0.0] = 1.0
+            matrix.data /= norms[rows]
+            return matrix
+        return _l2_normalize_rows(np.asarray(matrix, dtype=dtype))
+    
+    return np.asarray(normalized(X) @ normalized(Y).T)
+
 class ActivityRecommendationEngine:
     """
     Content-based filtering recommendation engine for activities.
@@ -43,57 +124,151 @@ class ActivityRecommendationEngine:
     and standard scaling for numerical features to create activity embeddings.
     """
     
-    def __init__(self, model_dir: str = "models"):
+    def __init__(self, model_dir: str = "models", embedding_cache_size: int = DEFAULT_CACHE_SIZE,
+                 sparse_embeddings: bool = False, ann_index: Optional[Dict[str, int]] = None,
+                 embedding_precision: str = 'float64', hashed_features: Optional[Dict[str, int]] = None):
         self.model_dir = Path(model_dir)
         self.model_dir.mkdir(exist_ok=True)
         
+        # Model parts, as LazyParts: a model directory provides some only
+        # when first used (see the model_pipeline / activity_features / catalog properties)
+        self._parts: Dict[str, LazyPart] = {}
+        # (id, length, estimated bytes) of the last row catalog memory_bytes measured
+        self._catalog_bytes = None
         self.model_pipeline = None
         self.activity_features = None
         self.activity_embeddings = None
+        # Place id (or id) of each embedding row, for update_model
+        self.activity_ids = None
         self.is_trained = False
         self.model_metadata = {}
-        
-        # Model file paths
+        # Keep embeddings in CSR form when training and scoring (a loaded
+        # model uses the format it was trained with)
+        self.sparse_embeddings = sparse_embeddings
+        # Precision the embeddings are stored and scored at (one of
+        # EMBEDDING_PRECISIONS; a loaded model uses the one it was trained with)
+        self.embedding_precision = check_precision(embedding_precision, sparse_embeddings)
+        # RandomProjectionIndex.build parameters: when set, training keeps the
+        # activities as a catalog and indexes their embeddings
+        self.ann_index_params = ann_index
+        self.ann_index = None
+        # HashedStreamingTrainer bucket counts: when set, training runs out of
+        # core with hashed type and term features instead of fitting the pipeline
+        self.hashed_features = hashed_features
+        self.catalog = None
+        # Numpy form of the fitted pipeline used at request time (None: use the pipeline)
+        self.compiled_transform = None
+        # Embedding rows of recently scored activities (disabled with size 0)
+        self.embedding_cache = EmbeddingCache(embedding_cache_size) if embedding_cache_size > 0 else None
+        self.shared_embeddings = None
+        # Segments published for older model versions, kept for attached readers
+        self.retired_shared_embeddings = []
+        # What requests score with, replaced as a whole when the model changes
+        # (see model_snapshot; None until a model is trained or loaded)
+        self._snapshot: Optional[ModelSnapshot] = None
+        
+        # Model file paths (model_path is the memory-mapped model directory;
+        # model_file is the single-pickle format of earlier versions)
+        self.model_path = self.model_dir / "activity_recommendation_model"
         self.model_file = self.model_dir / "activity_recommendation_model.pkl"
         self.metadata_file = self.model_dir / "model_metadata.json"
         
         logger.info(f"Initialized recommendation engine with model directory: {self.model_dir}")
 
+    def _deferred(self, name: str) -> Any:
+        """Value of a model part, reading it from the model directory on first use."""
+        part = self._parts.get(name)
+        return part.get() if part is not None else None
+
+    def _set_part(self, name: str, value: Any) -> None:
+        # A new holder: snapshots keep the one they were built with
+        self._parts[name] = LazyPart(value=value)
+
+    @property
+    def model_pipeline(self) -> Any:
+        """The fitted sklearn pipeline."""
+        return self._deferred('model_pipeline')
+
+    @model_pipeline.setter
+    def model_pipeline(self, value: Any) -> None:
+        self._set_part('model_pipeline', value)
+
+    @property
+    def activity_features(self) -> Optional[pd.DataFrame]:
+        """The feature table the model was trained on."""
+        return self._deferred('activity_features')
+
+    @activity_features.setter
+    def activity_features(self, value: Optional[pd.DataFrame]) -> None:
+        self._set_part('activity_features', value)
+
+    @property
+    def activity_ids(self) -> Optional[List[Any]]:
+        """Place id (or id) of each embedding row (None for activities without one)."""
+        return self._deferred('activity_ids')
+
+    @activity_ids.setter
+    def activity_ids(self, value: Optional[List[Any]]) -> None:
+        self._set_part('activity_ids', value)
+
+    @property
+    def catalog(self) -> Any:
+        """Training activities kept for catalog recommendations (None unless an ANN index was built)."""
+        return self._deferred('catalog')
+
+    @catalog.setter
+    def catalog(self, value: Any) -> None:
+        self._set_part('catalog', value)
+
+    def has_saved_model(self) -> bool:
+        return self.model_path.exists() or self.model_file.exists()
+
+    @staticmethod
+    def _activity_columns(activities: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+        """Collect the raw per-activity values features are derived from, column by column."""
+        if isinstance(activities, ColumnarActivities):
+            return activities.feature_columns()
+        
+        return {
+            'types': [activity.get('types', []) for activity in activities],
+            'rating': [activity.get('rating', 0.0) for activity in activities],
+            'price_level': [activity.get('price_level', 0) for activity in activities],
+            'user_ratings_total': [activity.get('user_ratings_total', 0) for activity in activities],
+            'has_photos': [1 if activity.get('photo_reference') else 0 for activity in activities]
+        }
+
+    def _activity_ids(self, activities: List[Dict[str, Any]]) -> List[Any]:
+        """Place id (or id) of each activity, None when it has neither."""
+        if isinstance(activities, ColumnarActivities):
+            for name in ('place_id', 'id'):
+                if name in activities.table.column_names:
+                    return activities.column(name, None)
+            return [None] * len(activities)
+        
+        return [activity.get('place_id', activity.get('id')) for activity in activities]
+
+    def _feature_columns(self, activities: List[Dict[str, Any]]) -> FeatureColumns:
+        """Extract features from activity data as columns over interned activity types."""
+        return self._columns_from_raw(self._activity_columns(activities))
+
+    def _columns_from_raw(self, raw_columns: Dict[str, List[Any]]) -> FeatureColumns:
+        with stage('import'):
+            # Loaded here so first-use import time is not counted as feature extraction
+            import numpy
+            import pandas
+        
+        with stage('feature_extraction'):
+            logger.debug(f"Extracting features from {len(raw_columns['types'])} activities")
+            return FeatureColumns(raw_columns)
+
     def _extract_features(self, activities: List[Dict[str, Any]]) -> pd.DataFrame:
         """Extract and preprocess features from activity data."""
-        logger.debug(f"Extracting features from {len(activities)} activities")
-        
-        features = []
-        for activity in activities:
-            # Extract basic features
-            activity_types = activity.get('types', [])
-            primary_type = activity_types[0] if activity_types else 'unknown'
-            
-            # Create feature vector
-            feature_vector = {
-                'primary_type': primary_type,
-                'types_text': ' '.join(activity_types),
-                'rating': activity.get('rating', 0.0),
-                'price_level': activity.get('price_level', 0),
-                'user_ratings_total': activity.get('user_ratings_total', 0),
-                'has_photos': 1 if activity.get('photo_reference') else 0,
-                
-                # Derived binary features
-                'is_food': 1 if any(t in ['restaurant', 'cafe', 'bar', 'food'] for t in activity_types) else 0,
-                'is_cultural': 1 if any(t in ['museum', 'art_gallery', 'library', 'church'] for t in activity_types) else 0,
-                'is_outdoor': 1 if any(t in ['park', 'natural_feature', 'recreation_area'] for t in activity_types) else 0,
-                'is_entertainment': 1 if any(t in ['amusement_park', 'movie_theater', 'stadium'] for t in activity_types) else 0,
-                'is_shopping': 1 if any(t in ['shopping_mall', 'store', 'department_store'] for t in activity_types) else 0,
-                
-                # Quality indicators
-                'is_highly_rated': 1 if activity.get('rating', 0) >= 4.0 else 0,
-                'is_popular': 1 if activity.get('user_ratings_total', 0) >= 100 else 0,
-                'is_expensive': 1 if activity.get('price_level', 0) >= 3 else 0
-            }
-            features.append(feature_vector)
+        columns = self._feature_columns(activities)
+        with stage('feature_extraction'):
+            features = columns.frame()
         
         logger.debug(f"Extracted {len(features)} feature vectors")
-        return pd.DataFrame(features)
+        return features
 
     def train_content_based_model(self, activities: List[Dict[str, Any]], force_retrain: bool = False) -> None:
         """
@@ -106,20 +281,165 @@ class ActivityRecommendationEngine:
         start_time = datetime.now()
         logger.info(f"Starting model training with {len(activities)} activities")
         
+        if self._load_recent_model(force_retrain):
+            return
+        
+        if not activities:
+            raise ValueError("No activities provided for training")
+        
+        if self.hashed_features is not None:
+            self._train_hashed(activities, start_time)
+            return
+        
+        # Keep the activities as the catalog the ANN index answers from
+        catalog = None
+        if self.ann_index_params is not None:
+            catalog = activities if isinstance(activities, ColumnarActivities) else list(activities)
+        
+        # Extract features
+        self._fit_features(self._extract_features(activities), start_time, catalog, self._activity_ids(activities))
+
+    def train_from_stream(self, activities: Iterable[Dict[str, Any]], force_retrain: bool = False,
+                          chunk_size: int = 5000) -> int:
+        """
+        Train the model from an activity iterator without holding the raw activities.
+        
+        Features are extracted chunk by chunk as activities arrive, so only
+        the compact feature table is kept in memory (plus the activities
+        themselves when an ANN index with its catalog is built). Returns the
+        number of activities consumed.
+        
+        Args:
+            activities: Iterable of activity dictionaries (e.g. a streaming parser)
+            force_retrain: Force retraining even if recent model exists
+            chunk_size: Activities per feature extraction chunk
+        """
+        import pandas as pd
+        
+        start_time = datetime.now()
+        logger.info("Starting streaming model training")
+        
+        if self._load_recent_model(force_retrain):
+            return 0
+        
+        if self.hashed_features is not None:
+            return self._train_hashed(activities, start_time, chunk_size)
+        
+        frames = []
+        activity_ids = []
+        catalog = [] if self.ann_index_params is not None else None
+        iterator = iter(activities)
+        while True:
+            with stage('parse'):
+                chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                break
+            frames.append(self._extract_features(chunk))
+            activity_ids.extend(self._activity_ids(chunk))
+            if catalog is not None:
+                catalog.extend(chunk)
+            logger.debug(f"Extracted features for {sum(len(f) for f in frames)} streamed activities")
+        
+        if not frames:
+            raise ValueError("No activities provided for training")
+        
+        activity_features = pd.concat(frames, ignore_index=True)
+        self._fit_features(activity_features, start_time, catalog, activity_ids)
+        return len(activity_features)
+
+    def _train_hashed(self, activities: Iterable[Dict[str, Any]], start_time: datetime,
+                      chunk_size: int = 5000) -> int:
+        """
+        Train with hashed features out of core (see hashed_training) and
+        open the saved model memory-mapped. Returns the number of activities.
+        """
+        import shutil
+        import tempfile
+        import numpy as np
+        from hashed_training import HashedStreamingTrainer
+        
+        if self.sparse_embeddings or self.embedding_precision == 'int8' or self.ann_index_params is not None:
+            raise ValueError("Hashed features are trained into dense float64 or float32 embeddings "
+                             "without a catalog (no sparse embeddings, int8 precision or ANN index)")
+        
+        staging_dir = Path(tempfile.mkdtemp(prefix='.hashed-', dir=self.model_dir))
+        trainer = HashedStreamingTrainer(staging_dir, dtype=self.embedding_precision, **self.hashed_features)
+        try:
+            iterator = iter(activities)
+            while True:
+                with stage('parse'):
+                    chunk = list(islice(iterator, chunk_size))
+                if not chunk:
+                    break
+                with stage('feature_extraction'):
+                    columns = self._feature_columns(chunk)
+                    activity_ids = self._activity_ids(chunk)
+                trainer.add(columns, activity_ids)
+                logger.debug(f"Embedded {trainer.rows} streamed activities")
+            
+            compiled_transform, staged_files = trainer.finish()
+            
+            # Describes the staged embeddings for the writer, which moves them into the model
+            self.activity_embeddings = np.load(staged_files['embeddings.npy'], mmap_mode='r')
+            self.model_pipeline = None
+            self.activity_features = None
+            self.activity_ids = None
+            self.catalog = None
+            self.ann_index = None
+            self.is_trained = True
+            self._use_transform(compiled_transform)
+            self.model_metadata = {
+                'trained_at': datetime.now().isoformat(),
+                'activities_count': trainer.rows,
+                'feature_matrix_shape': self.activity_embeddings.shape,
+                'sparse_embeddings': False,
+                'embedding_precision': self.embedding_precision,
+                'hashed_features': {'n_type_buckets': compiled_transform.n_type_buckets,
+                                    'n_text_buckets': compiled_transform.n_text_buckets},
+                'ann_index': None,
+                'model_version': '1.0.0'
+            }
+            self._save_trained_model(staged_files)
+        finally:
+            trainer.close()
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        
+        training_duration = (datetime.now() - start_time).total_seconds()
+        logger.info(f"✅ Hashed model trained out of core in {training_duration:.2f}s")
+        logger.info(f"📊 Feature matrix shape: {self.activity_embeddings.shape}")
+        return trainer.rows
+
+    def _load_recent_model(self, force_retrain: bool) -> bool:
+        """Load the existing model instead of training when it is recent enough."""
         # Check if we can load an existing model
         if not force_retrain and self._can_load_existing_model():
             try:
                 self.load_model()
                 logger.info("Successfully loaded existing model")
-                return
+                return True
             except Exception as e:
                 logger.warning(f"Failed to load existing model: {e}. Proceeding with training.")
+        return False
+
+    def _fit_features(self, activity_features: pd.DataFrame, start_time: datetime,
+                      catalog: Optional[List[Dict[str, Any]]] = None,
+                      activity_ids: Optional[List[Any]] = None) -> None:
+        """
+        Fit the preprocessing pipeline on extracted features and persist the model.
         
-        if not activities:
-            raise ValueError("No activities provided for training")
+        catalog holds the training activities, in feature order, when an ANN
+        index is to be built over them; activity_ids their place ids.
+        """
+        check_precision(self.embedding_precision, self.sparse_embeddings)
         
-        # Extract features
-        self.activity_features = self._extract_features(activities)
+        with stage('import'):
+            from sklearn.feature_extraction.text import TfidfVectorizer
+            from sklearn.preprocessing import StandardScaler, OneHotEncoder
+            from sklearn.compose import ColumnTransformer
+            from sklearn.pipeline import Pipeline
+        
+        self.activity_features = activity_features
+        self.activity_ids = activity_ids
         
         if len(self.activity_features) == 0:
             raise ValueError("No valid features extracted from activities")
@@ -134,11 +454,14 @@ class ActivityRecommendationEngine:
         # Create preprocessing pipeline
         preprocessor = ColumnTransformer(
             transformers=[
-                ('cat', OneHotEncoder(drop='first', sparse_output=False, handle_unknown='ignore'), categorical_features),
+                ('cat', OneHotEncoder(drop='first', sparse_output=self.sparse_embeddings, handle_unknown='ignore'),
+                 categorical_features),
                 ('num', StandardScaler(), numerical_features),
                 ('text', TfidfVectorizer(max_features=50, stop_words='english'), 'types_text')
             ],
-            remainder='drop'
+            remainder='drop',
+            # Sparse mode: always stack the blocks into one CSR matrix
+            **({'sparse_threshold': 1.0} if self.sparse_embeddings else {})
         )
         
         # Create and fit the pipeline
@@ -147,35 +470,303 @@ class ActivityRecommendationEngine:
         ])
         
         # Fit and transform features
-        self.activity_embeddings = self.model_pipeline.fit_transform(self.activity_features)
+        with stage('fit'):
+            self.activity_embeddings = self.model_pipeline.fit_transform(self.activity_features)
+            if self.sparse_embeddings:
+                self.activity_embeddings = self.activity_embeddings.tocsr()
+            self.activity_embeddings = to_precision(self.activity_embeddings, self.embedding_precision)
         self.is_trained = True
+        self._compile_transform()
+        
+        self.catalog = catalog
+        self.ann_index = None
+        if catalog is not None:
+            with stage('index'):
+                self.ann_index = RandomProjectionIndex.build(self.activity_embeddings, **self.ann_index_params)
         
         # Update metadata
         self.model_metadata = {
             'trained_at': datetime.now().isoformat(),
-            'activities_count': len(activities),
+            'activities_count': len(self.activity_features),
             'feature_matrix_shape': self.activity_embeddings.shape,
+            'sparse_embeddings': self.sparse_embeddings,
+            'embedding_precision': self.embedding_precision,
+            'ann_index': self.ann_index.params() if self.ann_index is not None else None,
             'model_version': '1.0.0'
         }
         
-        # Save the model
-        self.save_model()
+        self._save_trained_model()
         
         training_duration = (datetime.now() - start_time).total_seconds()
         logger.info(f"✅ Model trained successfully in {training_duration:.2f}s")
         logger.info(f"📊 Feature matrix shape: {self.activity_embeddings.shape}")
         logger.info(f"💾 Model saved to {self.model_file}")
 
+    def _save_trained_model(self, staged_files: Optional[Dict[str, Path]] = None) -> None:
+        """
+        Persist a newly trained or updated model and share it when this process publishes.
+        
+        staged_files are model files the out-of-core trainer already wrote
+        (see save_model); the model is then read back from the saved version.
+        """
+        with stage('save'):
+            self.save_model(staged_files=staged_files)
+            if staged_files:
+                self._load_model_directory(str(self.model_path))
+        
+        self._publish_snapshot()
+        
+        # A publishing process shares the new embeddings as a new segment
+        if self.shared_embeddings is not None and self.shared_embeddings.owner and self._embeddings_shareable():
+            with stage('publish'):
+                self.publish_shared_embeddings()
+
+    def update_model(self, activities: List[Dict[str, Any]], removed_ids: Iterable[Any] = (),
+                     drift_threshold: float = DEFAULT_DRIFT_THRESHOLD) -> Dict[str, Any]:
+        """
+        Apply new, changed and deleted activities to the trained model without refitting it.
+        
+        An activity whose place id (or id) the model already has replaces
+        that row; others are appended, and rows of removed_ids are dropped.
+        New rows are embedded with the fitted transform, so categories,
+        vocabulary and scaling stay those of the last full fit. Once the
+        share of the model's activities whose primary type that fit never
+        saw exceeds drift_threshold, the pipeline is refit on the updated
+        feature table instead.
+        
+        Args:
+            activities: New and changed activity dictionaries
+            removed_ids: Place ids (or ids) of activities to drop
+            drift_threshold: Unseen-category rate that triggers a full refit
+            
+        Returns:
+            Counts of added, replaced and removed rows, the unseen-category
+            rate and whether the model was refit
+        """
+        import numpy as np
+        import pandas as pd
+        
+        start_time = datetime.now()
+        if not self.is_trained:
+            raise ValueError("Cannot update an untrained model; train it first")
+        if self.activity_ids is None:
+            raise ValueError("Model has no activity ids to match updates against; retrain it first")
+        
+        with stage('feature_extraction'):
+            raw_columns = self._activity_columns(activities)
+            update_ids = self._activity_ids(activities)
+        columns = self._columns_from_raw(raw_columns)
+        
+        # Row i of the updated model is row source[i] of the current rows
+        # followed by the update's rows
+        existing = len(self.activity_ids)
+        ids = list(self.activity_ids)
+        source = list(range(existing))
+        position = {row_id: row for row, row_id in enumerate(ids) if row_id is not None}
+        added = replaced = 0
+        for j, row_id in enumerate(update_ids):
+            row = position.get(row_id) if row_id is not None else None
+            if row is None:
+                if row_id is not None:
+                    position[row_id] = len(source)
+                source.append(existing + j)
+                ids.append(row_id)
+                added += 1
+            else:
+                source[row] = existing + j
+                replaced += 1
+        
+        removed_ids = set(removed_ids)
+        keep = [row for row, row_id in enumerate(ids) if row_id is None or row_id not in removed_ids]
+        removed = len(ids) - len(keep)
+        source = np.asarray(source, dtype=np.int64)[keep]
+        ids = [ids[row] for row in keep]
+        if not len(source):
+            raise ValueError("Update would leave the model without activities")
+        
+        if self.activity_features is not None:
+            with stage('feature_extraction'):
+                activity_features = pd.concat([self.activity_features, columns.frame()], ignore_index=True)
+                activity_features = activity_features.iloc[source].reset_index(drop=True)
+                unseen_rate = float(np.mean(self._unseen_categories(activity_features['primary_type'])))
+        else:
+            # Hashed models keep no feature table, and their buckets take any type
+            activity_features = None
+            unseen_rate = 0.0
+        
+        catalog = None
+        if self.catalog is not None:
+            rows = list(self.catalog) + list(activities)
+            catalog = [rows[row] for row in source.tolist()]
+        
+        summary = {'added': added, 'replaced': replaced, 'removed': removed,
+                   'unseen_category_rate': unseen_rate, 'refit': unseen_rate > drift_threshold}
+        logger.info(f"Updating model: {added} added, {replaced} replaced, {removed} removed, "
+                    f"unseen-category rate {unseen_rate:.3f}")
+        
+        if summary['refit']:
+            logger.info(f"Unseen-category rate above {drift_threshold}; refitting the pipeline")
+            if catalog is not None and self.ann_index_params is None:
+                # Rebuild the index with the layout the model was trained with
+                self.ann_index_params = {'n_tables': self.ann_index.n_tables, 'n_bits': self.ann_index.n_bits}
+            self._fit_features(activity_features, start_time, catalog, ids)
+            return summary
+        
+        new_rows = self._embed_columns(columns)
+        with stage('update'):
+            if isinstance(self.activity_embeddings, QuantizedEmbeddings):
+                new_rows = QuantizedEmbeddings.quantize(new_rows, self.activity_embeddings.scales)
+            self.activity_embeddings = gather_rows(self.activity_embeddings, new_rows, source)
+        
+        self.activity_features = activity_features
+        self.activity_ids = ids
+        self.catalog = catalog
+        if self.ann_index is not None:
+            with stage('index'):
+                self.ann_index = self.ann_index.reindex(self.activity_embeddings)
+        
+        self.model_metadata = dict(
+            self.model_metadata,
+            updated_at=datetime.now().isoformat(),
+            activities_count=len(ids),
+            feature_matrix_shape=self.activity_embeddings.shape,
+            unseen_category_rate=unseen_rate,
+            ann_index=self.ann_index.params() if self.ann_index is not None else None
+        )
+        self._save_trained_model()
+        
+        duration = (datetime.now() - start_time).total_seconds()
+        logger.info(f"✅ Model updated in {duration:.2f}s")
+        return summary
+
+    def _unseen_categories(self, primary_types: Any) -> np.ndarray:
+        """Mask of the primary types the fitted one-hot encoder has no category for."""
+        import numpy as np
+        
+        if isinstance(self.compiled_transform, HashedFeatureTransform):
+            return np.zeros(len(primary_types), dtype=bool)
+        if self.compiled_transform is not None:
+            known = list(self.compiled_transform.categories)
+            if self.compiled_transform.dropped_category is not None:
+                known.append(self.compiled_transform.dropped_category)
+        else:
+            encoder = self.model_pipeline.named_steps['preprocessor'].named_transformers_['cat']
+            known = list(encoder.categories_[0])
+        return ~np.isin(np.asarray(primary_types, dtype=object), np.asarray(known, dtype=object))
+
+    def _compile_transform(self) -> None:
+        """Export the fitted pipeline into the numpy transform used for scoring."""
+        compiled_transform = CompiledFeatureTransform.from_pipeline(self.model_pipeline)
+        if compiled_transform is None:
+            logger.warning("Fitted pipeline cannot be compiled; scoring will use the sklearn pipeline")
+        self._use_transform(compiled_transform)
+
+    def _use_transform(self, compiled_transform: Optional[CompiledFeatureTransform]) -> None:
+        """Score with `compiled_transform` (None: the sklearn pipeline) from now on."""
+        self.compiled_transform = compiled_transform
+        
+        # Cached rows belong to the previous model
+        if self.embedding_cache is not None:
+            self.embedding_cache.clear()
+
+    def _transform_activities(self, activities: List[Dict[str, Any]],
+                              raw_columns: Optional[Dict[str, List[Any]]] = None,
+                              snapshot: Optional[ModelSnapshot] = None) -> Any:
+        """
+        Embed activities with the trained feature pipeline.
+        
+        Rows of activities embedded before under the same model version come
+        from the embedding cache; only the misses are transformed.
+        raw_columns are the activities' _activity_columns, if already collected.
+        snapshot is the model the request scores with (default: the current one).
+        """
+        import numpy as np
+        
+        snapshot = snapshot or self._snapshot
+        if raw_columns is None:
+            with stage('feature_extraction'):
+                raw_columns = self._activity_columns(activities)
+        
+        if self.embedding_cache is None:
+            return self._embed_raw(raw_columns, snapshot)
+        
+        with stage('cache'):
+            keys = embedding_keys(self._activity_ids(activities), raw_columns)
+            cached, missing = self.embedding_cache.lookup(snapshot.version, keys)
+        
+        if not missing:
+            with stage('cache'):
+                rows = [cached[position] for position in range(len(keys))]
+                if snapshot.sparse:
+                    return stack_sparse_rows(rows, snapshot.n_features)
+                return np.stack(rows)
+        
+        if cached:
+            raw_columns = {name: [column[i] for i in missing] for name, column in raw_columns.items()}
+        computed = self._embed_raw(raw_columns, snapshot)
+        if not snapshot.sparse and hasattr(computed, 'toarray'):
+            computed = computed.toarray()
+        
+        with stage('cache'):
+            computed_rows = sparse_rows(computed) if snapshot.sparse else computed
+            self.embedding_cache.store(snapshot.version, [keys[i] for i in missing], computed_rows)
+            if not cached:
+                return computed
+            
+            if snapshot.sparse:
+                rows = [None] * len(keys)
+                for position, row in zip(missing, computed_rows):
+                    rows[position] = row
+                for position, row in cached.items():
+                    rows[position] = row
+                return stack_sparse_rows(rows, computed.shape[1])
+            
+            embeddings = np.empty((len(keys), computed.shape[1]), dtype=computed.dtype)
+            embeddings[missing] = computed
+            positions = list(cached)
+            embeddings[positions] = np.stack([cached[position] for position in positions])
+            return embeddings
+
+    def _embed_raw(self, raw_columns: Dict[str, List[Any]], snapshot: Optional[ModelSnapshot] = None) -> Any:
+        """Transform raw activity columns into embeddings (see _embed_columns)."""
+        return self._embed_columns(self._columns_from_raw(raw_columns), snapshot)
+
+    def _embed_columns(self, columns: FeatureColumns, snapshot: Optional[ModelSnapshot] = None) -> Any:
+        """
+        Transform feature columns into embeddings (CSR in sparse mode,
+        float32 when the model stores reduced-precision embeddings) with
+        the snapshot's model (default: the current one).
+        """
+        snapshot = snapshot or self._snapshot
+        if snapshot.transform is not None:
+            with stage('transform'):
+                embeddings = snapshot.transform.transform(columns, sparse_output=snapshot.sparse)
+        else:
+            with stage('feature_extraction'):
+                activity_features = columns.frame()
+            with stage('transform'):
+                embeddings = snapshot.pipeline.get().transform(activity_features)
+                if snapshot.sparse:
+                    embeddings = embeddings.tocsr()
+        
+        # Request pools are scored, not stored, so int8 models score them in float32
+        if snapshot.precision != 'float64':
+            embeddings = embeddings.astype('float32')
+        return embeddings
+
     def _can_load_existing_model(self) -> bool:
         """Check if we can load an existing model (exists and is recent)."""
-        if not self.model_file.exists() or not self.metadata_file.exists():
+        if not self.has_saved_model() or not self.metadata_file.exists():
             return False
         
         try:
             with open(self.metadata_file, 'r') as f:
                 metadata = json.load(f)
             
-            trained_at = datetime.fromisoformat(metadata.get('trained_at', '1970-01-01T00:00:00'))
+            # An incrementally updated model is as fresh as its last update
+            trained_at = datetime.fromisoformat(
+                metadata.get('updated_at', metadata.get('trained_at', '1970-01-01T00:00:00'))
+            )
             days_old = (datetime.now() - trained_at).days
             
             # Model is valid if less than 7 days old
@@ -187,8 +778,11 @@ class ActivityRecommendationEngine:
             logger.warning(f"Error checking model metadata: {e}")
             return False
 
-    def _calculate_user_preference_vector(self, user_profile: Dict[str, Any]) -> np.ndarray:
-        """Calculate user preference vector based on profile."""
+    def _calculate_user_preference_vector(self, user_profile: Dict[str, Any],
+                                          snapshot: Optional[ModelSnapshot] = None) -> np.ndarray:
+        """Calculate user preference vector based on profile (for the snapshot's model, default the current one)."""
+        import numpy as np
+        
         logger.debug("Calculating user preference vector")
         
         # Extract user preferences
@@ -199,7 +793,7 @@ class ActivityRecommendationEngine:
         
         # Create preference vector (same length as activity embeddings)
         # This is a simplified approach - in practice, you'd want more sophisticated mapping
-        preference_vector = np.zeros(self.activity_embeddings.shape[1])
+        preference_vector = np.zeros((snapshot or self._snapshot).n_features)
         
         # Map interests to feature indices (simplified)
         interest_mapping = {
@@ -214,8 +808,8 @@ class ActivityRecommendationEngine:
             if interest in interest_mapping:
                 for feature in interest_mapping[interest]:
                     # Find feature index in the feature matrix
-                    if feature in self.activity_features.columns:
-                        feature_idx = self.activity_features.columns.get_loc(feature)
+                    if feature in FEATURE_COLUMNS:
+                        feature_idx = FEATURE_COLUMNS.index(feature)
                         if feature_idx < len(preference_vector):
                             preference_vector[feature_idx] = 1.0
         
@@ -229,7 +823,7 @@ class ActivityRecommendationEngine:
     def get_personalized_recommendations(
         self, 
         user_profile: Dict[str, Any], 
-        available_activities: List[Dict[str, Any]], 
+        available_activities: Optional[List[Dict[str, Any]]] = None, 
         top_n: int = 5
     ) -> List[Tuple[Dict[str, Any], float]]:
         """
@@ -238,43 +832,46 @@ class ActivityRecommendationEngine:
         Args:
             user_profile: User preferences and constraints
             available_activities: List of available activities to rank
+                (None: rank the catalog stored with the model)
             top_n: Number of top recommendations to return
             
         Returns:
             List of (activity, score) tuples sorted by score
         """
+        if available_activities is None:
+            return self.get_catalog_recommendations(user_profile, top_n)
+        
         start_time = datetime.now()
         logger.info(f"Generating recommendations for user with {len(available_activities)} available activities")
         
-        if not self.is_trained:
+        # The whole request scores with this model, even if it is replaced meanwhile
+        snapshot = self._snapshot
+        if snapshot is None:
             logger.warning("Model not trained. Returning fallback recommendations.")
             return self._fallback_recommendations(available_activities, top_n)
         
         try:
-            # Extract features for available activities
-            activity_features = self._extract_features(available_activities)
-            
-            # Transform features using the trained pipeline
-            activity_embeddings = self.model_pipeline.transform(activity_features)
-            
-            # Calculate user preference vector
-            user_vector = self._calculate_user_preference_vector(user_profile)
-            
-            # Calculate similarity scores
-            similarity_scores = cosine_similarity([user_vector], activity_embeddings)[0]
+            # Extract and transform features for available activities
+            with stage('feature_extraction'):
+                raw_columns = self._activity_columns(available_activities)
+            activity_embeddings = self._transform_activities(available_activities, raw_columns, snapshot)
+            
+            with stage('similarity'):
+                # Calculate user preference vector
+                user_vector = self._calculate_user_preference_vector(user_profile, snapshot)
+                
+                # Calculate similarity scores
+                similarity_scores = cosine_similarity([user_vector], activity_embeddings)[0]
             
             # Apply preference-based boosting
-            final_scores = []
-            for i, activity in enumerate(available_activities):
-                base_score = similarity_scores[i]
-                
-                # Apply preference boosts
-                score = self._apply_preference_boosting(activity, user_profile, base_score)
-                final_scores.append((activity, score))
+            with stage('boosting'):
+                scores = self._boost_scores(
+                    similarity_scores, raw_columns['types'], self._boosting_prices(available_activities), user_profile
+                )
             
-            # Sort by score and return top N
-            final_scores.sort(key=lambda x: x[1], reverse=True)
-            recommendations = final_scores[:top_n]
+            # Select the top N by score
+            with stage('sort'):
+                recommendations = [(available_activities[i], scores[i]) for i in top_n_indices(scores, top_n)]
             
             duration = (datetime.now() - start_time).total_seconds()
             logger.info(f"✅ Generated {len(recommendations)} recommendations in {duration:.3f}s")
@@ -285,8 +882,197 @@ class ActivityRecommendationEngine:
             logger.error(f"Error generating recommendations: {e}")
             return self._fallback_recommendations(available_activities, top_n)
 
+    def get_catalog_recommendations(self, user_profile: Dict[str, Any], top_n: int = 5,
+                                    probes: int = DEFAULT_PROBES, exact: bool = False
+                                    ) -> List[Tuple[Dict[str, Any], float]]:
+        """
+        Recommend from the catalog of training activities stored with the model.
+        
+        The ANN index narrows the catalog to the activities hashed near the
+        user's preference vector; only those are scored and boosted. More
+        probes raise recall at the cost of more candidates. exact=True (or a
+        preference vector without any interest) scans the whole catalog.
+        """
+        import numpy as np
+        
+        snapshot = self._snapshot
+        catalog = snapshot.catalog.get() if snapshot is not None else None
+        if catalog is None:
+            raise ValueError("No activity catalog stored with the model; "
+                             "pass activities or train with an ANN index")
+        
+        catalog_columns = snapshot.catalog_columns.get()
+        
+        with stage('similarity'):
+            user_vector = self._calculate_user_preference_vector(user_profile, snapshot)
+        
+        with stage('ann'):
+            candidates = None
+            if not exact and snapshot.ann_index is not None and user_vector.any():
+                candidates = snapshot.ann_index.candidates(user_vector, probes)
+        
+        with stage('similarity'):
+            # The preference vector is unit length (or zero), so cosine
+            # similarity only needs the rows' precomputed norms
+            embeddings, norms = snapshot.embeddings, catalog_columns['norms']
+            if candidates is not None:
+                embeddings, norms = embeddings[candidates], norms[candidates]
+            user_vector = user_vector.astype(scoring_dtype(embeddings))
+            similarity_scores = np.asarray(embeddings @ user_vector).ravel() / norms
+        logger.info(f"Scoring {len(similarity_scores)} of {len(catalog)} catalog activities")
+        
+        with stage('boosting'):
+            interned, prices = catalog_columns['interned'], catalog_columns['prices']
+            if candidates is not None:
+                interned, prices = select_interned(interned, candidates), prices[candidates]
+            scores = self._boost_scores(similarity_scores, None, prices, user_profile, interned)
+        
+        with stage('sort'):
+            top = top_n_indices(scores, top_n)
+            rows = top if candidates is None else candidates[top]
+            return [(catalog[row], scores[i]) for row, i in zip(rows.tolist(), top.tolist())]
+
+    @staticmethod
+    def _catalog_scoring_columns(embeddings: Any, catalog: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Catalog values every catalog query reads (interned types, prices, embedding norms), computed once per snapshot."""
+        import numpy as np
+        
+        norms = np.array(row_norms(embeddings))
+        # Zero rows score 0, as with cosine_similarity
+        norms[norms == 0.0] = 1.0
+        
+        return {
+            'interned': intern_types(ActivityRecommendationEngine._activity_columns(catalog)['types']),
+            'prices': np.asarray(ActivityRecommendationEngine._boosting_prices(catalog)),
+            'norms': norms
+        }
+
+    def get_batch_recommendations(
+        self,
+        user_profiles: List[Dict[str, Any]],
+        available_activities: List[Dict[str, Any]],
+        top_n: int = 5
+    ) -> List[List[Tuple[Dict[str, Any], float]]]:
+        """
+        Get personalized recommendations for many users over one activity pool.
+        
+        Equivalent to calling get_personalized_recommendations once per
+        profile, but the pool is extracted and transformed once and all
+        users are scored with a single matrix product.
+        
+        Args:
+            user_profiles: User preferences and constraints, one per user
+            available_activities: List of available activities to rank
+            top_n: Number of top recommendations to return per user
+            
+        Returns:
+            One list of (activity, score) tuples per profile, in profile order
+        """
+        import numpy as np
+        
+        start_time = datetime.now()
+        logger.info(f"Generating recommendations for {len(user_profiles)} users "
+                    f"with {len(available_activities)} available activities")
+        
+        snapshot = self._snapshot
+        if snapshot is None:
+            logger.warning("Model not trained. Returning fallback recommendations.")
+            fallback = self._fallback_recommendations(available_activities, top_n)
+            return [list(fallback) for _ in user_profiles]
+        
+        try:
+            with stage('feature_extraction'):
+                raw_columns = self._activity_columns(available_activities)
+            activity_embeddings = self._transform_activities(available_activities, raw_columns, snapshot)
+            
+            with stage('similarity'):
+                # One preference vector per row; cosine_similarity normalizes
+                # both sides and scores all users in a single matrix product
+                user_matrix = np.array(
+                    [self._calculate_user_preference_vector(profile, snapshot) for profile in user_profiles],
+                    dtype=np.float64
+                ).reshape(len(user_profiles), -1)
+                similarity_scores = cosine_similarity(user_matrix, activity_embeddings)
+            
+            with stage('boosting'):
+                interned = intern_types(raw_columns['types'])
+                prices = self._boosting_prices(available_activities)
+                scores = [
+                    self._boost_scores(similarity_scores[u], raw_columns['types'], prices, profile, interned)
+                    for u, profile in enumerate(user_profiles)
+                ]
+            
+            with stage('sort'):
+                recommendations = [
+                    [(available_activities[i], user_scores[i]) for i in top_n_indices(user_scores, top_n)]
+                    for user_scores in scores
+                ]
+            
+            duration = (datetime.now() - start_time).total_seconds()
+            logger.info(f"✅ Generated recommendations for {len(recommendations)} users in {duration:.3f}s")
+            
+            return recommendations
+            
+        except Exception as e:
+            logger.error(f"Error generating batch recommendations: {e}")
+            fallback = self._fallback_recommendations(available_activities, top_n)
+            return [list(fallback) for _ in user_profiles]
+
+    @staticmethod
+    def _boosting_prices(activities: List[Dict[str, Any]]) -> List[Any]:
+        """Price levels as boosting reads them (a missing price counts as moderate)."""
+        if isinstance(activities, ColumnarActivities):
+            return activities.column('price_level', 2)
+        return [activity.get('price_level', 2) for activity in activities]
+
+    def _boost_scores(self, base_scores: np.ndarray, types: List[List[str]], price_levels: List[Any],
+                      user_profile: Dict[str, Any], interned: Optional[Tuple] = None) -> np.ndarray:
+        """
+        Apply preference-based boosting to all similarity scores at once.
+        
+        Same rules, applied in the same order, as _apply_preference_boosting,
+        but type matching is evaluated once per distinct type and then
+        OR-reduced over each activity's types. `interned` is
+        intern_types(types), when the caller already has it (types is then
+        not read).
+        """
+        import numpy as np
+        
+        vocabulary, type_ids, offsets = interned if interned is not None else intern_types(types)
+        has_types = offsets[1:] > offsets[:-1]
+        starts = offsets[:-1][has_types]
+        
+        def any_type(type_mask: np.ndarray) -> np.ndarray:
+            matched = np.zeros(len(has_types), dtype=bool)
+            if len(starts):
+                matched[has_types] = np.logical_or.reduceat(type_mask[type_ids], starts)
+            return matched
+        
+        scores = np.array(base_scores, dtype=np.float64)
+        
+        # Interest matching boost (substring match against every type)
+        lowered = [t.lower() for t in vocabulary]
+        for interest in user_profile.get('interests', []):
+            needle = interest.lower()
+            type_mask = np.fromiter((needle in t for t in lowered), dtype=bool, count=len(lowered))
+            scores = np.where(any_type(type_mask), scores * 1.3, scores)
+        
+        # Budget compatibility
+        user_budget = user_profile.get('budget', 2)
+        prices = np.asarray(price_levels)
+        scores = np.where(user_budget < prices, scores * 0.7,
+                          np.where(user_budget > prices + 1, scores * 0.9, scores))
+        
+        # Pace compatibility
+        pace = user_profile.get('pace', 'moderate')
+        penalized_type = {'fast': 'park', 'relaxed': 'amusement_park'}.get(pace)
+        if penalized_type is not None:
+            scores = np.where(any_type(vocabulary == penalized_type), scores * 0.8, scores)
+        
+        return scores
+
     def _apply_preference_boosting(self, activity: Dict[str, Any], user_profile: Dict[str, Any], base_score: float) -> float:
-        """Apply preference-based boosting to the base similarity score."""
+        """Apply preference-based boosting to the base similarity score (one activity; see _boost_scores)."""
         score = base_score
         
         # Interest matching boost
@@ -319,53 +1105,80 @@ class ActivityRecommendationEngine:
         """Fallback recommendation method when ML model is unavailable."""
         logger.warning("Using fallback recommendation method")
         
-        # Simple heuristic ranking
-        scored_activities = []
-        for activity in activities:
-            score = 0.0
-            
-            # Rating-based scoring
-            rating = activity.get('rating', 0)
-            score += rating * 0.3
-            
-            # Popularity-based scoring
-            reviews = activity.get('user_ratings_total', 0)
-            if reviews > 100:
-                score += 0.2
-            
-            # Type diversity bonus
-            types = activity.get('types', [])
-            if len(types) > 1:
-                score += 0.1
+        with stage('fallback'):
+            # Simple heuristic ranking
+            scored_activities = []
+            for activity in activities:
+                score = 0.0
+                
+                # Rating-based scoring
+                rating = activity.get('rating', 0)
+                score += rating * 0.3
+                
+                # Popularity-based scoring
+                reviews = activity.get('user_ratings_total', 0)
+                if reviews > 100:
+                    score += 0.2
+                
+                # Type diversity bonus
+                types = activity.get('types', [])
+                if len(types) > 1:
+                    score += 0.1
+                
+                scored_activities.append((activity, score))
             
-            scored_activities.append((activity, score))
-        
-        # Sort and return top N
-        scored_activities.sort(key=lambda x: x[1], reverse=True)
-        return scored_activities[:top_n]
+            # Sort and return top N
+            scored_activities.sort(key=lambda x: x[1], reverse=True)
+            return scored_activities[:top_n]
 
-    def save_model(self, filepath: str = None) -> None:
-        """Save the trained model to disk."""
+    def save_model(self, filepath: str = None, staged_files: Optional[Dict[str, Path]] = None) -> None:
+        """
+        Save the trained model to disk.
+        
+        The model is written as a memory-mapped model directory (see
+        model_store); a filepath ending in .pkl writes the single joblib
+        pickle of earlier versions instead. staged_files (model directories
+        only) are files of the model already on disk, moved into it.
+        """
         if not self.is_trained:
             raise ValueError("Cannot save untrained model")
         
-        if filepath is None:
-            filepath = str(self.model_file)
+        filepath = str(self.model_path if filepath is None else filepath)
+        if staged_files and filepath.endswith('.pkl'):
+            raise ValueError("Staged model files can only be saved to a model directory")
         
         try:
-            model_data = {
-                'pipeline': self.model_pipeline,
-                'activity_features': self.activity_features,
-                'activity_embeddings': self.activity_embeddings,
-                'is_trained': self.is_trained,
-                'metadata': self.model_metadata
-            }
-            
-            joblib.dump(model_data, filepath)
+            if filepath.endswith('.pkl'):
+                import joblib
+                
+                model_data = {
+                    'pipeline': self.model_pipeline,
+                    'activity_features': self.activity_features,
+                    'activity_embeddings': self.activity_embeddings,
+                    'activity_ids': self.activity_ids,
+                    'ann_index': self.ann_index,
+                    'catalog': self.catalog,
+                    'is_trained': self.is_trained,
+                    'metadata': self.model_metadata
+                }
+                
+                joblib.dump(model_data, filepath)
+            else:
+                from model_store import write_model_directory
+                
+                write_model_directory(
+                    Path(filepath), self.model_metadata, self.activity_embeddings, self.activity_features,
+                    compiled_transform=self.compiled_transform, pipeline=self.model_pipeline,
+                    ann_index=self.ann_index, catalog=self.catalog, activity_ids=self.activity_ids,
+                    staged_files=staged_files
+                )
             
-            # Save metadata separately for easy access
-            with open(self.metadata_file, 'w') as f:
+            # Save metadata separately for easy access, replacing the old file
+            # in one step so readers never see it half written
+            metadata_tmp = self.metadata_file.with_name(f".{self.metadata_file.name}.{os.getpid()}")
+            with open(metadata_tmp, 'w') as f:
                 json.dump(self.model_metadata, f, indent=2)
+            os.replace(metadata_tmp, self.metadata_file)
             
             logger.info(f"✅ Model saved to {filepath}")
             
@@ -373,22 +1186,29 @@ class ActivityRecommendationEngine:
             logger.error(f"Error saving model: {e}")
             raise
 
-    def load_model(self, filepath: str = None) -> None:
-        """Load a trained model from disk."""
+    def load_model(self, filepath: str = None, publish_shared: bool = False, attach_shared: bool = False) -> None:
+        """
+        Load a trained model from disk.
+        
+        Args:
+            filepath: Model directory or pickle to load (defaults to the
+                engine's model directory, then to a pickle of earlier versions)
+            publish_shared: Publish the embeddings into a shared memory segment
+                other processes on the host can attach to
+            attach_shared: Use the embeddings another process published for
+                this model version instead of holding a private copy
+        """
         if filepath is None:
-            filepath = str(self.model_file)
+            filepath = str(self.model_path if self.model_path.exists() else self.model_file)
         
         if not os.path.exists(filepath):
             raise FileNotFoundError(f"Model file not found: {filepath}")
         
         try:
-            model_data = joblib.load(filepath)
-            
-            self.model_pipeline = model_data['pipeline']
-            self.activity_features = model_data['activity_features']
-            self.activity_embeddings = model_data['activity_embeddings']
-            self.is_trained = model_data['is_trained']
-            self.model_metadata = model_data.get('metadata', {})
+            if os.path.isdir(filepath):
+                self._load_model_directory(filepath)
+            else:
+                self._load_model_pickle(filepath, attach_shared)
             
             logger.info(f"✅ Model loaded from {filepath}")
             logger.info(f"📊 Model metadata: {self.model_metadata}")
@@ -396,6 +1216,247 @@ class ActivityRecommendationEngine:
         except Exception as e:
             logger.error(f"Error loading model: {e}")
             raise
+        
+        # Scoring works from the private copy whatever happens to sharing below
+        self._publish_snapshot()
+        
+        if not self._embeddings_shareable() and (attach_shared or publish_shared):
+            # Shared segments hold dense matrices; CSR and int8 models are small enough to keep private
+            logger.info("Model embeddings are sparse or quantized; not using shared memory")
+            return
+        try:
+            if attach_shared:
+                self.attach_shared_embeddings()
+            elif publish_shared:
+                self.publish_shared_embeddings()
+        except Exception as e:
+            logger.warning(f"Could not share the model embeddings ({e}); using a private copy")
+
+    def _load_model_directory(self, path: str) -> None:
+        """Open a model directory: arrays are memory-mapped, other parts are read on first use."""
+        with stage('import'):
+            import numpy
+            import model_store
+        
+        model = model_store.ModelDirectory(Path(path))
+        self.model_metadata = model.metadata
+        self.sparse_embeddings = bool(model.manifest['embeddings']['sparse'])
+        self.embedding_precision = model.manifest['embeddings'].get('precision', 'float64')
+        self.activity_embeddings = model.embeddings()
+        self.ann_index = model.ann_index()
+        self.is_trained = True
+        
+        self._parts = {
+            name: LazyPart(loader) for name, loader in (
+                ('model_pipeline', model.pipeline),
+                ('activity_features', model.activity_features),
+                ('activity_ids', model.activity_ids),
+                ('catalog', model.catalog)
+            )
+        }
+        
+        compiled_transform = model.compiled_transform()
+        if compiled_transform is None:
+            self._compile_transform()
+        else:
+            self._use_transform(compiled_transform)
+
+    def _load_model_pickle(self, filepath: str, attach_shared: bool) -> None:
+        """Load a model saved as a single joblib pickle."""
+        with stage('import'):
+            import joblib
+            # Unpickling the pipeline would import these anyway; doing it
+            # here keeps library import time out of the model_load stage
+            import sklearn.compose
+            import sklearn.feature_extraction.text
+            import sklearn.pipeline
+            import sklearn.preprocessing
+        
+        # Memory-map the pickled arrays when attaching so the private copy
+        # of the embeddings is never materialized
+        model_data = joblib.load(filepath, mmap_mode='r' if attach_shared else None)
+        
+        self.model_pipeline = model_data['pipeline']
+        self.activity_features = model_data['activity_features']
+        self.activity_embeddings = model_data['activity_embeddings']
+        self.activity_ids = model_data.get('activity_ids')
+        self.ann_index = model_data.get('ann_index')
+        self.catalog = model_data.get('catalog')
+        self.is_trained = model_data['is_trained']
+        self.model_metadata = model_data.get('metadata', {})
+        self.sparse_embeddings = bool(self.model_metadata.get('sparse_embeddings', False))
+        self.embedding_precision = self.model_metadata.get('embedding_precision', 'float64')
+        self._compile_transform()
+
+    def _embeddings_shareable(self) -> bool:
+        """Whether the embeddings are a dense array a shared memory segment can hold."""
+        return not self.sparse_embeddings and self.embedding_precision != 'int8'
+
+    def model_version_tag(self) -> str:
+        """Short tag identifying the trained model artifact (used to version shared segments)."""
+        identity = f"{self.model_metadata.get('trained_at')}:{self.model_metadata.get('activities_count')}"
+        if 'updated_at' in self.model_metadata:
+            identity += f":{self.model_metadata['updated_at']}"
+        return hashlib.sha1(identity.encode()).hexdigest()[:12]
+
+    def _publish_snapshot(self) -> None:
+        """
+        Make the engine's model, as it is now, the one new requests score with.
+        
+        Called once a train, update, load or embeddings move is complete;
+        requests already running finish on the snapshot they started with.
+        """
+        if not self.is_trained:
+            self._snapshot = None
+            return
+        
+        embeddings = self.activity_embeddings
+        catalog = self._parts.get('catalog') or LazyPart()
+        # The loader must not refer to the engine, which holds the snapshot
+        scoring_columns = self._catalog_scoring_columns
+        self._snapshot = ModelSnapshot(
+            version=self.model_version_tag(),
+            embeddings=embeddings,
+            sparse=self.sparse_embeddings,
+            precision=self.embedding_precision,
+            transform=self.compiled_transform,
+            pipeline=self._parts.get('model_pipeline') or LazyPart(),
+            ann_index=self.ann_index,
+            catalog=catalog,
+            catalog_columns=LazyPart(lambda: scoring_columns(embeddings, catalog.get()))
+        )
+
+    def publish_shared_embeddings(self) -> str:
+        """
+        Publish the embedding matrix into a named shared memory segment.
+        
+        The segment lives until release_shared_embeddings() is called or this
+        process exits. Publishing after a retrain creates a new segment next
+        to the old one. Returns the segment name.
+        """
+        from embedding_store import SharedEmbeddings, find_segment, register_segment
+        
+        if not self.is_trained:
+            raise ValueError("Cannot publish embeddings of an untrained model")
+        
+        version = self.model_version_tag()
+        if self.shared_embeddings is not None and self.shared_embeddings.version == version:
+            return self.shared_embeddings.name
+        
+        existing = find_segment(self.model_dir, version)
+        if existing is not None and self.attach_shared_embeddings(version):
+            logger.info(f"Embeddings for model {version} already published by pid {existing['publisher_pid']}")
+            return existing['name']
+        
+        previous = self.shared_embeddings
+        self.shared_embeddings = SharedEmbeddings.publish(self.activity_embeddings, version)
+        self.activity_embeddings = self.shared_embeddings.array
+        self._publish_snapshot()
+        register_segment(self.model_dir, self.shared_embeddings)
+        
+        # Segments this process published for older versions stay alive for
+        # attached readers until released explicitly
+        if previous is not None:
+            if previous.owner:
+                self.retired_shared_embeddings.append(previous)
+            else:
+                previous.release()
+        
+        return self.shared_embeddings.name
+
+    def attach_shared_embeddings(self, version: str = None) -> bool:
+        """
+        Replace the private embedding matrix with a zero-copy view of a
+        published segment for this model version. Returns False (keeping the
+        private copy) when no matching segment is available.
+        """
+        from embedding_store import SharedEmbeddings, find_segment
+        
+        version = version or self.model_version_tag()
+        entry = find_segment(self.model_dir, version)
+        if entry is None:
+            logger.warning(f"No shared embeddings published for model {version}; using a private copy")
+            return False
+        
+        try:
+            shared = SharedEmbeddings.attach(entry)
+        except FileNotFoundError:
+            logger.warning(f"Shared embeddings segment {entry['name']} no longer exists; using a private copy")
+            return False
+        
+        if self.shared_embeddings is not None and not self.shared_embeddings.owner:
+            self.shared_embeddings.release()
+        self.shared_embeddings = shared
+        self.activity_embeddings = shared.array
+        self._publish_snapshot()
+        return True
+
+    def release_shared_embeddings(self, retired_only: bool = False) -> None:
+        """
+        Detach from (and, as publisher, unlink) shared embeddings segments.
+        
+        With retired_only, only segments published for previous model
+        versions are released, once their readers have moved on. Requests
+        still scoring with a released segment's snapshot must have finished
+        (HotSwapEngine releases a replaced engine only once it is drained).
+        """
+        from embedding_store import unregister_segment
+        
+        released = self.retired_shared_embeddings
+        self.retired_shared_embeddings = []
+        
+        if not retired_only and self.shared_embeddings is not None:
+            self.activity_embeddings = self.shared_embeddings.array.copy()
+            released.append(self.shared_embeddings)
+            self.shared_embeddings = None
+            self._publish_snapshot()
+        
+        for shared in released:
+            shared.release()
+            if shared.owner:
+                unregister_segment(self.model_dir, shared.version)
+
+    def warm_up(self) -> None:
+        """Import the libraries used at request time ahead of the first request."""
+        import numpy
+        import pandas
+        import scipy.sparse
+        
+        logger.debug("Request-time ML dependencies imported")
+
+    def memory_bytes(self) -> int:
+        """
+        Approximate memory held by the loaded model: embedding, index and
+        feature arrays (memory-mapped ones included, as scoring pages them
+        in) and, once loaded, the catalog. Cheap enough to call per request.
+        """
+        total = 0
+        embeddings = self.activity_embeddings
+        if embeddings is not None:
+            if hasattr(embeddings, 'indptr'):
+                total += embeddings.data.nbytes + embeddings.indices.nbytes + embeddings.indptr.nbytes
+            else:
+                total += embeddings.nbytes
+        if self.ann_index is not None:
+            total += sum(part.nbytes for part in (self.ann_index.planes, self.ann_index.sorted_codes, self.ann_index.order))
+        
+        # Deferred parts count once something has loaded them
+        loaded = {name: part.peek() for name, part in self._parts.items()}
+        features = loaded.get('activity_features')
+        if features is not None:
+            total += int(features.memory_usage(index=False).sum())
+        catalog = loaded.get('catalog')
+        if isinstance(catalog, ColumnarActivities):
+            total += catalog.table.nbytes
+        elif catalog:
+            # Estimated from a sample of rows (dict plus its values), once per catalog
+            cached = self._catalog_bytes
+            if cached is None or cached[:2] != (id(catalog), len(catalog)):
+                sample = catalog[::max(1, len(catalog) // 100)]
+                row_bytes = sum(sys.getsizeof(row) + sum(map(sys.getsizeof, row.values())) for row in sample)
+                cached = self._catalog_bytes = (id(catalog), len(catalog), row_bytes * len(catalog) // len(sample))
+            total += cached[2]
+        return total
 
     def get_model_info(self) -> Dict[str, Any]:
         """Get information about the current model."""
@@ -406,8 +1467,13 @@ class ActivityRecommendationEngine:
             'status': 'trained',
             'metadata': self.model_metadata,
             'feature_matrix_shape': self.activity_embeddings.shape if self.activity_embeddings is not None else None,
-            'model_file': str(self.model_file),
-            'model_file_exists': self.model_file.exists()
+            'sparse_embeddings': self.sparse_embeddings,
+            'embedding_precision': self.embedding_precision,
+            'ann_index': self.ann_index.params() if self.ann_index is not None else None,
+            'catalog_size': self.ann_index.n_rows if self.ann_index is not None else None,
+            'model_file': str(self.model_path if self.model_path.exists() else self.model_file),
+            'model_file_exists': self.has_saved_model(),
+            'embedding_cache': self.embedding_cache.stats() if self.embedding_cache is not None else None
         }
 
 def generate_ai_explanation(activity, user_profile, decision_factors=None):
@@ -1472,6 +2538,8 @@ def _apply_general_tip(itinerary, tip):
 
 class RecommendationEngine:
     def __init__(self):
+        from prisma import PrismaClient
+        
         self.prisma = PrismaClient()
         
     def create_user_profile_hash(self, user_characteristics: Dict[str, Any]) -> str:
@@ -2008,154 +3076,664 @@ class RecommendationEngine:
             logger.error(f"Error generating recommendation explanation: {e}")
             return "Recommended based on traveler insights"
 
-def main():
+def load_engine(model_dir: str = "models", shared_embeddings: Optional[str] = None,
+                embedding_cache_size: int = DEFAULT_CACHE_SIZE, **training_options) -> ActivityRecommendationEngine:
     """
-    CLI interface for the recommendation engine.
-    Expects JSON input via stdin and outputs JSON recommendations.
+    Create an engine and load the persisted model when one exists.
+    
+    shared_embeddings is "publish" or "attach" to share the embedding matrix
+    with other engine processes on the host through shared memory.
+    training_options (sparse_embeddings, embedding_precision, ann_index, hashed_features) apply
+    to models this engine trains.
     """
-    try:
-        # Read input from stdin
-        input_data = json.loads(sys.stdin.read())
+    engine = ActivityRecommendationEngine(model_dir, embedding_cache_size=embedding_cache_size, **training_options)
+    
+    # Check if model exists and load it
+    if engine.has_saved_model():
+        try:
+            with stage('model_load'):
+                engine.load_model(
+                    publish_shared=shared_embeddings == 'publish',
+                    attach_shared=shared_embeddings == 'attach'
+                )
+            logger.info("Loaded existing model")
+        except Exception as e:
+            logger.warning(f"Failed to load existing model: {e}")
+    
+    return engine
+
+def ann_index_params(option: Any) -> Optional[Dict[str, int]]:
+    """
+    RandomProjectionIndex.build parameters from a request's "ann_index"
+    option: true for the defaults, an object with n_tables/n_bits, or false.
+    """
+    if not option:
+        return None
+    if option is True:
+        return {}
+    if not isinstance(option, dict) or set(option) - {'n_tables', 'n_bits', 'seed'}:
+        raise ValueError('"ann_index" must be true or an object with "n_tables" and/or "n_bits"')
+    return {name: int(value) for name, value in option.items()}
+
+def hashed_features_params(option: Any) -> Optional[Dict[str, int]]:
+    """
+    HashedStreamingTrainer bucket counts from a request's "hashed_features"
+    option: true for the defaults, an object with n_type_buckets/n_text_buckets, or false.
+    """
+    if not option:
+        return None
+    if option is True:
+        return {}
+    if not isinstance(option, dict) or set(option) - {'n_type_buckets', 'n_text_buckets'}:
+        raise ValueError('"hashed_features" must be true or an object with "n_type_buckets" and/or "n_text_buckets"')
+    return {name: int(value) for name, value in option.items()}
+
+def needs_engine(input_data: Dict[str, Any]) -> bool:
+    """Whether a request uses the ML model (and therefore the ML libraries)."""
+    if isinstance(input_data.get('batch'), list):
+        return any(isinstance(item, dict) and needs_engine(item) for item in input_data['batch'])
+    return any(mode in input_data for mode in MODEL_MODES)
+
+def decode_requests(raw: Any, wire_format: str = 'json') -> Dict[str, Any]:
+    """
+    Decode CLI input into a single request.
+    
+    Accepts one document, an array of requests, or a stream of
+    newline-delimited (or concatenated) documents, as JSON or MessagePack.
+    Arrays and streams are wrapped in a {"batch": [...]} envelope.
+    """
+    if wire_format == 'msgpack':
+        from engine_io import decode_msgpack_requests
         
-        # Initialize engine
-        engine = ActivityRecommendationEngine()
+        documents = decode_msgpack_requests(raw)
+    else:
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        
+        decoder = json.JSONDecoder()
+        documents = []
+        position = 0
+        length = len(raw)
+        
+        while True:
+            while position < length and raw[position].isspace():
+                position += 1
+            if position >= length:
+                break
+            document, position = decoder.raw_decode(raw, position)
+            documents.append(document)
+    
+    if not documents:
+        raise ValueError("No request provided on stdin")
+    
+    if len(documents) > 1:
+        return {'batch': documents}
+    if isinstance(documents[0], list):
+        return {'batch': documents[0]}
+    return documents[0]
+
+def encode_response(result: Dict[str, Any], wire_format: str = 'json', pretty: bool = False) -> bytes:
+    """Encode a CLI response in the requested wire format (compact JSON by default)."""
+    if wire_format == 'msgpack':
+        from engine_io import encode_msgpack
         
-        # Check if model exists and load it
-        if engine.model_file.exists():
+        return encode_msgpack(result)
+    return encode_json(result, pretty=pretty) + b'\n'
+
+def handle_batch(requests: List[Any], engine: Optional[ActivityRecommendationEngine] = None) -> Dict[str, Any]:
+    """
+    Run a batch of requests in order within one process.
+    
+    Each item gets its own status, so one failing item does not fail the
+    batch. Results carry the item's position as "index" and echo its "id".
+    """
+    start_time = datetime.now()
+    results = []
+    failed = 0
+    
+    for index, request in enumerate(requests):
+        if not isinstance(request, dict):
+            item = {'status': 'error', 'message': 'Batch items must be JSON objects'}
+        elif 'batch' in request:
+            item = {'status': 'error', 'message': 'Nested batches are not supported'}
+        else:
             try:
-                engine.load_model()
-                logger.info("Loaded existing model")
+                item = handle_request(request, engine)
             except Exception as e:
-                logger.warning(f"Failed to load existing model: {e}")
-        
-        # Process request
-        if 'train' in input_data:
-            # Training mode
-            activities = input_data['activities']
-            force_retrain = input_data.get('force_retrain', False)
-            engine.train_content_based_model(activities, force_retrain)
-            
-            result = {
-                'status': 'success',
-                'message': 'Model trained successfully',
-                'model_info': engine.get_model_info()
-            }
-            
-        elif 'recommend' in input_data:
-            # Recommendation mode
-            user_profile = input_data['user_profile']
-            activities = input_data['activities']
-            top_n = input_data.get('top_n', 5)
-            
+                logger.error(f"Error in batch item {index}: {e}")
+                item = {'status': 'error', 'message': str(e)}
+        
+        if item.get('status') != 'success':
+            failed += 1
+        
+        item = dict(item, index=index)
+        if isinstance(request, dict) and 'id' in request:
+            item['id'] = request['id']
+        results.append(item)
+    
+    duration = (datetime.now() - start_time).total_seconds()
+    logger.info(f"Processed batch of {len(results)} requests ({failed} failed) in {duration:.3f}s")
+    
+    return {
+        'status': 'success',
+        'count': len(results),
+        'failed': failed,
+        'results': results
+    }
+
+def handle_request(input_data: Dict[str, Any], engine: Optional[ActivityRecommendationEngine] = None) -> Dict[str, Any]:
+    """
+    Process a single engine request and return the response payload.
+    
+    Shared by the one-shot CLI and the resident server so both expose the
+    same modes with the same response shapes. The engine is only required
+    for MODEL_MODES; pure-Python modes run without it.
+    
+    With "timings": true the response carries a per-stage "timings" block
+    in milliseconds. Requests handled inside an already timed run (a batch
+    item, or the CLI which also times parsing and model loading) record
+    into that run's timer instead.
+    """
+    if current_timer() is not None:
+        return _dispatch_request(input_data, engine)
+    
+    timer = StageTimer()
+    with activate(timer):
+        result = _dispatch_request(input_data, engine)
+    
+    if input_data.get('timings'):
+        result = dict(result, timings=timer.as_dict())
+    return result
+
+def _dispatch_request(input_data: Dict[str, Any], engine: Optional[ActivityRecommendationEngine]) -> Dict[str, Any]:
+    # Activity lists may arrive as Arrow IPC tables
+    with stage('parse'):
+        resolve_activity_payloads(input_data)
+    
+    # A hot-swapped engine builds model changes in the background and serves
+    # everything else from its current engine, which stays alive until done
+    if isinstance(engine, HotSwapEngine) and 'batch' not in input_data and needs_engine(input_data):
+        if any(mode in input_data for mode in REBUILD_MODES):
+            return engine.start_rebuild(input_data)
+        live = engine
+        with live.acquire() as engine:
+            result = _dispatch_request(input_data, engine)
+        if 'info' in input_data:
+            result['rebuild'] = live.status()
+        return result
+    
+    # A resident server builds a shard's model changes in the background
+    if (isinstance(engine, DestinationShards) and engine.background_rebuilds and 'batch' not in input_data
+            and any(mode in input_data for mode in REBUILD_MODES)):
+        return engine.start_rebuild(input_data)
+    
+    # Model requests of a sharded engine go to their destination's model
+    shards = None
+    if isinstance(engine, DestinationShards) and 'batch' not in input_data and needs_engine(input_data):
+        shards = engine
+        with stage('model_load'):
+            engine = shards.engine_for(input_data.get('destination'), create='train' in input_data)
+    
+    if 'batch' in input_data:
+        # Batch mode: many requests in one invocation
+        if not isinstance(input_data['batch'], list):
+            raise ValueError('"batch" must be a list of requests')
+        result = handle_batch(input_data['batch'], engine)
+        
+    elif 'train' in input_data:
+        # Training mode
+        activities = input_data['activities']
+        force_retrain = input_data.get('force_retrain', False)
+        if 'sparse_embeddings' in input_data:
+            engine.sparse_embeddings = bool(input_data['sparse_embeddings'])
+        if 'embedding_precision' in input_data:
+            engine.embedding_precision = check_precision(input_data['embedding_precision'])
+        if 'ann_index' in input_data:
+            engine.ann_index_params = ann_index_params(input_data['ann_index'])
+        if 'hashed_features' in input_data:
+            engine.hashed_features = hashed_features_params(input_data['hashed_features'])
+        engine.train_content_based_model(activities, force_retrain)
+        
+        result = {
+            'status': 'success',
+            'message': 'Model trained successfully',
+            'model_info': engine.get_model_info()
+        }
+        
+    elif 'update' in input_data:
+        # Incremental update of the trained model
+        update = engine.update_model(
+            input_data.get('activities', []),
+            input_data.get('removed_ids', []),
+            float(input_data.get('drift_threshold', DEFAULT_DRIFT_THRESHOLD))
+        )
+        
+        result = {
+            'status': 'success',
+            'message': 'Model refit after drift' if update['refit'] else 'Model updated',
+            'update': update,
+            'model_info': engine.get_model_info()
+        }
+        
+    elif 'recommend' in input_data:
+        # Recommendation mode (without activities: from the model's catalog)
+        user_profile = input_data['user_profile']
+        activities = input_data.get('activities')
+        top_n = input_data.get('top_n', 5)
+        
+        if activities is None:
+            recommendations = engine.get_catalog_recommendations(
+                user_profile, top_n, probes=input_data.get('ann_probes', DEFAULT_PROBES)
+            )
+        else:
             recommendations = engine.get_personalized_recommendations(user_profile, activities, top_n)
-            
-            result = {
-                'status': 'success',
-                'recommendations': [
+        
+        result = {
+            'status': 'success',
+            'recommendations': [
+                {
+                    'activity': activity,
+                    'score': score
+                }
+                for activity, score in recommendations
+            ]
+        }
+        
+    elif 'multi_recommend' in input_data:
+        # Recommendations for several users over the same activities
+        user_profiles = input_data['user_profiles']
+        activities = input_data['activities']
+        top_n = input_data.get('top_n', 5)
+        
+        if not isinstance(user_profiles, list):
+            raise ValueError('"user_profiles" must be a list of user profiles')
+        
+        per_user = engine.get_batch_recommendations(user_profiles, activities, top_n)
+        
+        result = {
+            'status': 'success',
+            'recommendations': [
+                [
                     {
                         'activity': activity,
-                        'score': float(score)
+                        'score': score
                     }
                     for activity, score in recommendations
                 ]
-            }
-            
-        elif 'explain' in input_data:
-            # Explanation mode
-            activity = input_data['activity']
-            user_profile = input_data['user_profile']
-            decision_factors = input_data.get('decision_factors', {})
-            
+                for recommendations in per_user
+            ]
+        }
+        
+    elif 'explain' in input_data:
+        # Explanation mode
+        activity = input_data['activity']
+        user_profile = input_data['user_profile']
+        decision_factors = input_data.get('decision_factors', {})
+        
+        with stage('explain'):
             explanation = generate_ai_explanation(activity, user_profile, decision_factors)
-            
-            result = {
-                'status': 'success',
-                'explanation': explanation
-            }
-            
-        elif 'summary' in input_data:
-            # Summary mode
-            user_profile = input_data['user_profile']
-            destination = input_data['destination']
-            total_activities = input_data['total_activities']
-            data_points = input_data.get('data_points', None)
-            
+        
+        result = {
+            'status': 'success',
+            'explanation': explanation
+        }
+        
+    elif 'summary' in input_data:
+        # Summary mode
+        user_profile = input_data['user_profile']
+        destination = input_data['destination']
+        total_activities = input_data['total_activities']
+        data_points = input_data.get('data_points', None)
+        
+        with stage('summary'):
             summary = generate_itinerary_summary(user_profile, destination, total_activities, data_points)
-            
-            result = {
-                'status': 'success',
-                'summary': summary
-            }
-            
-        elif 'health_score' in input_data:
-            # Health scoring mode
-            itinerary = input_data['itinerary']
-            user_profile = input_data['user_profile']
-            
+        
+        result = {
+            'status': 'success',
+            'summary': summary
+        }
+        
+    elif 'health_score' in input_data:
+        # Health scoring mode
+        itinerary = input_data['itinerary']
+        user_profile = input_data['user_profile']
+        
+        with stage('health_score'):
             health_score = calculate_itinerary_health_score(itinerary, user_profile)
-            
-            result = {
-                'status': 'success',
-                'health_score': health_score
-            }
-            
-        elif 'auto_optimize' in input_data:
-            # Auto-optimization mode
-            itinerary = input_data['itinerary']
-            user_profile = input_data['user_profile']
-            available_activities = input_data['available_activities']
-            max_iterations = input_data.get('max_iterations', 5)
-            
+        
+        result = {
+            'status': 'success',
+            'health_score': health_score
+        }
+        
+    elif 'auto_optimize' in input_data:
+        # Auto-optimization mode
+        itinerary = input_data['itinerary']
+        user_profile = input_data['user_profile']
+        available_activities = input_data['available_activities']
+        max_iterations = input_data.get('max_iterations', 5)
+        
+        with stage('optimize'):
             optimization_result = auto_optimize(itinerary, user_profile, available_activities, max_iterations)
-            
-            result = {
-                'status': 'success',
-                'optimization_result': optimization_result
-            }
-            
-        elif 'proactive_tips' in input_data:
-            # Proactive tips mode
-            itinerary = input_data['itinerary']
-            user_profile = input_data['user_profile']
-            weather_forecast = input_data.get('weather_forecast', None)
-            
+        
+        result = {
+            'status': 'success',
+            'optimization_result': optimization_result
+        }
+        
+    elif 'proactive_tips' in input_data:
+        # Proactive tips mode
+        itinerary = input_data['itinerary']
+        user_profile = input_data['user_profile']
+        weather_forecast = input_data.get('weather_forecast', None)
+        
+        with stage('proactive_tips'):
             tips = generate_proactive_tips(itinerary, user_profile, weather_forecast)
-            
-            result = {
-                'status': 'success',
-                'proactive_tips': tips
-            }
-            
-        elif 'apply_tip' in input_data:
-            # Apply tip mode
-            itinerary = input_data['itinerary']
-            user_profile = input_data['user_profile']
-            tip = input_data['tip']
-            
-            # Apply the tip to the itinerary
+        
+        result = {
+            'status': 'success',
+            'proactive_tips': tips
+        }
+        
+    elif 'apply_tip' in input_data:
+        # Apply tip mode
+        itinerary = input_data['itinerary']
+        user_profile = input_data['user_profile']
+        tip = input_data['tip']
+        
+        # Apply the tip to the itinerary
+        with stage('apply_tip'):
             modified_itinerary = apply_tip_to_itinerary(itinerary, tip, user_profile)
-            
-            result = {
-                'status': 'success',
-                'modified_itinerary': modified_itinerary,
-                'applied_tip': tip
-            }
+        
+        result = {
+            'status': 'success',
+            'modified_itinerary': modified_itinerary,
+            'applied_tip': tip
+        }
 
-        elif 'info' in input_data:
-            # Info mode
-            result = {
-                'status': 'success',
-                'model_info': engine.get_model_info()
-            }
-            
+    elif 'info' in input_data:
+        # Info mode
+        result = {
+            'status': 'success',
+            'model_info': engine.get_model_info()
+        }
+        if shards is not None:
+            result['shards'] = dict(shards.stats(), destinations=shards.destinations())
+        
+    else:
+        result = {
+            'status': 'error',
+            'message': 'Invalid request. Use "batch", "train", "update", "recommend", "multi_recommend", "explain", "summary", "health_score", "auto_optimize", "proactive_tips", "apply_tip", or "info"'
+        }
+    
+    return result
+
+# Fields of a streamed train request that configure training; they are only
+# seen in time when they come before the activities array
+STREAM_TRAIN_OPTIONS = ('force_retrain', 'sparse_embeddings', 'embedding_precision', 'ann_index',
+                        'hashed_features', 'destination')
+
+def handle_streaming_request(stream, model_dir: str = "models", chunk_size: int = 5000,
+                             destination_shards: bool = False, **training_options) -> Dict[str, Any]:
+    """
+    Process a request read incrementally from a binary stream.
+    
+    Meant for large "train" requests: activities are parsed one at a time
+    and fed to feature extraction in chunks while the rest of the payload is
+    still arriving. Requests whose mode is not known to be "train" before
+    the activities array starts are collected and handled normally.
+    With destination_shards, a "destination" in the header selects the
+    shard that is trained.
+    
+    Training options (STREAM_TRAIN_OPTIONS) must come before the array: one
+    found after it fails the request before the model is saved.
+    """
+    from engine_io import StreamingJsonRequest
+    
+    request = StreamingJsonRequest(stream)
+    with stage('parse'):
+        # Copied: the request adds the fields after the array to its own dict
+        header = dict(request.read_header())
+    
+    if 'train' not in header:
+        with stage('parse'):
+            activities = list(request.items())
+        input_data = dict(request.fields)
+        # A request without the array (e.g. a catalog recommend) keeps going without activities
+        if request.array_found:
+            input_data['activities'] = activities
+        engine = None
+        if destination_shards and needs_engine(input_data):
+            engine = DestinationShards(model_dir, **training_options)
+        elif needs_engine(input_data):
+            engine = load_engine(model_dir, **training_options)
+        return handle_request(input_data, engine)
+    
+    if destination_shards and header.get('destination') is not None:
+        model_dir = str(shard_path(model_dir, header['destination']))
+        Path(model_dir).mkdir(parents=True, exist_ok=True)
+    if 'sparse_embeddings' in header:
+        training_options['sparse_embeddings'] = bool(header['sparse_embeddings'])
+    if 'embedding_precision' in header:
+        training_options['embedding_precision'] = check_precision(header['embedding_precision'])
+    if 'ann_index' in header:
+        training_options['ann_index'] = ann_index_params(header['ann_index'])
+    if 'hashed_features' in header:
+        training_options['hashed_features'] = hashed_features_params(header['hashed_features'])
+    
+    def activities():
+        yield from request.items()
+        late = [key for key in STREAM_TRAIN_OPTIONS if key in request.fields and key not in header]
+        if late:
+            raise ValueError(f'Training options must come before "activities" in a streamed request: '
+                             f'move {", ".join(late)} ahead of the array')
+    
+    engine = load_engine(model_dir, **training_options)
+    items = activities()
+    count = engine.train_from_stream(items, force_retrain=header.get('force_retrain', False), chunk_size=chunk_size)
+    if count == 0:
+        # The recent model was kept without reading the activities; they may still carry options
+        with stage('parse'):
+            for _ in items:
+                pass
+        return {
+            'status': 'success',
+            'message': 'Existing model is recent and was not retrained (set "force_retrain" to retrain)',
+            'activities_streamed': 0,
+            'model_info': engine.get_model_info()
+        }
+    
+    return {
+        'status': 'success',
+        'message': 'Model trained successfully',
+        'activities_streamed': count,
+        'model_info': engine.get_model_info()
+    }
+
+def _handle_timed_request(input_data: Dict[str, Any], engine: Optional[ActivityRecommendationEngine] = None) -> Dict[str, Any]:
+    """Server handler used with --timings: every response reports its stage timings."""
+    return handle_request(dict(input_data, timings=True), engine)
+
+def _parse_args(argv: Optional[List[str]] = None):
+    """Parse CLI flags. Without flags the engine handles one JSON request from stdin."""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="TripWeaver activity recommendation engine")
+    parser.add_argument('--serve', action='store_true',
+                        help='Keep the engine resident and serve newline-delimited JSON requests')
+    parser.add_argument('--socket', metavar='PATH',
+                        help='Serve on a Unix socket at PATH instead of stdin/stdout (requires --serve)')
+    parser.add_argument('--workers', type=int, default=0, metavar='N',
+                        help='Serve from N pre-forked worker processes sharing the loaded model (with --serve), '
+                             'or train shards in N processes (with --train-destinations)')
+    parser.add_argument('--threads', type=int, default=1, metavar='N',
+                        help='Score up to N requests at once in the server process (with --serve, without --workers)')
+    parser.add_argument('--max-queue', type=int, default=64, metavar='N',
+                        help='Requests allowed to wait per priority lane before new ones are rejected (with --serve)')
+    parser.add_argument('--embedding-cache-size', type=int, default=DEFAULT_CACHE_SIZE, metavar='N',
+                        help='Activity embedding rows kept for reuse across requests (0 disables the cache)')
+    parser.add_argument('--sparse-embeddings', action='store_true',
+                        help='Train models that keep activity embeddings in sparse CSR form')
+    parser.add_argument('--embedding-precision', choices=EMBEDDING_PRECISIONS, default='float64',
+                        help='Store and score activity embeddings at this precision (int8: per-dimension '
+                             'scalar quantization, dense embeddings only)')
+    parser.add_argument('--ann-index', action='store_true',
+                        help='Keep the training activities as a catalog with an ANN index, so recommend '
+                             'requests without "activities" rank the catalog')
+    parser.add_argument('--ann-tables', type=int, default=DEFAULT_TABLES, metavar='N',
+                        help='LSH tables in the ANN index (more: higher recall, slower queries)')
+    parser.add_argument('--ann-bits', type=int, default=DEFAULT_BITS, metavar='N',
+                        help='Hyperplanes per LSH table (more: smaller buckets, faster queries, lower recall)')
+    parser.add_argument('--hashed-features', action='store_true',
+                        help='Train out of core with hashed type and term features, writing embeddings '
+                             'chunk by chunk (for catalogs too large to fit in memory; use with --stream)')
+    parser.add_argument('--hash-type-buckets', type=int, default=DEFAULT_TYPE_BUCKETS, metavar='N',
+                        help='Columns the primary type is hashed into (with --hashed-features)')
+    parser.add_argument('--hash-text-buckets', type=int, default=DEFAULT_TEXT_BUCKETS, metavar='N',
+                        help='Columns type-list terms are hashed into (with --hashed-features)')
+    parser.add_argument('--shared-embeddings', choices=('publish', 'attach'),
+                        help='Publish the embeddings to (or attach to them in) host shared memory')
+    parser.add_argument('--format', choices=('json', 'msgpack'), default='json',
+                        help='Wire format for requests and responses (msgpack is length-prefixed when serving)')
+    parser.add_argument('--timings', action='store_true',
+                        help='Add a per-stage "timings" block to every response (requests can also set "timings": true)')
+    parser.add_argument('--pretty', action='store_true',
+                        help='Indent JSON responses for reading (responses are compact by default)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Parse a large train request incrementally, extracting features while it arrives')
+    parser.add_argument('--destination-shards', action='store_true',
+                        help='Keep one model per destination; model requests pick one with "destination" '
+                             'and shards load on first use')
+    parser.add_argument('--shard-memory-mb', type=float, default=DEFAULT_MEMORY_BUDGET_MB, metavar='MB',
+                        help='Memory the loaded destination shards may use before the least recently '
+                             'used are dropped (with --destination-shards)')
+    parser.add_argument('--train-destinations', metavar='PATH',
+                        help='Train the destination shards of PATH (a directory of per-destination JSON/NDJSON '
+                             'activity files, or an NDJSON file of activities with "destination") in parallel '
+                             'across --workers processes')
+    parser.add_argument('--model-dir', default='models', help='Directory holding the trained model')
+    
+    args = parser.parse_args(argv)
+    if args.socket and not args.serve:
+        parser.error('--socket requires --serve')
+    if args.workers and not (args.serve or args.train_destinations):
+        parser.error('--workers requires --serve or --train-destinations')
+    if args.workers < 0:
+        parser.error('--workers must be positive')
+    if args.threads < 1:
+        parser.error('--threads must be at least 1')
+    if args.threads > 1 and (args.workers or not args.serve):
+        parser.error('--threads requires --serve without --workers')
+    if args.max_queue < 1:
+        parser.error('--max-queue must be at least 1')
+    if args.ann_tables < 1 or not 1 <= args.ann_bits <= 62:
+        parser.error('--ann-tables must be at least 1 and --ann-bits between 1 and 62')
+    if args.embedding_precision == 'int8' and args.sparse_embeddings:
+        parser.error('--embedding-precision int8 needs dense embeddings (drop --sparse-embeddings)')
+    if args.hashed_features and (args.sparse_embeddings or args.embedding_precision == 'int8' or args.ann_index):
+        parser.error('--hashed-features trains dense float64 or float32 embeddings without an ANN index')
+    if args.hash_type_buckets < 1 or args.hash_text_buckets < 1:
+        parser.error('--hash-type-buckets and --hash-text-buckets must be at least 1')
+    if args.destination_shards and args.shared_embeddings:
+        parser.error('--shared-embeddings does not apply to --destination-shards')
+    if args.shard_memory_mb <= 0:
+        parser.error('--shard-memory-mb must be positive')
+    if args.stream and (args.serve or args.format != 'json'):
+        parser.error('--stream only applies to one-shot JSON requests')
+    if args.train_destinations and (args.serve or args.stream):
+        parser.error('--train-destinations cannot be combined with --serve or --stream')
+    return args
+
+def main(argv: Optional[List[str]] = None):
+    """
+    CLI interface for the recommendation engine.
+    Expects JSON input via stdin and outputs JSON recommendations. Several
+    requests can be sent at once as a JSON array, an NDJSON stream or a
+    {"batch": [...]} envelope; they are answered in order in one response.
+    
+    With --serve the engine stays resident and answers newline-delimited
+    JSON requests on stdin/stdout (or a Unix socket with --socket). Adding
+    --workers N forks N processes that share the loaded model. Without it,
+    --threads N scores up to N requests at once in the server process, and
+    train and update requests are built in the background and the new model
+    is swapped in atomically (see model_swap).
+    
+    --train-destinations PATH retrains per-destination shards in parallel
+    (--workers N processes, one per CPU by default) and reports per-shard timings.
+    """
+    args = _parse_args(argv)
+    _configure_logging()
+    training_options = {
+        'sparse_embeddings': args.sparse_embeddings,
+        'embedding_precision': args.embedding_precision,
+        'ann_index': {'n_tables': args.ann_tables, 'n_bits': args.ann_bits} if args.ann_index else None,
+        'hashed_features': {'n_type_buckets': args.hash_type_buckets,
+                            'n_text_buckets': args.hash_text_buckets} if args.hashed_features else None
+    }
+    
+    def make_engine(shared_embeddings: Optional[str] = None):
+        if args.destination_shards:
+            return DestinationShards(args.model_dir, args.shard_memory_mb, background_rebuilds=args.serve,
+                                     embedding_cache_size=args.embedding_cache_size, **training_options)
+        return load_engine(args.model_dir, shared_embeddings, args.embedding_cache_size, **training_options)
+    
+    if args.serve:
+        from engine_server import EngineServer
+        
+        if args.workers or args.destination_shards:
+            # Shards build their train and update requests in the background themselves
+            engine = make_engine(args.shared_embeddings)
         else:
-            result = {
-                'status': 'error',
-                'message': 'Invalid request. Use "train", "recommend", "explain", "summary", "health_score", "auto_optimize", "proactive_tips", "apply_tip", or "info"'
-            }
+            # Train and update requests are built in the background and swapped in
+            engine = HotSwapEngine(lambda: make_engine(args.shared_embeddings), args.model_dir, training_options)
+        if args.workers:
+            # Import in the parent so forked workers inherit the modules too
+            engine.warm_up()
+        
+        handler = _handle_timed_request if args.timings else handle_request
+        server = EngineServer(engine, handler, workers=args.workers, wire_format=args.format,
+                              max_queue=args.max_queue, threads=args.threads)
+        try:
+            if args.socket:
+                server.serve_unix_socket(args.socket)
+            else:
+                server.serve_stdio()
+        finally:
+            server.close()
+            engine.release_shared_embeddings()
+        return
+    
+    timer = StageTimer()
+    report_timings = args.timings
+    try:
+        with activate(timer):
+            if args.train_destinations:
+                result = train_destination_shards(args.model_dir, args.train_destinations,
+                                                  args.workers or None, **training_options)
+            elif args.stream:
+                result = handle_streaming_request(sys.stdin.buffer, args.model_dir,
+                                                  destination_shards=args.destination_shards, **training_options)
+            else:
+                # Read input from stdin (a single request, an array or a stream of requests)
+                with stage('parse'):
+                    input_data = decode_requests(sys.stdin.buffer.read(), args.format)
+                report_timings = report_timings or bool(input_data.get('timings'))
+                
+                # Initialize engine only for modes that use the model
+                engine = make_engine() if needs_engine(input_data) else None
+                
+                # Process request
+                result = handle_request(input_data, engine)
+        
+        if report_timings:
+            result = dict(result, timings=timer.as_dict())
         
         # Output result
-        print(json.dumps(result, indent=2))
+        sys.stdout.buffer.write(encode_with_timings(
+            result, lambda payload: encode_response(payload, args.format, args.pretty),
+            json_output=args.format == 'json' and not args.pretty
+        ))
+        sys.stdout.flush()
         
     except Exception as e:
         logger.error(f"Error in main: {e}")
@@ -2163,7 +3741,8 @@ def main():
             'status': 'error',
             'message': str(e)
         }
-        print(json.dumps(result, indent=2))
+        sys.stdout.buffer.write(encode_response(result, args.format, args.pretty))
+        sys.stdout.flush()
         sys.exit(1)
 
 if __name__ == '__main__':
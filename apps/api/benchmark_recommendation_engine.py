@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the ML recommendation engine.
+
+Each subcommand builds a synthetic catalog of activities, runs the code path
+it measures a few times and prints the best timings.
+
+    python3 benchmark_recommendation_engine.py encoder --activities 5000
+    python3 benchmark_recommendation_engine.py transform --candidates 20 200 5000
+    python3 benchmark_recommendation_engine.py multi --users 50 --candidates 2000
+    python3 benchmark_recommendation_engine.py model-size --activities 100000 --cities 400
+    python3 benchmark_recommendation_engine.py ann --catalog 100000 --tables 8 16 --bits 6 8 --probes 0 2 8
+    python3 benchmark_recommendation_engine.py precision --catalog 100000 --held-out 5000
+    python3 benchmark_recommendation_engine.py update --catalog 100000 --changes 300
+    python3 benchmark_recommendation_engine.py shards --cities 20 --per-city 5000
+    python3 benchmark_recommendation_engine.py parallel-train --cities 16 --per-city 10000 --workers 1 4
+    python3 benchmark_recommendation_engine.py out-of-core --catalog 100000 400000 1600000
+    python3 benchmark_recommendation_engine.py hot-swap --catalog 100000 --candidates 200
+    python3 benchmark_recommendation_engine.py threads --catalog 20000 --candidates 200 --threads 1 4 16
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Add the ai directory to the path
+sys.path.append(os.path.join(os.path.dirname(__file__), 'ai'))
+
+PLACE_TYPES = [
+    ['restaurant', 'food', 'establishment'],
+    ['cafe', 'food', 'establishment'],
+    ['museum', 'tourist_attraction', 'establishment'],
+    ['art_gallery', 'point_of_interest'],
+    ['park', 'tourist_attraction'],
+    ['night_club', 'bar', 'establishment'],
+    ['shopping_mall', 'store', 'establishment'],
+    ['church', 'place_of_worship', 'tourist_attraction'],
+    ['amusement_park', 'tourist_attraction'],
+    ['zoo', 'tourist_attraction'],
+]
+
+USER_PROFILE = {
+    'interests': ['art', 'food', 'culture'],
+    'budget': 2,
+    'pace': 'moderate',
+    'group_size': 2
+}
+
+
+def synthetic_activities(count, seed=7):
+    """Generate a reproducible catalog of Google Places-like activities."""
+    rng = random.Random(seed)
+    activities = []
+    for i in range(count):
+        activity = {
+            'place_id': f'place_{i}',
+            'name': f'Activity {i}',
+            'types': rng.choice(PLACE_TYPES),
+            'rating': round(rng.uniform(2.5, 5.0), 1),
+            'user_ratings_total': rng.randint(0, 20000),
+            'vicinity': f'{rng.randint(1, 200)} Example Street',
+        }
+        if rng.random() < 0.8:
+            activity['price_level'] = rng.randint(0, 4)
+        if rng.random() < 0.7:
+            activity['photo_reference'] = f'photo_{i}'
+        activities.append(activity)
+    return activities
+
+
+def trained_engine(activities):
+    from recommendation_engine import ActivityRecommendationEngine
+
+    engine = ActivityRecommendationEngine(model_dir=tempfile.mkdtemp(prefix='tw-bench-'))
+    engine.train_content_based_model(activities, force_retrain=True)
+    return engine
+
+
+def best_of(repeat, fn):
+    """Best wall time of `repeat` runs, and the last result."""
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def random_profiles(count, seed=11):
+    interests = ['art', 'food', 'culture', 'outdoors', 'entertainment', 'shopping', 'park']
+    rng = random.Random(seed)
+    return [
+        {'interests': rng.sample(interests, rng.randint(1, 3)), 'budget': rng.randint(0, 4),
+         'pace': rng.choice(['relaxed', 'moderate', 'fast'])}
+        for _ in range(count)
+    ]
+
+
+def bench_encoder(args):
+    """Compare the previous indented json.dumps output with encode_json."""
+    from engine_io import encode_json, orjson
+
+    activities = synthetic_activities(args.activities)
+    engine = trained_engine(activities)
+    recommendations = engine.get_personalized_recommendations(USER_PROFILE, activities, top_n=len(activities))
+    response = {
+        'status': 'success',
+        'recommendations': [
+            {'activity': activity, 'score': score}
+            for activity, score in recommendations
+        ]
+    }
+
+    def previous():
+        # The old CLI converted every score by hand before indenting the document
+        converted = dict(response, recommendations=[
+            {'activity': item['activity'], 'score': float(item['score'])}
+            for item in response['recommendations']
+        ])
+        return (json.dumps(converted, indent=2) + '\n').encode('utf-8')
+
+    results = [
+        ('json.dumps indent=2', previous),
+        ('encode_json', lambda: encode_json(response) + b'\n'),
+        ('encode_json pretty', lambda: encode_json(response, pretty=True) + b'\n'),
+    ]
+
+    print(f"Recommend response for {len(recommendations)} activities "
+          f"(orjson {'available' if orjson is not None else 'not installed'})")
+    baseline = None
+    for label, fn in results:
+        seconds, payload = best_of(args.repeat, fn)
+        baseline = baseline or seconds
+        print(f"  {label:<22} {seconds * 1000:8.2f} ms  {len(payload) / 1024:8.1f} KiB  "
+              f"{baseline / seconds:5.1f}x")
+
+
+def bench_transform(args):
+    """Compare the sklearn pipeline with the compiled transform on candidate lists."""
+    import numpy as np
+
+    engine = trained_engine(synthetic_activities(args.catalog))
+
+    print(f"Feature transform, model trained on {args.catalog} activities")
+    for size in args.candidates:
+        candidates = synthetic_activities(size, seed=size)
+
+        def pipeline():
+            embeddings = engine.model_pipeline.transform(engine._extract_features(candidates))
+            return embeddings.toarray() if hasattr(embeddings, 'toarray') else embeddings
+
+        def compiled():
+            return engine.compiled_transform.transform(engine._feature_columns(candidates))
+
+        pipeline_seconds, expected = best_of(args.repeat, pipeline)
+        compiled_seconds, actual = best_of(args.repeat, compiled)
+        assert np.allclose(actual, expected, rtol=0, atol=1e-12)
+
+        print(f"  {size:>6} candidates  pipeline {pipeline_seconds * 1000:8.2f} ms  "
+              f"compiled {compiled_seconds * 1000:8.2f} ms  {pipeline_seconds / compiled_seconds:5.1f}x")
+
+
+def bench_multi(args):
+    """Compare per-user recommend calls with one batched call over the same pool."""
+    engine = trained_engine(synthetic_activities(args.catalog))
+    candidates = synthetic_activities(args.candidates, seed=args.candidates)
+    profiles = random_profiles(args.users)
+
+    def per_user():
+        return [engine.get_personalized_recommendations(profile, candidates, args.top_n) for profile in profiles]
+
+    def batched():
+        return engine.get_batch_recommendations(profiles, candidates, args.top_n)
+
+    per_user_seconds, expected = best_of(args.repeat, per_user)
+    batched_seconds, actual = best_of(args.repeat, batched)
+    assert [[a['place_id'] for a, _ in r] for r in actual] == [[a['place_id'] for a, _ in r] for r in expected]
+
+    print(f"{args.users} users x {args.candidates} candidates, top {args.top_n}")
+    print(f"  per-user calls {per_user_seconds * 1000:8.2f} ms  "
+          f"batched {batched_seconds * 1000:8.2f} ms  {per_user_seconds / batched_seconds:5.1f}x")
+
+
+def bench_model_size(args):
+    """Model size and load time, dense vs sparse and legacy pickle vs model directory."""
+    from recommendation_engine import ActivityRecommendationEngine
+
+    # Multi-city catalogs have many distinct primary types (city-specific categories)
+    activities = synthetic_activities(args.activities)
+    rng = random.Random(5)
+    for activity in activities:
+        activity['types'] = [f'city_{rng.randrange(args.cities)}_place'] + activity['types']
+    profile = random_profiles(1)[0]
+
+    def directory_size(path):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(path) for name in names)
+
+    print(f"Model for {args.activities} activities across {args.cities} cities")
+    for sparse_embeddings in (False, True):
+        model_dir = tempfile.mkdtemp(prefix='tw-bench-')
+        engine = ActivityRecommendationEngine(model_dir, sparse_embeddings=sparse_embeddings)
+        engine.train_content_based_model(activities, force_retrain=True)
+        engine.save_model(engine.model_file)
+
+        for name, path, size in (
+            ('pickle', engine.model_file, os.path.getsize(engine.model_file)),
+            ('directory', engine.model_path, directory_size(engine.model_path.resolve()))
+        ):
+            def load_and_score():
+                reader = ActivityRecommendationEngine(model_dir)
+                reader.load_model(str(path))
+                reader.get_personalized_recommendations(profile, activities[:50])
+                return reader
+
+            seconds, _ = best_of(args.repeat, load_and_score)
+            print(f"  {'sparse' if sparse_embeddings else 'dense':<6}  {name:<9}  "
+                  f"embeddings {engine.activity_embeddings.shape}  "
+                  f"size {size / 2 ** 20:8.1f} MiB  load+score {seconds * 1000:8.1f} ms")
+
+
+def bench_ann(args):
+    """Recall and latency of catalog recommendations through the ANN index vs the exact scan."""
+    from recommendation_engine import ActivityRecommendationEngine
+
+    catalog = synthetic_activities(args.catalog)
+    profiles = random_profiles(args.queries)
+
+    def average_query(engine, **options):
+        start = time.perf_counter()
+        results = [engine.get_catalog_recommendations(profile, args.top_n, **options) for profile in profiles]
+        return (time.perf_counter() - start) / len(profiles), results
+
+    print(f"Catalog of {args.catalog} activities, {args.queries} users, top {args.top_n}")
+    exact = None
+    for tables in args.tables:
+        for bits in args.bits:
+            engine = ActivityRecommendationEngine(tempfile.mkdtemp(prefix='tw-bench-'),
+                                                  ann_index={'n_tables': tables, 'n_bits': bits})
+            start = time.perf_counter()
+            engine.train_content_based_model(catalog, force_retrain=True)
+            train_seconds = time.perf_counter() - start
+            # The first catalog query prepares per-catalog columns; keep it out of the timings
+            engine.get_catalog_recommendations(profiles[0], args.top_n)
+
+            if exact is None:
+                exact_seconds, results = average_query(engine, exact=True)
+                exact = [{activity['place_id'] for activity, _ in result} for result in results]
+                print(f"  exact scan                      {exact_seconds * 1000:8.2f} ms/query")
+
+            for probes in args.probes:
+                seconds, results = average_query(engine, probes=probes)
+                recall = sum(
+                    len(expected & {activity['place_id'] for activity, _ in result}) / max(len(expected), 1)
+                    for expected, result in zip(exact, results)
+                ) / len(profiles)
+                print(f"  tables {tables:>3} bits {bits:>2} probes {probes:>2}  {seconds * 1000:8.2f} ms/query  "
+                      f"recall@{args.top_n} {recall:5.3f}  (training {train_seconds:.1f}s)")
+
+
+def bench_precision(args):
+    """
+    Embedding memory, catalog query time and top-N overlap with float64 for
+    each embedding precision: on the stored catalog and on a held-out pool
+    of activities the model was not trained on.
+    """
+    from recommendation_engine import ActivityRecommendationEngine
+
+    catalog = synthetic_activities(args.catalog)
+    held_out = synthetic_activities(args.held_out, seed=29)
+    profiles = random_profiles(args.queries)
+
+    def top_ids(results):
+        return [{activity['place_id'] for activity, _ in result} for result in results]
+
+    def overlap(expected, actual):
+        return sum(len(e & a) for e, a in zip(expected, actual)) / sum(len(e) for e in expected)
+
+    print(f"Catalog of {args.catalog} activities, held-out pool of {args.held_out}, "
+          f"{args.queries} users, overlap@{args.top_n} with float64")
+    reference = None
+    for precision in ('float64', 'float32', 'int8'):
+        engine = ActivityRecommendationEngine(tempfile.mkdtemp(prefix='tw-bench-'), ann_index={},
+                                              embedding_precision=precision)
+        engine.train_content_based_model(catalog, force_retrain=True)
+        engine.get_catalog_recommendations(profiles[0], args.top_n, exact=True)
+
+        start = time.perf_counter()
+        catalog_results = top_ids(engine.get_catalog_recommendations(profile, args.top_n, exact=True)
+                                  for profile in profiles)
+        query_seconds = (time.perf_counter() - start) / len(profiles)
+        pool_results = top_ids(engine.get_batch_recommendations(profiles, held_out, args.top_n))
+        if reference is None:
+            reference = catalog_results, pool_results
+
+        print(f"  {precision:<7}  embeddings {engine.activity_embeddings.nbytes / 2 ** 20:8.1f} MiB  "
+              f"catalog query {query_seconds * 1000:7.2f} ms  "
+              f"catalog overlap {overlap(reference[0], catalog_results):5.3f}  "
+              f"held-out overlap {overlap(reference[1], pool_results):5.3f}")
+
+
+def bench_update(args):
+    """
+    Full retrain vs update_model for a batch of new, changed and deleted
+    places, from the JSON request the engine receives to the saved model.
+    """
+    from recommendation_engine import ActivityRecommendationEngine, decode_requests, handle_request
+
+    catalog = synthetic_activities(args.catalog)
+    added = [dict(activity, place_id=f'new_{i}')
+             for i, activity in enumerate(synthetic_activities(args.changes, seed=19))]
+    changed = [dict(activity, rating=4.9) for activity in catalog[:args.changes]]
+    removed = [activity['place_id'] for activity in catalog[-args.changes:]]
+    train_request = json.dumps({'train': True, 'force_retrain': True, 'activities': catalog}).encode()
+    update_request = json.dumps({'update': True, 'activities': added + changed, 'removed_ids': removed}).encode()
+
+    print(f"Catalog of {args.catalog} activities; {args.changes} added, changed and removed each "
+          f"(best of {args.repeat})")
+    for name, options in (('float64', {}), ('int8 + ann', {'embedding_precision': 'int8', 'ann_index': {}})):
+        train_seconds = update_seconds = float('inf')
+        for _ in range(args.repeat):
+            engine = ActivityRecommendationEngine(tempfile.mkdtemp(prefix='tw-bench-'), **options)
+            start = time.perf_counter()
+            handle_request(decode_requests(train_request), engine)
+            train_seconds = min(train_seconds, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            result = handle_request(decode_requests(update_request), engine)
+            update_seconds = min(update_seconds, time.perf_counter() - start)
+        print(f"  {name:<10}  train request {len(train_request) / 2 ** 20:6.1f} MiB {train_seconds:6.2f} s  "
+              f"update request {len(update_request) / 2 ** 20:6.2f} MiB {update_seconds:6.2f} s  "
+              f"(refit: {result['update']['refit']})")
+
+
+def bench_shards(args):
+    """One model for all cities vs per-destination shards, for a worker serving one city."""
+    from model_shards import DestinationShards
+    from recommendation_engine import ActivityRecommendationEngine, handle_request
+
+    cities = {f'city_{i}': synthetic_activities(args.per_city, seed=i) for i in range(args.cities)}
+    model_dir = tempfile.mkdtemp(prefix='tw-bench-')
+    options = {'ann_index': {}}
+    everything = [activity for activities in cities.values() for activity in activities]
+    ActivityRecommendationEngine(model_dir, **options).train_content_based_model(everything, force_retrain=True)
+    shards = DestinationShards(model_dir, **options)
+    for city, activities in cities.items():
+        handle_request({'train': True, 'destination': city, 'activities': activities}, shards)
+
+    request = {'recommend': True, 'user_profile': USER_PROFILE, 'top_n': 10}
+    print(f"{args.cities} cities of {args.per_city} activities; first catalog request for one city")
+    for name, destination in (('global model', None), ('city shard', 'city_0')):
+        def first_request():
+            shards = DestinationShards(model_dir, **options)
+            handle_request(dict(request, destination=destination), shards)
+            return shards
+
+        seconds, loaded = best_of(args.repeat, first_request)
+        print(f"  {name:<12}  load + recommend {seconds * 1000:8.1f} ms  "
+              f"held {loaded.stats()['memory_bytes'] / 2 ** 20:8.1f} MiB")
+
+
+def bench_parallel_train(args):
+    """Nightly-style retrain of every destination shard: serial vs a process pool."""
+    from model_shards import train_destination_shards
+
+    source = Path(tempfile.mkdtemp(prefix='tw-bench-'))
+    for i in range(args.cities):
+        with open(source / f'city-{i}.ndjson', 'w') as f:
+            f.writelines(json.dumps(activity) + '\n' for activity in synthetic_activities(args.per_city, seed=i))
+
+    print(f"{args.cities} cities of {args.per_city} activities ({os.cpu_count()} CPUs)")
+    for workers in args.workers:
+        result = train_destination_shards(tempfile.mkdtemp(prefix='tw-bench-'), source, workers=workers)
+        slowest = max(shard['seconds'] for shard in result['shards'])
+        print(f"  workers={workers:<3}  total {result['seconds']:7.2f} s  slowest shard {slowest:6.2f} s")
+
+
+def bench_out_of_core(args):
+    """Peak RSS of streaming training as the catalog grows: fitted pipeline vs hashed out-of-core trainer."""
+    import subprocess
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    # Each run is its own process, so its peak RSS is that of the training alone
+    code = (
+        "import json, resource, sys, tempfile, time\n"
+        "from itertools import chain\n"
+        f"sys.path[:0] = [{os.path.join(here, 'ai')!r}, {here!r}]\n"
+        "from benchmark_recommendation_engine import synthetic_activities\n"
+        "from recommendation_engine import ActivityRecommendationEngine\n"
+        "catalog, hashed = int(sys.argv[1]), sys.argv[2] == 'hashed'\n"
+        "stream = chain.from_iterable(synthetic_activities(10000, seed=i) for i in range(catalog // 10000))\n"
+        "engine = ActivityRecommendationEngine(tempfile.mkdtemp(prefix='tw-bench-'), hashed_features={} if hashed else None)\n"
+        "start = time.perf_counter()\n"
+        "engine.train_from_stream(stream, force_retrain=True)\n"
+        "print(json.dumps([time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]))\n"
+    )
+    print("catalog     trainer   train s   peak RSS MiB")
+    for catalog in args.catalog:
+        for trainer in ('pipeline', 'hashed'):
+            completed = subprocess.run([sys.executable, '-c', code, str(catalog), trainer],
+                                       capture_output=True, text=True, check=True)
+            seconds, max_rss_kib = json.loads(completed.stdout.strip().splitlines()[-1])
+            print(f"{catalog:>9}  {trainer:<8}  {seconds:7.2f}   {max_rss_kib / 1024:10.1f}")
+
+
+def bench_hot_swap(args):
+    """Recommend latency while the model is retrained: in place vs a background rebuild."""
+    import numpy as np
+    from model_swap import HotSwapEngine
+    from recommendation_engine import handle_request, load_engine
+
+    activities = synthetic_activities(args.catalog)
+    model_dir = tempfile.mkdtemp(prefix='tw-bench-')
+    handle_request({'train': True, 'force_retrain': True, 'activities': activities}, load_engine(model_dir))
+    recommend = {'recommend': True, 'user_profile': USER_PROFILE, 'activities': activities[:args.candidates], 'top_n': 10}
+    retrain = {'train': True, 'force_retrain': True, 'activities': activities}
+
+    # In place, a request arriving during the retrain waits for all of it
+    engine = load_engine(model_dir)
+    handle_request(recommend, engine)
+    started = time.perf_counter()
+    handle_request(retrain, engine)
+    handle_request(recommend, engine)
+    blocked = time.perf_counter() - started
+    print(f"{args.catalog} activities, {args.candidates} candidates per request")
+    print(f"  in place     worst request {blocked * 1000:9.1f} ms")
+
+    live = HotSwapEngine(lambda: load_engine(model_dir), model_dir)
+    handle_request(recommend, live)
+    latencies = []
+    started = time.perf_counter()
+    handle_request(retrain, live)
+    while live.status()['running'] is not None:
+        request_started = time.perf_counter()
+        handle_request(recommend, live)
+        latencies.append(time.perf_counter() - request_started)
+    live.wait()
+    rebuild = time.perf_counter() - started
+    print(f"  hot swap     worst request {max(latencies) * 1000:9.1f} ms  p50 {np.median(latencies) * 1000:6.1f} ms  "
+          f"({len(latencies)} requests during a {rebuild:.1f} s rebuild, {live.swaps} swap)")
+
+
+def bench_threads(args):
+    """Recommend throughput of one engine shared by a pool of request threads."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    activities = synthetic_activities(args.catalog)
+    engine = trained_engine(activities)
+    profiles = random_profiles(args.requests)
+    pools = [activities[start:start + args.candidates]
+             for start in range(0, args.catalog - args.candidates, args.candidates)]
+
+    def recommend(i):
+        return engine.get_personalized_recommendations(profiles[i], pools[i % len(pools)], 10)
+
+    expected = [recommend(i) for i in range(args.requests)]
+    print(f"{args.requests} requests, {args.candidates} candidates each, catalog of {args.catalog}")
+    for threads in args.threads:
+        with ThreadPoolExecutor(threads) as executor:
+            seconds, results = best_of(args.repeat, lambda: list(executor.map(recommend, range(args.requests))))
+        identical = all([a['place_id'] for a, _ in got] == [a['place_id'] for a, _ in want]
+                        for got, want in zip(results, expected))
+        print(f"  {threads:3d} threads  {args.requests / seconds:8.0f} requests/s  "
+              f"results identical to one thread: {identical}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ML recommendation engine benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    encoder = subparsers.add_parser('encoder', help='Response encoding time and size')
+    encoder.add_argument('--activities', type=int, default=5000)
+    encoder.add_argument('--repeat', type=int, default=5)
+    encoder.set_defaults(run=bench_encoder)
+
+    transform = subparsers.add_parser('transform', help='Feature transform latency, sklearn vs compiled')
+    transform.add_argument('--catalog', type=int, default=5000)
+    transform.add_argument('--candidates', type=int, nargs='+', default=[20, 200, 5000])
+    transform.add_argument('--repeat', type=int, default=5)
+    transform.set_defaults(run=bench_transform)
+
+    multi = subparsers.add_parser('multi', help='Recommendations for many users, per-user vs batched')
+    multi.add_argument('--catalog', type=int, default=5000)
+    multi.add_argument('--candidates', type=int, default=2000)
+    multi.add_argument('--users', type=int, default=50)
+    multi.add_argument('--top-n', type=int, default=10)
+    multi.add_argument('--repeat', type=int, default=3)
+    multi.set_defaults(run=bench_multi)
+
+    model_size = subparsers.add_parser('model-size', help='Model size and load time, dense vs sparse and pickle vs directory')
+    model_size.add_argument('--activities', type=int, default=100000)
+    model_size.add_argument('--cities', type=int, default=400)
+    model_size.add_argument('--repeat', type=int, default=3)
+    model_size.set_defaults(run=bench_model_size)
+
+    ann = subparsers.add_parser('ann', help='ANN index recall and latency against the exact catalog scan')
+    ann.add_argument('--catalog', type=int, default=100000)
+    ann.add_argument('--queries', type=int, default=20)
+    ann.add_argument('--top-n', type=int, default=10)
+    ann.add_argument('--tables', type=int, nargs='+', default=[8, 16])
+    ann.add_argument('--bits', type=int, nargs='+', default=[6, 8])
+    ann.add_argument('--probes', type=int, nargs='+', default=[0, 2, 6])
+    ann.set_defaults(run=bench_ann)
+
+    precision = subparsers.add_parser('precision', help='Memory, speed and ranking quality per embedding precision')
+    precision.add_argument('--catalog', type=int, default=100000)
+    precision.add_argument('--held-out', type=int, default=5000)
+    precision.add_argument('--queries', type=int, default=50)
+    precision.add_argument('--top-n', type=int, default=10)
+    precision.set_defaults(run=bench_precision)
+
+    update = subparsers.add_parser('update', help='Full retrain vs incremental update_model')
+    update.add_argument('--catalog', type=int, default=100000)
+    update.add_argument('--changes', type=int, default=300)
+    update.add_argument('--repeat', type=int, default=3)
+    update.set_defaults(run=bench_update)
+
+    shards = subparsers.add_parser('shards', help='Global model vs per-destination shards for one city')
+    shards.add_argument('--cities', type=int, default=20)
+    shards.add_argument('--per-city', type=int, default=5000)
+    shards.add_argument('--repeat', type=int, default=3)
+    shards.set_defaults(run=bench_shards)
+
+    parallel = subparsers.add_parser('parallel-train', help='Train destination shards serially vs in a process pool')
+    parallel.add_argument('--cities', type=int, default=16)
+    parallel.add_argument('--per-city', type=int, default=10000)
+    parallel.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parallel.set_defaults(run=bench_parallel_train)
+
+    out_of_core = subparsers.add_parser('out-of-core', help='Peak memory of streaming training vs catalog size')
+    out_of_core.add_argument('--catalog', type=int, nargs='+', default=[100000, 400000, 1600000])
+    out_of_core.set_defaults(run=bench_out_of_core)
+
+    hot_swap = subparsers.add_parser('hot-swap', help='Request latency during a retrain: in place vs background rebuild')
+    hot_swap.add_argument('--catalog', type=int, default=100000)
+    hot_swap.add_argument('--candidates', type=int, default=200)
+    hot_swap.set_defaults(run=bench_hot_swap)
+
+    threads = subparsers.add_parser('threads', help='Recommend throughput with concurrent request threads on one engine')
+    threads.add_argument('--catalog', type=int, default=20000)
+    threads.add_argument('--candidates', type=int, default=200)
+    threads.add_argument('--requests', type=int, default=400)
+    threads.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+    threads.add_argument('--repeat', type=int, default=3)
+    threads.set_defaults(run=bench_threads)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
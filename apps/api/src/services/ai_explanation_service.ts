@@ -69,6 +69,43 @@ export class AIExplanationService {
     }
   }
 
+  /**
+   * Generate explanations for many activities with a single engine invocation
+   */
+  async generateExplanations(requests: AIExplanationRequest[]): Promise<string[]> {
+    if (requests.length === 0) {
+      return [];
+    }
+
+    try {
+      logger.info('Generating AI explanations in batch', { count: requests.length });
+
+      const inputData = {
+        batch: requests.map((request) => ({
+          explain: true,
+          activity: request.activity,
+          user_profile: request.userProfile,
+          decision_factors: request.decisionFactors || {}
+        }))
+      };
+
+      const result = await this.callPythonEngine(inputData);
+
+      return result.results.map((item: any, index: number) =>
+        item.status === 'success'
+          ? item.explanation
+          : this.generateFallbackExplanation(requests[index].activity, requests[index].userProfile)
+      );
+    } catch (error) {
+      logger.error('Failed to generate AI explanations in batch', {
+        error: error.message,
+        count: requests.length
+      });
+
+      return requests.map((request) => this.generateFallbackExplanation(request.activity, request.userProfile));
+    }
+  }
+
   /**
    * Generate an itinerary summary explaining how the itinerary was built
    */
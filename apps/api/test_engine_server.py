@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Tests for the resident recommendation engine server (ai/engine_server.py).
+
+Run with: python3 -m pytest -q test_engine_server.py
+"""
+
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'ai'))
+
+from engine_server import EngineServer
+
+
+def _echo_handler(request, engine):
+    if 'boom' in request:
+        raise ValueError('boom')
+    engine['calls'] += 1
+    return {'status': 'success', 'calls': engine['calls']}
+
+
+def _serve(lines, server):
+    stdout = io.BytesIO()
+    server.serve_stdio(io.BytesIO(''.join(line + '\n' for line in lines).encode('utf-8')), stdout)
+    return [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+
+def test_stdio_server_keeps_engine_resident():
+    server = EngineServer({'calls': 0}, _echo_handler)
+
+    responses = _serve(['{"id": 1, "info": true}', '', '{"id": "b", "info": true}'], server)
+
+    assert responses == [
+        {'status': 'success', 'calls': 1, 'id': 1},
+        {'status': 'success', 'calls': 2, 'id': 'b'},
+    ]
+
+
+def test_stdio_server_survives_bad_requests():
+    server = EngineServer({'calls': 0}, _echo_handler)
+
+    responses = _serve(['not json', '[1, 2]', '{"id": 3, "boom": true}', '{"info": true}'], server)
+
+    assert [r['status'] for r in responses] == ['error', 'error', 'error', 'success']
+    assert responses[2] == {'status': 'error', 'message': 'boom', 'id': 3}
+    assert responses[3]['calls'] == 1
+
+
+def _pid_handler(request, engine):
+    return {'status': 'success', 'pid': os.getpid(), 'rows': len(engine['embeddings'])}
+
+
+def test_worker_pool_serves_from_forked_workers():
+    server = EngineServer({'embeddings': list(range(1000))}, _pid_handler, workers=2)
+    try:
+        responses = _serve([json.dumps({'id': i, 'recommend': True}) for i in range(20)] +
+                           ['{"id": "t", "train": true}', '{"id": "bt", "batch": [{"train": true}]}',
+                            '{"id": "bu", "batch": [{"recommend": true}, {"update": true}]}'], server)
+    finally:
+        server.close()
+
+    by_id = {r['id']: r for r in responses}
+    assert sorted(k for k in by_id if isinstance(k, int)) == list(range(20))
+    assert all(by_id[i]['rows'] == 1000 and by_id[i]['pid'] != os.getpid() for i in range(20))
+    # Model changes are rejected, batched ones included
+    assert all(by_id[i]['status'] == 'error' and 'pid' not in by_id[i] for i in ('t', 'bt', 'bu'))
+
+
+def _crashing_handler(request, engine):
+    if 'crash' in request:
+        os._exit(1)
+    return dict(_pid_handler(request, engine), ppid=os.getppid())
+
+
+def test_worker_pool_answers_and_replaces_dead_workers():
+    from engine_server import WorkerPool
+
+    pool = WorkerPool({'embeddings': [0]}, _crashing_handler, 1)
+    pool.start()
+    try:
+        first = pool.submit({'recommend': True}).result(10)
+        crashed = pool.submit({'recommend': True, 'crash': True})
+        queued = pool.submit({'recommend': True})
+
+        assert crashed.result(10)['code'] == 'worker_died'
+        # The request queued behind it runs on the replacement worker
+        replacement = queued.result(10)
+        assert replacement['status'] == 'success' and replacement['pid'] not in (first['pid'], os.getpid())
+        assert pool.restarts == 1
+        # Replacements come from the fork server, not the threaded parent
+        assert replacement['ppid'] == first['ppid'] != os.getpid()
+    finally:
+        pool.shutdown()
+
+
+def test_msgpack_framing_round_trip():
+    import msgpack
+    from engine_io import FRAME_HEADER
+
+    server = EngineServer({'calls': 0}, _echo_handler, wire_format='msgpack')
+    stdin = b''.join(FRAME_HEADER.pack(len(body)) + body
+                     for body in (msgpack.packb({'id': 1, 'info': True}), b'\xc1', msgpack.packb({'id': 2})))
+    stdout = io.BytesIO()
+
+    server.serve_stdio(io.BytesIO(stdin), stdout)
+
+    responses = list(msgpack.Unpacker(_strip_frames(stdout.getvalue()), raw=False))
+    assert [r['status'] for r in responses] == ['success', 'error', 'success']
+    assert (responses[0]['id'], responses[2]['id'], responses[2]['calls']) == (1, 2, 2)
+
+
+def _strip_frames(data):
+    from engine_io import FRAME_HEADER
+
+    stream = io.BytesIO(data)
+    bodies = []
+    while True:
+        header = stream.read(FRAME_HEADER.size)
+        if not header:
+            return io.BytesIO(b''.join(bodies))
+        bodies.append(stream.read(FRAME_HEADER.unpack(header)[0]))
+
+
+def _gated_handler(request, engine):
+    engine['gate'].wait(5)
+    engine['order'].append(request['id'])
+    return {'status': 'success'}
+
+
+def _overlap_handler(request, engine):
+    import time
+
+    with engine['lock']:
+        engine['active'] += 1
+        engine['seen'].append((request['id'], engine['active']))
+    time.sleep(0.05)
+    with engine['lock']:
+        engine['active'] -= 1
+    return {'status': 'success'}
+
+
+def test_threads_score_concurrently_and_model_changes_run_alone():
+    import threading
+
+    engine = {'lock': threading.Lock(), 'active': 0, 'seen': []}
+    server = EngineServer(engine, _overlap_handler, threads=2)
+    try:
+        ids = ['r0', 'r1', 'r2', 'train', 'r3', 'batch']
+        futures = [server.submit({'id': i, 'recommend': True}) for i in ids[:3]] + \
+                  [server.submit({'id': 'train', 'train': True}), server.submit({'id': 'r3', 'recommend': True}),
+                   server.submit({'id': 'batch', 'batch': [{'update': True}]})]
+        assert all(f.result(5)['status'] == 'success' for f in futures)
+    finally:
+        server.close()
+
+    seen = dict(engine['seen'])
+    assert max(seen[i] for i in ('r0', 'r1', 'r2', 'r3')) == 2
+    assert seen['train'] == 1 and seen['batch'] == 1
+
+
+def test_admission_queue_prioritizes_cheap_modes_and_enforces_limits():
+    import threading
+    import time
+
+    engine = {'gate': threading.Event(), 'order': []}
+    server = EngineServer(engine, _gated_handler, max_queue=2)
+    try:
+        # The first request occupies the only execution slot
+        running = server.submit({'id': 'running', 'recommend': True})
+        while server.queue.depth()['bulk']:
+            time.sleep(0.001)
+
+        bulk = [server.submit({'id': f'bulk{i}', 'recommend': True}) for i in range(3)]
+        cheap = [server.submit({'id': 'cheap', 'explain': True}),
+                 server.submit({'id': 'expired', 'explain': True, 'deadline_ms': 1})]
+        time.sleep(0.01)
+        engine['gate'].set()
+
+        responses = [f.result(5) for f in [running] + bulk + cheap]
+    finally:
+        server.close()
+
+    assert engine['order'] == ['running', 'cheap', 'bulk0', 'bulk1']
+    assert responses[3]['code'] == 'overloaded'
+    assert responses[5]['code'] == 'deadline_exceeded'
@@ -0,0 +1,933 @@
+#!/usr/bin/env python3
+"""
+Tests for the ML recommendation engine (ai/recommendation_engine.py).
+
+Run with: python3 -m pytest -q test_recommendation_engine.py
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+AI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ai')
+sys.path.insert(0, AI_DIR)
+
+HEAVY_MODULES = ('numpy', 'pandas', 'sklearn', 'joblib', 'prisma')
+
+# Import budget for the engine module itself, on top of interpreter start-up
+IMPORT_BUDGET_SECONDS = 0.1
+
+
+def _run_python(code, stdin='', cwd=None):
+    code = f"import sys\nsys.path.insert(0, {AI_DIR!r})\n" + code
+    completed = subprocess.run(
+        [sys.executable, '-c', code],
+        input=stdin, capture_output=True, text=True, cwd=cwd or AI_DIR, check=True
+    )
+    return completed.stdout
+
+
+def test_module_import_is_within_budget_and_skips_ml_libraries():
+    output = _run_python(
+        "import sys, time, json\n"
+        "start = time.perf_counter()\n"
+        "import recommendation_engine\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"print(json.dumps([elapsed, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))\n"
+    )
+    elapsed, loaded = json.loads(output)
+
+    assert loaded == []
+    assert elapsed < IMPORT_BUDGET_SECONDS, f"import took {elapsed:.3f}s"
+
+
+def test_pure_python_modes_run_without_ml_libraries(tmp_path):
+    itinerary = {
+        'days': [{
+            'day': 1,
+            'activities': [
+                {'name': 'Louvre', 'types': ['museum'], 'rating': 4.7, 'price_level': 2,
+                 'user_ratings_total': 1200, 'duration': '3 hours'},
+                {'name': 'Bistrot', 'types': ['restaurant'], 'rating': 4.4, 'price_level': 2,
+                 'user_ratings_total': 300, 'duration': '2 hours'},
+            ]
+        }]
+    }
+    requests = [
+        {'health_score': True, 'itinerary': itinerary, 'user_profile': {'budget': 2}},
+        {'proactive_tips': True, 'itinerary': itinerary, 'user_profile': {'budget': 2}},
+        {'explain': True, 'activity': itinerary['days'][0]['activities'][0],
+         'user_profile': {'interests': ['museum']}},
+    ]
+
+    for request in requests:
+        output = _run_python(
+            "import sys, json\n"
+            "import recommendation_engine\n"
+            "recommendation_engine.main([])\n"
+            f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))\n",
+            stdin=json.dumps(request), cwd=str(tmp_path)
+        )
+        response, loaded = output.rstrip('\n').rsplit('\n', 1)
+
+        assert json.loads(response)['status'] == 'success'
+        assert json.loads(loaded) == []
+
+
+SAMPLE_ACTIVITIES = [
+    {'place_id': 'louvre', 'name': 'Louvre', 'types': ['museum', 'art_gallery'], 'rating': 4.7,
+     'price_level': 3, 'user_ratings_total': 8900, 'photo_reference': 'p1'},
+    {'place_id': 'bistrot', 'name': 'Le Petit Bistrot', 'types': ['restaurant', 'food'], 'rating': 4.5,
+     'price_level': 2, 'user_ratings_total': 1250},
+    {'place_id': 'tuileries', 'name': 'Tuileries', 'types': ['park', 'point_of_interest'], 'rating': 4.3,
+     'price_level': 0, 'user_ratings_total': 3200},
+    {'place_id': 'halles', 'name': 'Forum des Halles', 'types': ['shopping_mall', 'store'], 'rating': 3.8,
+     'price_level': 2, 'user_ratings_total': 950},
+    {'place_id': 'cafe', 'name': 'Cafe de Flore', 'types': ['cafe', 'food'], 'rating': 4.1,
+     'price_level': 2, 'user_ratings_total': 40},
+    {'place_id': 'asterix', 'name': 'Parc Asterix', 'types': ['amusement_park'], 'rating': 4.4,
+     'price_level': 3, 'user_ratings_total': 20000, 'photo_reference': 'p2'},
+]
+
+
+def _trained_engine(model_dir, activities=SAMPLE_ACTIVITIES, **kwargs):
+    from recommendation_engine import ActivityRecommendationEngine
+
+    engine = ActivityRecommendationEngine(str(model_dir), **kwargs)
+    engine.train_content_based_model(activities, force_retrain=True)
+    return engine
+
+
+def test_shared_embeddings_publish_attach_and_retrain(tmp_path):
+    from embedding_store import read_manifest
+
+    publisher = _trained_engine(tmp_path)
+    publisher.publish_shared_embeddings()
+    first_version = publisher.shared_embeddings.version
+    try:
+        # Another process attaches zero-copy to the published matrix
+        output = _run_python(
+            "import json\n"
+            "from recommendation_engine import ActivityRecommendationEngine\n"
+            f"reader = ActivityRecommendationEngine({str(tmp_path)!r})\n"
+            "reader.load_model(attach_shared=True)\n"
+            "shared = reader.shared_embeddings\n"
+            "print(json.dumps([shared.owner, shared.version, float(reader.activity_embeddings.sum())]))\n"
+        )
+        owner, version, total = json.loads(output)
+        assert (owner, version) == (False, first_version)
+        assert abs(total - float(publisher.activity_embeddings.sum())) < 1e-9
+
+        # A retrain publishes a new version next to the one readers may still use
+        publisher.train_content_based_model(SAMPLE_ACTIVITIES[:4], force_retrain=True)
+        manifest = read_manifest(tmp_path)
+        assert manifest['current'] == publisher.shared_embeddings.version != first_version
+        assert set(manifest['segments']) == {first_version, manifest['current']}
+    finally:
+        publisher.release_shared_embeddings()
+
+    assert read_manifest(tmp_path)['segments'] == {}
+
+    # A segment left behind by a crashed publisher is replaced, not fatal
+    from multiprocessing import shared_memory
+    from embedding_store import segment_name
+    from recommendation_engine import load_engine
+
+    leftover = shared_memory.SharedMemory(name=segment_name(publisher.model_version_tag()), create=True, size=8)
+    leftover.close()
+    restarted = load_engine(str(tmp_path), shared_embeddings='publish')
+    try:
+        assert restarted.shared_embeddings is not None and restarted.shared_embeddings.owner
+        assert restarted.get_personalized_recommendations({'interests': ['food']}, SAMPLE_ACTIVITIES, 2) == \
+            publisher.get_personalized_recommendations({'interests': ['food']}, SAMPLE_ACTIVITIES, 2)
+    finally:
+        restarted.release_shared_embeddings()
+
+
+def test_model_directory_loads_memory_mapped_without_sklearn(tmp_path):
+    import numpy as np
+    from recommendation_engine import ActivityRecommendationEngine
+
+    engine = _trained_engine(tmp_path)
+    profile = {'interests': ['culture', 'food'], 'budget': 2, 'pace': 'relaxed'}
+    expected = [(a['place_id'], s) for a, s in engine.get_personalized_recommendations(profile, SAMPLE_ACTIVITIES, 4)]
+    assert engine.model_path.is_symlink() and (engine.model_path / 'embeddings.npy').exists()
+
+    # A fresh process loads and scores without unpickling the pipeline or importing sklearn
+    output = _run_python(
+        "import json, sys\n"
+        "from recommendation_engine import ActivityRecommendationEngine\n"
+        f"engine = ActivityRecommendationEngine({str(tmp_path)!r})\n"
+        "engine.load_model()\n"
+        "mapped = type(engine.activity_embeddings).__name__\n"
+        f"result = engine.get_personalized_recommendations({profile!r}, {SAMPLE_ACTIVITIES!r}, 4)\n"
+        "print(json.dumps([mapped, [(a['place_id'], float(s)) for a, s in result],\n"
+        "                  [m for m in ('sklearn', 'joblib') if m in sys.modules]]))\n"
+    )
+    mapped, recommendations, loaded = json.loads(output)
+    assert mapped == 'memmap'
+    assert [tuple(r) for r in recommendations] == [(place_id, float(score)) for place_id, score in expected]
+    assert loaded == []
+
+    # Deferred parts are read on first use
+    reader = ActivityRecommendationEngine(str(tmp_path))
+    reader.load_model()
+    assert reader.activity_features.equals(engine.activity_features)
+    assert np.allclose(reader.model_pipeline.transform(reader.activity_features), engine.activity_embeddings)
+
+    # A retrain switches the link; versions older than the previous one are
+    # kept only while a reader has them open
+    first = engine.model_path.resolve()
+    engine_embeddings = np.array(engine.activity_embeddings)
+    for _ in range(2):
+        engine.train_content_based_model(SAMPLE_ACTIVITIES[:4], force_retrain=True)
+    versions = [p for p in tmp_path.glob('activity_recommendation_model.*') if p.is_dir()]
+    assert len(versions) == 3 and first in versions
+    assert reader.activity_ids == [a['place_id'] for a in SAMPLE_ACTIVITIES]
+
+    reader_embeddings = reader.activity_embeddings
+    del reader
+    engine.train_content_based_model(SAMPLE_ACTIVITIES[:4], force_retrain=True)
+    versions = [p for p in tmp_path.glob('activity_recommendation_model.*') if p.is_dir()]
+    assert len(versions) == 2 and first not in versions
+    # A reader of a removed version keeps its mapping
+    assert np.array_equal(reader_embeddings, engine_embeddings)
+
+    # Pickled models of earlier versions still load
+    engine.save_model(str(engine.model_file))
+    legacy = ActivityRecommendationEngine(str(tmp_path))
+    legacy.load_model(str(engine.model_file))
+    assert legacy.activity_features.equals(engine.activity_features)
+
+
+def test_batch_envelope_runs_mixed_requests_in_order(tmp_path):
+    explain = {'explain': True, 'activity': {'name': 'Louvre', 'rating': 4.7, 'types': ['museum']},
+               'user_profile': {'interests': ['museum']}}
+    health = {'health_score': True, 'itinerary': {'days': []}, 'user_profile': {}}
+    ndjson = '\n'.join(json.dumps(dict(explain, id=i)) for i in range(50))
+    ndjson += '\n' + json.dumps(health) + '\n{"explain": true}\n'
+
+    output = _run_python(
+        "import recommendation_engine\n"
+        "recommendation_engine.main([])\n",
+        stdin=ndjson, cwd=str(tmp_path)
+    )
+    response = json.loads(output)
+
+    assert (response['status'], response['count'], response['failed']) == ('success', 52, 1)
+    assert [r['index'] for r in response['results']] == list(range(52))
+    assert [r['id'] for r in response['results'][:50]] == list(range(50))
+    assert 'health_score' in response['results'][50]
+    assert response['results'][51]['status'] == 'error'
+
+
+def test_decode_requests_accepts_single_array_and_envelope():
+    from recommendation_engine import decode_requests
+
+    assert decode_requests('{"info": true}') == {'info': True}
+    assert decode_requests('[{"info": true}, {"explain": true}]') == {'batch': [{'info': True}, {'explain': True}]}
+    assert decode_requests('{"batch": [{"info": true}]}') == {'batch': [{'info': True}]}
+
+
+def test_columnar_feature_extraction_matches_per_activity_rules(tmp_path):
+    from engine_io import activities_from_arrow, activities_to_arrow
+    from feature_transform import FEATURE_COLUMNS, TYPE_CATEGORIES
+    from recommendation_engine import ActivityRecommendationEngine
+
+    activities = SAMPLE_ACTIVITIES + [
+        {'place_id': 'bare', 'name': 'No types', 'types': []},
+        {'place_id': 'bar', 'name': 'Wine Bar', 'types': ['bar', 'store', 'park'], 'rating': 4.0,
+         'price_level': 4, 'user_ratings_total': 100, 'photo_reference': 'p3'},
+    ]
+
+    def expected_row(activity):
+        types = activity.get('types', [])
+        rating = activity.get('rating', 0.0)
+        price_level = activity.get('price_level', 0)
+        reviews = activity.get('user_ratings_total', 0)
+        row = [types[0] if types else 'unknown', ' '.join(types), rating, price_level, reviews,
+               1 if activity.get('photo_reference') else 0]
+        row += [int(any(t in category for t in types)) for category in TYPE_CATEGORIES.values()]
+        return row + [int(rating >= 4.0), int(reviews >= 100), int(price_level >= 3)]
+
+    engine = ActivityRecommendationEngine(str(tmp_path))
+    for source in (activities, activities_from_arrow(activities_to_arrow(activities))):
+        features = engine._extract_features(source)
+        assert list(features.columns) == FEATURE_COLUMNS
+        assert features.values.tolist() == [expected_row(a) for a in activities]
+
+
+def test_compiled_transform_matches_sklearn_pipeline(tmp_path):
+    import numpy as np
+    from feature_transform import CompiledFeatureTransform
+
+    training = [dict(a, rating=a['rating'] - i * 0.05, user_ratings_total=a['user_ratings_total'] + i)
+                for i in range(10) for a in SAMPLE_ACTIVITIES]
+    engine = _trained_engine(tmp_path, training)
+    assert isinstance(engine.compiled_transform, CompiledFeatureTransform)
+
+    candidates = SAMPLE_ACTIVITIES + [
+        {'place_id': 'new', 'types': ['Night_Club', 'bar', 'bar', 'unseen-type'], 'rating': 3.2, 'price_level': 1},
+        {'place_id': 'bare', 'types': []},
+        {'place_id': 'zoo', 'types': ['zoo'], 'rating': 5, 'user_ratings_total': 10},
+    ]
+    expected = engine.model_pipeline.transform(engine._extract_features(candidates))
+    if hasattr(expected, 'toarray'):
+        expected = expected.toarray()
+
+    compiled = engine.compiled_transform.transform(engine._feature_columns(candidates))
+
+    assert compiled.shape == expected.shape
+    assert np.allclose(compiled, expected, rtol=0, atol=1e-12)
+
+
+def test_sparse_embeddings_train_score_and_persist_as_csr(tmp_path):
+    import numpy as np
+    from scipy import sparse
+    from recommendation_engine import ActivityRecommendationEngine
+
+    dense = _trained_engine(tmp_path / 'dense')
+    engine = _trained_engine(tmp_path / 'sparse', sparse_embeddings=True)
+    assert sparse.isspmatrix_csr(engine.activity_embeddings)
+    assert np.allclose(engine.activity_embeddings.toarray(), dense.activity_embeddings, rtol=0, atol=1e-12)
+
+    candidates = SAMPLE_ACTIVITIES + [{'place_id': 'bare', 'types': []}]
+    expected = engine.model_pipeline.transform(engine._extract_features(candidates))
+    compiled = engine.compiled_transform.transform(engine._feature_columns(candidates), sparse_output=True)
+    assert sparse.isspmatrix_csr(compiled)
+    assert np.allclose(compiled.toarray(), expected.toarray(), rtol=0, atol=1e-12)
+
+    # Cold, partially cached and fully cached candidate lists all stay sparse
+    for activities in (SAMPLE_ACTIVITIES[:3], candidates, candidates[::-1]):
+        embeddings = engine._transform_activities(activities)
+        assert sparse.isspmatrix_csr(embeddings)
+        assert np.allclose(embeddings.toarray(), dense._transform_activities(activities), rtol=0, atol=1e-12)
+
+    profile = {'interests': ['culture', 'food'], 'budget': 2}
+    expected = dense.get_personalized_recommendations(profile, candidates, 4)
+    actual = engine.get_personalized_recommendations(profile, candidates, 4)
+    assert [a['place_id'] for a, _ in actual] == [a['place_id'] for a, _ in expected]
+
+    # The model file keeps the CSR matrix and a reloaded engine scores sparsely
+    reloaded = ActivityRecommendationEngine(str(tmp_path / 'sparse'))
+    reloaded.load_model()
+    assert reloaded.sparse_embeddings and reloaded.get_model_info()['sparse_embeddings']
+    assert sparse.isspmatrix_csr(reloaded.activity_embeddings)
+    assert sparse.isspmatrix_csr(reloaded._transform_activities(candidates))
+
+
+def test_reduced_precision_embeddings_rank_like_float64(tmp_path):
+    import numpy as np
+    from benchmark_recommendation_engine import random_profiles, synthetic_activities
+    from embedding_quantization import QuantizedEmbeddings
+    from recommendation_engine import ActivityRecommendationEngine
+
+    catalog = synthetic_activities(1500)
+    engines = {
+        precision: _trained_engine(tmp_path / precision, catalog, ann_index={}, embedding_precision=precision)
+        for precision in ('float64', 'float32', 'int8')
+    }
+    reference = engines['float64'].activity_embeddings
+    assert engines['float32'].activity_embeddings.dtype == np.float32
+    assert np.allclose(engines['float32'].activity_embeddings, reference, atol=1e-5)
+
+    # int8 codes reconstruct every value to within half a quantization step
+    quantized = engines['int8'].activity_embeddings
+    assert isinstance(quantized, QuantizedEmbeddings) and quantized.codes.dtype == np.int8
+    assert np.all(np.abs(quantized.toarray() - reference) <= quantized.scales / 2 + 1e-6)
+    assert quantized.nbytes < reference.nbytes / 7
+
+    # Request pools are scored in float32 by both reduced precisions
+    for precision in ('float32', 'int8'):
+        assert engines[precision]._transform_activities(catalog[:20]).dtype == np.float32
+
+    def overlap(engine, profile, **options):
+        expected = engines['float64'].get_catalog_recommendations(profile, 10, exact=True, **options)
+        actual = engine.get_catalog_recommendations(profile, 10, exact=True, **options)
+        return len({a['place_id'] for a, _ in expected} & {a['place_id'] for a, _ in actual})
+
+    profiles = random_profiles(10)
+    assert min(overlap(engines['float32'], profile) for profile in profiles) >= 9
+    assert np.mean([overlap(engines['int8'], profile) for profile in profiles]) >= 8
+
+    # The quantized model is saved as codes and scales and reloads memory-mapped
+    reloaded = ActivityRecommendationEngine(str(tmp_path / 'int8'))
+    reloaded.load_model()
+    assert reloaded.get_model_info()['embedding_precision'] == 'int8'
+    assert isinstance(reloaded.activity_embeddings.codes, np.memmap)
+    assert np.array_equal(reloaded.activity_embeddings.codes, quantized.codes)
+    profile = profiles[0]
+    assert [a['place_id'] for a, _ in reloaded.get_catalog_recommendations(profile, 5)] == \
+        [a['place_id'] for a, _ in engines['int8'].get_catalog_recommendations(profile, 5)]
+
+    try:
+        ActivityRecommendationEngine(str(tmp_path / 'x'), sparse_embeddings=True, embedding_precision='int8')
+    except ValueError as e:
+        assert 'dense' in str(e)
+    else:
+        raise AssertionError('expected a ValueError')
+
+
+def test_ann_index_recommends_from_catalog_without_activities(tmp_path):
+    import numpy as np
+    import pytest
+    from ann_index import RandomProjectionIndex
+    from benchmark_recommendation_engine import synthetic_activities
+    from recommendation_engine import ActivityRecommendationEngine, handle_request
+
+    catalog = synthetic_activities(2000)
+    engine = _trained_engine(tmp_path, catalog, ann_index={'n_tables': 16, 'n_bits': 6})
+    assert engine.ann_index.params() == {'type': 'random_projection', 'n_tables': 16, 'n_bits': 6, 'rows': 2000}
+
+    # A row is always a candidate for its own embedding
+    index = engine.ann_index
+    for row in (0, 17, 1999):
+        assert row in index.candidates(engine.activity_embeddings[row], probes=0)
+    # More probes never lose candidates
+    query = engine._calculate_user_preference_vector({'interests': ['food', 'culture']})
+    narrow, wide = index.candidates(query, probes=0), index.candidates(query, probes=3)
+    assert set(narrow) <= set(wide) and len(wide) < len(catalog)
+
+    profile = {'interests': ['food', 'culture'], 'budget': 2, 'pace': 'fast'}
+    exact = engine.get_catalog_recommendations(profile, 10, exact=True)
+    scan = engine.get_personalized_recommendations(profile, catalog, 10)
+    assert [a['place_id'] for a, _ in exact] == [a['place_id'] for a, _ in scan]
+
+    # Approximate results carry their exact scores; recall grows with probes
+    exact_scores = {a['place_id']: score for a, score in engine.get_catalog_recommendations(profile, 2000, exact=True)}
+    recall = []
+    for probes in (0, 2, 6):
+        approximate = engine.get_catalog_recommendations(profile, 10, probes=probes)
+        assert all(score == pytest.approx(exact_scores[a['place_id']]) for a, score in approximate)
+        recall.append(len({a['place_id'] for a, _ in approximate} & {a['place_id'] for a, _ in exact}))
+    assert recall == sorted(recall) and recall[-1] >= 8
+
+    # The index and catalog are saved with the model
+    reloaded = ActivityRecommendationEngine(str(tmp_path))
+    reloaded.load_model()
+    assert isinstance(reloaded.ann_index, RandomProjectionIndex)
+    assert np.array_equal(reloaded.ann_index.order, index.order)
+    result = handle_request({'recommend': True, 'user_profile': profile, 'top_n': 3, 'ann_probes': 8}, reloaded)
+    assert [r['activity']['place_id'] for r in result['recommendations']] == \
+        [a['place_id'] for a, _ in engine.get_catalog_recommendations(profile, 3, probes=8)]
+
+    # Without a catalog the request has to name its activities
+    plain = _trained_engine(tmp_path / 'plain')
+    assert plain.catalog is None and plain.get_model_info()['ann_index'] is None
+    try:
+        plain.get_personalized_recommendations(profile)
+    except ValueError as e:
+        assert 'catalog' in str(e)
+    else:
+        raise AssertionError('expected a ValueError')
+
+
+def test_update_model_splices_rows_and_refits_on_category_drift(tmp_path):
+    import numpy as np
+    from benchmark_recommendation_engine import synthetic_activities
+    from embedding_quantization import QuantizedEmbeddings
+    from recommendation_engine import ActivityRecommendationEngine, handle_request
+
+    catalog = synthetic_activities(300)
+    engine = _trained_engine(tmp_path, catalog, ann_index={})
+    trained_at = engine.model_metadata['trained_at']
+    compiled = engine.compiled_transform
+
+    changed = dict(catalog[5], rating=1.0, price_level=4)
+    added = [dict(activity, place_id=f'new_{i}') for i, activity in enumerate(synthetic_activities(2, seed=3))]
+    summary = engine.update_model([changed] + added, removed_ids=['place_7'])
+    assert summary == {'added': 2, 'replaced': 1, 'removed': 1, 'unseen_category_rate': 0.0, 'refit': False}
+
+    # Rows are embedded with the fitted transform: no refit, same parameters
+    assert engine.model_metadata['trained_at'] == trained_at and engine.compiled_transform is compiled
+    ids = engine.activity_ids
+    assert len(ids) == engine.activity_embeddings.shape[0] == len(engine.activity_features) == 301
+    assert 'place_7' not in ids and ids[-2:] == ['new_0', 'new_1']
+    for activity in (changed, *added, catalog[0]):
+        row = ids.index(activity['place_id'])
+        assert np.allclose(engine.activity_embeddings[row], engine._transform_activities([activity])[0])
+        assert engine.catalog[row] == activity
+    assert engine.ann_index.n_rows == 301
+    assert set(engine.ann_index.candidates(engine.activity_embeddings[-1], probes=0)) >= {300}
+
+    # The update is saved, ids included
+    reloaded = ActivityRecommendationEngine(str(tmp_path))
+    reloaded.load_model()
+    assert reloaded.activity_ids == ids
+    assert np.array_equal(reloaded.activity_embeddings, engine.activity_embeddings)
+    assert reloaded.model_version_tag() != _trained_engine(tmp_path / 'fresh', catalog).model_version_tag()
+
+    # A batch of places of a category the encoder never saw triggers a full refit
+    volcanoes = [dict(activity, place_id=f'volcano_{i}', types=['volcano', 'natural_feature'])
+                 for i, activity in enumerate(synthetic_activities(20, seed=5))]
+    result = handle_request({'update': True, 'activities': volcanoes}, reloaded)
+    assert result['update']['refit'] and result['update']['unseen_category_rate'] > 0.05
+    assert 'volcano' in reloaded.compiled_transform.categories
+    assert reloaded.get_model_info()['metadata']['activities_count'] == 321
+
+    # Quantized models quantize new rows with their existing scales
+    quantized = _trained_engine(tmp_path / 'int8', catalog, embedding_precision='int8')
+    scales = quantized.activity_embeddings.scales
+    quantized.update_model(added)
+    assert isinstance(quantized.activity_embeddings, QuantizedEmbeddings)
+    assert quantized.activity_embeddings.shape[0] == 302 and quantized.activity_embeddings.scales is scales
+
+
+def test_hot_swap_engine_rebuilds_in_background_and_swaps_atomically(tmp_path):
+    from model_swap import HotSwapEngine
+    from recommendation_engine import handle_request, load_engine
+
+    _trained_engine(tmp_path)
+    live = HotSwapEngine(lambda: load_engine(str(tmp_path)), str(tmp_path))
+    profile = {'interests': ['food'], 'budget': 2}
+    recommend = {'recommend': True, 'user_profile': profile, 'activities': SAMPLE_ACTIVITIES, 'top_n': 3}
+    expected = handle_request(recommend, live)['recommendations']
+
+    with live.acquire() as in_flight:
+        retrain = {'train': True, 'force_retrain': True, 'activities': SAMPLE_ACTIVITIES[:4] * 3}
+        assert handle_request(retrain, live)['status'] == 'accepted'
+        # Serving continues on the current model while the new one is built
+        assert handle_request(recommend, live)['recommendations'] == expected
+        assert handle_request(dict(retrain), live)['code'] == 'rebuild_in_progress'
+        assert live.engine is in_flight
+
+        assert live.wait(120)
+        status = handle_request({'info': True}, live)
+        assert status['model_info']['metadata']['activities_count'] == 12
+        assert status['rebuild']['last']['result']['status'] == 'success'
+        assert status['rebuild']['swaps'] == 1 and status['rebuild']['retired_in_use'] == 1
+
+        # The in-flight request still sees the complete previous model
+        assert in_flight.model_metadata['activities_count'] == len(SAMPLE_ACTIVITIES)
+        assert [a['place_id'] for a, _ in in_flight.get_personalized_recommendations(profile, SAMPLE_ACTIVITIES, 3)] == \
+            [r['activity']['place_id'] for r in expected]
+    assert live.status()['retired_in_use'] == 0
+
+    # A failed rebuild leaves the current model in place
+    assert handle_request({'update': True, 'activities': [], 'removed_ids': [a['place_id'] for a in SAMPLE_ACTIVITIES]},
+                          live)['status'] == 'accepted'
+    assert live.wait(120)
+    assert live.status()['last']['result']['status'] == 'error' and live.status()['swaps'] == 1
+
+    # So does a rebuilt model that cannot be opened
+    current = live.engine
+    live._engine_factory = lambda: load_engine(str(tmp_path / 'unreadable'))
+    assert handle_request(dict(retrain), live)['status'] == 'accepted'
+    assert live.wait(120)
+    assert live.status()['last']['result']['code'] == 'swap_failed'
+    assert live.engine is current and live.status()['swaps'] == 1
+
+
+def test_concurrent_requests_match_single_threaded_results_across_a_retrain(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from benchmark_recommendation_engine import synthetic_activities
+    from recommendation_engine import ActivityRecommendationEngine
+
+    ann_index = {'n_tables': 8, 'n_bits': 6}
+    catalogs = {'old': synthetic_activities(600, seed=1), 'new': synthetic_activities(500, seed=2)}
+    for name, catalog in catalogs.items():
+        _trained_engine(tmp_path / name, catalog, ann_index=ann_index)
+
+    def open_engine(name):
+        engine = ActivityRecommendationEngine(str(tmp_path / name), ann_index=ann_index)
+        engine.load_model()
+        return engine
+
+    pool = synthetic_activities(80, seed=3)
+    profiles = [{'interests': interests, 'budget': budget, 'pace': pace}
+                for interests in (['food'], ['culture', 'outdoors'], [])
+                for budget, pace in ((1, 'fast'), (3, 'relaxed'))]
+
+    def run(engine, request):
+        kind, i = request
+        if kind == 'pool':
+            results = [engine.get_personalized_recommendations(profiles[i], pool, 5)]
+        elif kind == 'catalog':
+            results = [engine.get_catalog_recommendations(profiles[i], 5, probes=2)]
+        else:
+            results = engine.get_batch_recommendations(profiles[i:], pool, 5)
+        return [[(activity['place_id'], score) for activity, score in recommendations] for recommendations in results]
+
+    requests = [(kind, i) for kind in ('pool', 'catalog', 'batch') for i in range(len(profiles))] * 8
+    expected = {}
+    for name in catalogs:
+        single = open_engine(name)
+        expected[name] = {request: run(single, request) for request in set(requests)}
+
+    # Many threads on one engine, starting before the catalog has been read from disk
+    engine = open_engine('old')
+    with ThreadPoolExecutor(16) as executor:
+        results = list(executor.map(lambda request: run(engine, request), requests))
+    assert results == [expected['old'][request] for request in requests]
+
+    # A retrain in place while they run: each request scores with one whole model
+    with ThreadPoolExecutor(16) as executor:
+        futures = [executor.submit(run, engine, request) for request in requests]
+        engine.train_content_based_model(catalogs['new'], force_retrain=True)
+        results = [future.result() for future in futures]
+    assert all(result in (expected['old'][request], expected['new'][request])
+               for request, result in zip(requests, results))
+    assert [run(engine, request) for request in requests[::5]] == [expected['new'][request] for request in requests[::5]]
+
+
+def test_destination_shards_load_on_first_use_and_evict_within_budget(tmp_path):
+    from benchmark_recommendation_engine import synthetic_activities
+    from model_shards import DestinationShards
+    from recommendation_engine import handle_request
+
+    shards = DestinationShards(str(tmp_path), memory_budget_mb=100)
+    cities = {'Tokyo, Japan': synthetic_activities(400, seed=1), 'Orlando': synthetic_activities(300, seed=2)}
+    for city, activities in cities.items():
+        result = handle_request({'train': True, 'destination': city, 'activities': activities}, shards)
+        assert result['model_info']['metadata']['activities_count'] == len(activities)
+    assert shards.destinations() == ['orlando', 'tokyo-japan']
+    assert (tmp_path / 'destinations' / 'tokyo-japan' / 'activity_recommendation_model').is_dir()
+
+    # A fresh worker loads only the shards its requests name
+    profile = {'interests': ['food'], 'budget': 2}
+    request = {'recommend': True, 'user_profile': profile, 'activities': cities['Orlando'][:30], 'top_n': 3}
+    shards = DestinationShards(str(tmp_path), memory_budget_mb=100)
+    expected = handle_request(dict(request, destination='orlando'), shards)['recommendations']
+    assert shards.stats()['loaded'] == ['orlando'] and shards.loads == 1
+
+    # With room for one shard, using Tokyo evicts Orlando, which reloads on demand
+    tokyo = shards.engine_for('Tokyo, Japan')
+    budget = max(tokyo.memory_bytes(), shards.engine_for('orlando').memory_bytes())
+    shards.memory_budget = budget
+    handle_request(dict(request, destination='Tokyo, Japan'), shards)
+    assert shards.stats()['loaded'] == ['tokyo-japan'] and shards.evictions == 1
+    assert handle_request(dict(request, destination='orlando'), shards)['recommendations'] == expected
+    assert shards.stats()['loaded'] == ['orlando'] and shards.loads == 3
+    assert shards.stats()['memory_bytes'] <= budget
+
+    # Requests without a destination use the top-level model; pure-Python modes load nothing
+    info = handle_request({'info': True}, shards)
+    assert info['model_info'] == {'status': 'not_trained'} and info['shards']['destinations'] == ['orlando', 'tokyo-japan']
+    loads = shards.loads
+    handle_request({'summary': True, 'user_profile': profile, 'destination': 'Paris', 'total_activities': 3}, shards)
+    assert shards.loads == loads
+
+    # A destination without a trained shard is an error, and leaves nothing behind
+    try:
+        handle_request(dict(request, destination='Paris'), shards)
+    except ValueError as e:
+        assert 'Paris' in str(e)
+    else:
+        raise AssertionError('expected a ValueError')
+    assert not (tmp_path / 'destinations' / 'paris').exists() and shards.loads == loads
+
+    # A resident server retrains a shard in the background while it keeps serving
+    shards = DestinationShards(str(tmp_path), background_rebuilds=True)
+    assert handle_request(dict(request, destination='orlando'), shards)['recommendations'] == expected
+    retrain = {'train': True, 'force_retrain': True, 'destination': 'Orlando', 'activities': cities['Orlando'][:40]}
+    assert handle_request(retrain, shards)['status'] == 'accepted'
+    assert handle_request(dict(retrain), shards)['code'] == 'rebuild_in_progress'
+    assert handle_request(dict(request, destination='orlando'), shards)['recommendations'] == expected
+    assert shards.wait(120)
+    assert shards.stats()['rebuilds']['last']['orlando']['result']['status'] == 'success'
+    assert shards.engine_for('orlando').model_metadata['activities_count'] == 40
+
+
+def test_train_destinations_trains_shards_in_worker_processes(tmp_path):
+    from benchmark_recommendation_engine import synthetic_activities
+    from model_shards import DestinationShards, train_destination_shards
+    from recommendation_engine import handle_request
+
+    source = tmp_path / 'activities.ndjson'
+    cities = {'Tokyo, Japan': synthetic_activities(300, seed=1), 'Orlando': synthetic_activities(200, seed=2)}
+    with open(source, 'w') as f:
+        for city, activities in cities.items():
+            f.writelines(json.dumps(dict(activity, destination=city)) + '\n' for activity in activities)
+
+    model_dir = tmp_path / 'models'
+    result = train_destination_shards(str(model_dir), source, workers=2, embedding_precision='float32')
+    assert result['status'] == 'success' and result['workers'] == 2
+    assert [(shard['key'], shard['activities']) for shard in result['shards']] == [('orlando', 200), ('tokyo-japan', 300)]
+    assert all({'feature_extraction', 'save', 'total'} <= set(shard['timings']) for shard in result['shards'])
+
+    shards = DestinationShards(str(model_dir))
+    assert shards.destinations() == ['orlando', 'tokyo-japan']
+    info = handle_request({'info': True, 'destination': 'Tokyo, Japan'}, shards)['model_info']
+    assert info['metadata']['activities_count'] == 300 and info['embedding_precision'] == 'float32'
+    assert shards.engine_for('orlando').model_metadata['activities_count'] == 200
+
+    # Retraining from a directory of per-destination files swaps in new versions;
+    # a destination that fails keeps its previous model
+    (tmp_path / 'by_city').mkdir()
+    with open(tmp_path / 'by_city' / 'orlando.json', 'w') as f:
+        json.dump(cities['Orlando'][:50], f)
+    (tmp_path / 'by_city' / 'tokyo-japan.ndjson').write_text('{"broken"\n')
+    result = train_destination_shards(str(model_dir), tmp_path / 'by_city', workers=1)
+    assert result['status'] == 'error'
+    assert [shard['status'] for shard in result['shards']] == ['success', 'error']
+    # Loaded shards pick up the new version on their next request
+    loads = shards.loads
+    assert shards.engine_for('orlando').model_metadata['activities_count'] == 50
+    assert shards.engine_for('tokyo-japan').model_metadata['activities_count'] == 300
+    assert shards.loads == loads + 1
+    assert shards.reload('tokyo-japan') and not shards.reload('paris')
+    assert shards.engine_for('tokyo-japan').model_metadata['activities_count'] == 300
+    assert shards.loads == loads + 2
+
+
+def test_embedding_cache_transforms_only_misses_and_follows_model_version(tmp_path):
+    import numpy as np
+
+    engine = _trained_engine(tmp_path)
+    profile = {'interests': ['food'], 'budget': 2}
+    transformed = []
+    transform = engine.compiled_transform.transform
+    engine.compiled_transform.transform = (
+        lambda columns, **kwargs: transformed.append(len(columns)) or transform(columns, **kwargs)
+    )
+
+    first = engine._transform_activities(SAMPLE_ACTIVITIES[:4])
+    changed = dict(SAMPLE_ACTIVITIES[1], rating=2.0)
+    second = engine._transform_activities([SAMPLE_ACTIVITIES[3], changed] + SAMPLE_ACTIVITIES[4:])
+
+    assert transformed == [4, 3]
+    assert np.array_equal(second[0], first[3])
+    assert np.allclose(second, transform(engine._feature_columns([SAMPLE_ACTIVITIES[3], changed] + SAMPLE_ACTIVITIES[4:])))
+    assert engine.get_personalized_recommendations(profile, SAMPLE_ACTIVITIES, 3)
+    assert engine.embedding_cache.stats()['hits'] == 1 + 6
+
+    # A retrain changes the model version and empties the cache
+    engine.train_content_based_model(SAMPLE_ACTIVITIES[:5], force_retrain=True)
+    engine.get_personalized_recommendations(profile, SAMPLE_ACTIVITIES, 3)
+    assert engine.embedding_cache.stats()['hits'] == 0
+
+
+def test_vectorized_boosting_and_top_n_match_per_activity_ranking(tmp_path):
+    import random
+    import numpy as np
+    from recommendation_engine import top_n_indices
+
+    engine = _trained_engine(tmp_path)
+    rng = random.Random(3)
+    type_pool = ['museum', 'art_gallery', 'park', 'amusement_park', 'restaurant', 'Food_court', 'store', 'bar']
+    candidates = []
+    for i in range(300):
+        activity = {'place_id': f'p{i}', 'types': rng.sample(type_pool, rng.randint(0, 3)),
+                    'rating': rng.choice([3.5, 4.0, 4.5]), 'user_ratings_total': rng.choice([10, 500])}
+        if rng.random() < 0.7:
+            activity['price_level'] = rng.randint(0, 4)
+        candidates.append(activity)
+
+    profiles = [
+        {'interests': ['art', 'food', 'food'], 'budget': 1, 'pace': 'fast'},
+        {'interests': ['PARK'], 'budget': 3, 'pace': 'relaxed'},
+        {},
+    ]
+    for profile in profiles:
+        base = np.array([rng.choice([0.0, 0.25, 0.5]) for _ in candidates])
+        expected = [(a, engine._apply_preference_boosting(a, profile, b)) for a, b in zip(candidates, base)]
+        expected.sort(key=lambda x: x[1], reverse=True)
+
+        scores = engine._boost_scores(base, [a.get('types', []) for a in candidates],
+                                      engine._boosting_prices(candidates), profile)
+        for top_n in (1, 7, 300, 500, -2):
+            ranked = [(candidates[i], scores[i]) for i in top_n_indices(scores, top_n)]
+            assert ranked == expected[:top_n]
+
+
+def test_batch_recommendations_match_per_user_calls(tmp_path):
+    import pytest
+    from recommendation_engine import ActivityRecommendationEngine, handle_request
+
+    engine = _trained_engine(tmp_path)
+    profiles = [
+        {'interests': ['food', 'culture'], 'budget': 1, 'pace': 'fast'},
+        {'interests': ['outdoors', 'entertainment'], 'budget': 3, 'pace': 'relaxed'},
+        {'interests': ['shopping']},
+        {},
+    ]
+
+    batched = engine.get_batch_recommendations(profiles, SAMPLE_ACTIVITIES, 4)
+    assert len(batched) == len(profiles)
+    for profile, recommendations in zip(profiles, batched):
+        expected = engine.get_personalized_recommendations(profile, SAMPLE_ACTIVITIES, 4)
+        assert [a['place_id'] for a, _ in recommendations] == [a['place_id'] for a, _ in expected]
+        assert [score for _, score in recommendations] == pytest.approx([score for _, score in expected])
+
+    result = handle_request({'multi_recommend': True, 'user_profiles': profiles,
+                             'activities': SAMPLE_ACTIVITIES, 'top_n': 2}, engine)
+    assert result['status'] == 'success'
+    assert [len(recommendations) for recommendations in result['recommendations']] == [2] * len(profiles)
+
+    # Without a model every user gets the fallback ranking
+    untrained = ActivityRecommendationEngine(model_dir=str(tmp_path / 'untrained'))
+    fallback = untrained.get_batch_recommendations(profiles[:2], SAMPLE_ACTIVITIES, 3)
+    assert fallback[0] == fallback[1] == untrained._fallback_recommendations(SAMPLE_ACTIVITIES, 3)
+
+
+def test_timings_block_breaks_down_recommend_stages(tmp_path):
+    from engine_timing import encode_with_timings
+    from engine_io import get_codec
+    from recommendation_engine import handle_request
+
+    engine = _trained_engine(tmp_path)
+    request = {'recommend': True, 'user_profile': {'interests': ['food'], 'budget': 2},
+               'activities': SAMPLE_ACTIVITIES, 'top_n': 2}
+
+    assert 'timings' not in handle_request(dict(request), engine)
+
+    # Start cold so the candidates go through the transform again
+    engine.embedding_cache.clear()
+    result = handle_request(dict(request, timings=True), engine)
+    timings = result['timings']
+    assert {'feature_extraction', 'transform', 'similarity', 'boosting', 'sort'} <= set(timings)
+    assert sum(v for k, v in timings.items() if k != 'total') <= timings['total'] + 0.01
+
+    encoded = json.loads(encode_with_timings(result, get_codec('json').encode, json_output=True))
+    assert encoded['recommendations'] == json.loads(json.dumps(result['recommendations']))
+    assert encoded['timings']['serialize'] >= 0
+    assert encoded['timings']['total'] >= timings['total']
+
+
+def test_encode_json_handles_numpy_datetime_and_dataclasses(monkeypatch):
+    import dataclasses
+    from datetime import datetime
+    import numpy as np
+    import engine_io
+
+    @dataclasses.dataclass
+    class Tip:
+        title: str
+        priority: int
+
+    payload = {'score': np.float64(0.25), 'count': np.int64(3), 'vector': np.arange(3, dtype=np.float32),
+               'at': datetime(2024, 5, 1, 12, 30), 'tip': Tip('Go early', 2), 'name': 'Café'}
+    expected = {'score': 0.25, 'count': 3, 'vector': [0.0, 1.0, 2.0],
+                'at': '2024-05-01T12:30:00', 'tip': {'title': 'Go early', 'priority': 2}, 'name': 'Café'}
+
+    for orjson in (engine_io.orjson, None):
+        monkeypatch.setattr(engine_io, 'orjson', orjson)
+        compact = engine_io.encode_json(payload)
+        assert b'\n' not in compact and b': ' not in compact
+        assert json.loads(compact) == expected
+        assert json.loads(engine_io.encode_json(payload, pretty=True)) == expected
+
+
+def test_arrow_activities_match_json_recommendations(tmp_path):
+    import base64
+    from engine_io import activities_to_arrow
+    from recommendation_engine import handle_request
+
+    engine = _trained_engine(tmp_path)
+    profile = {'interests': ['food', 'museum'], 'budget': 2, 'pace': 'moderate'}
+    expected = handle_request({'recommend': True, 'user_profile': profile,
+                               'activities': SAMPLE_ACTIVITIES, 'top_n': 3}, engine)
+
+    payload = activities_to_arrow(SAMPLE_ACTIVITIES)
+    for activities in (payload, {'arrow_ipc': base64.b64encode(payload).decode('ascii')}):
+        result = handle_request({'recommend': True, 'user_profile': profile,
+                                 'activities': activities, 'top_n': 3}, engine)
+        assert [r['activity']['place_id'] for r in result['recommendations']] == \
+            [r['activity']['place_id'] for r in expected['recommendations']]
+        assert [r['score'] for r in result['recommendations']] == \
+            [r['score'] for r in expected['recommendations']]
+
+
+def test_streaming_request_parses_array_items_incrementally():
+    import io
+    from engine_io import StreamingJsonRequest
+
+    payload = {'train': True, 'activities': SAMPLE_ACTIVITIES * 50, 'force_retrain': True, 'top_n': 12345}
+    request = StreamingJsonRequest(io.BytesIO(json.dumps(payload, indent=1).encode('utf-8')), chunk_size=7)
+
+    assert request.read_header() == {'train': True}
+    items = list(request.items())
+    assert items == payload['activities']
+    assert request.fields == {'train': True, 'force_retrain': True, 'top_n': 12345}
+    assert request.array_found
+
+    request = StreamingJsonRequest(io.BytesIO(b'{"recommend": true, "top_n": 3}'))
+    assert list(request.items()) == [] and not request.array_found
+
+
+def test_streaming_train_matches_in_memory_training(tmp_path):
+    import io
+    import numpy as np
+    from recommendation_engine import handle_streaming_request
+
+    activities = [dict(a, rating=a['rating'] - i * 0.01) for i in range(40) for a in SAMPLE_ACTIVITIES]
+    payload = json.dumps({'train': True, 'force_retrain': True, 'activities': activities}).encode('utf-8')
+
+    result = handle_streaming_request(io.BytesIO(payload), str(tmp_path / 'streamed'), chunk_size=17)
+    expected = _trained_engine(tmp_path / 'memory', activities)
+
+    assert result['activities_streamed'] == len(activities)
+    from recommendation_engine import load_engine
+    streamed = load_engine(str(tmp_path / 'streamed'))
+    np.testing.assert_allclose(streamed.activity_embeddings, expected.activity_embeddings)
+
+    # Training options after the array fail the request instead of being ignored
+    late = json.dumps({'train': True, 'activities': activities[:30], 'force_retrain': True}).encode('utf-8')
+    try:
+        handle_streaming_request(io.BytesIO(late), str(tmp_path / 'streamed'))
+    except ValueError as e:
+        assert 'force_retrain' in str(e)
+    else:
+        raise AssertionError('expected a ValueError')
+    late = json.dumps({'train': True, 'force_retrain': True, 'activities': activities[:30],
+                       'embedding_precision': 'float32'}).encode('utf-8')
+    try:
+        handle_streaming_request(io.BytesIO(late), str(tmp_path / 'streamed'), chunk_size=17)
+    except ValueError as e:
+        assert 'embedding_precision' in str(e)
+    else:
+        raise AssertionError('expected a ValueError')
+    assert load_engine(str(tmp_path / 'streamed')).model_metadata['activities_count'] == len(activities)
+
+    # Keeping the recent model is not reported as training
+    kept = json.dumps({'train': True, 'activities': activities[:30]}).encode('utf-8')
+    result = handle_streaming_request(io.BytesIO(kept), str(tmp_path / 'streamed'))
+    assert result['activities_streamed'] == 0 and 'not retrained' in result['message']
+
+    # A streamed recommend without activities ranks the catalog, as the regular path does
+    from recommendation_engine import handle_request
+
+    _trained_engine(tmp_path / 'catalog', activities, ann_index={'n_tables': 4, 'n_bits': 4})
+    recommend = {'recommend': True, 'user_profile': {'interests': ['food']}, 'top_n': 3}
+    result = handle_streaming_request(io.BytesIO(json.dumps(recommend).encode('utf-8')), str(tmp_path / 'catalog'))
+    assert result['status'] == 'success' and len(result['recommendations']) == 3
+    assert result['recommendations'] == handle_request(recommend, load_engine(str(tmp_path / 'catalog')))['recommendations']
+
+
+def test_hashed_streaming_train_writes_embeddings_out_of_core(tmp_path):
+    import io
+    import numpy as np
+    from benchmark_recommendation_engine import synthetic_activities
+    from feature_transform import NUMERICAL_FEATURES
+    from recommendation_engine import handle_streaming_request, load_engine
+
+    activities = synthetic_activities(3000, seed=5)
+    payload = json.dumps({'train': True, 'force_retrain': True, 'hashed_features': {'n_text_buckets': 32},
+                          'embedding_precision': 'float32', 'activities': activities}).encode('utf-8')
+    result = handle_streaming_request(io.BytesIO(payload), str(tmp_path), chunk_size=700)
+    assert result['activities_streamed'] == 3000
+    assert result['model_info']['feature_matrix_shape'] == (3000, 64 + len(NUMERICAL_FEATURES) + 32)
+    assert not list(tmp_path.glob('.hashed-*'))
+
+    engine = load_engine(str(tmp_path))
+    embeddings = engine.activity_embeddings
+    assert isinstance(embeddings, np.memmap) and embeddings.dtype == np.float32
+    assert engine.activity_features is None and engine.model_pipeline is None
+    assert len(engine.activity_ids) == 3000
+
+    # Statistics accumulated chunk by chunk are those of the whole catalog, and
+    # request-time embeddings match the stored rows
+    columns = engine._feature_columns(activities)
+    numeric = np.column_stack([columns.numeric[name] for name in NUMERICAL_FEATURES]).astype(float)
+    np.testing.assert_allclose(engine.compiled_transform.mean, numeric.mean(axis=0))
+    np.testing.assert_allclose(engine.compiled_transform.scale, np.where(numeric.std(axis=0) > 0, numeric.std(axis=0), 1.0))
+    np.testing.assert_allclose(engine._embed_columns(columns), embeddings, atol=1e-6)
+
+    profile = {'interests': ['food'], 'budget': 2}
+    assert len(engine.get_personalized_recommendations(profile, activities[:40], 5)) == 5
+
+    # Any new type has a bucket, so updates never refit
+    update = engine.update_model([dict(activities[0], types=['ski_resort'])], removed_ids=[activities[1]['place_id']])
+    assert update == {'added': 0, 'replaced': 1, 'removed': 1, 'unseen_category_rate': 0.0, 'refit': False}
+    assert load_engine(str(tmp_path)).activity_embeddings.shape[0] == 2999